@@ -7,6 +7,7 @@ Streaming via server-side cursor em chunks de 50k — sem carregar 18M rows em m
 """
 import os, sys, time, pathlib, psycopg2, meilisearch
 from dotenv import load_dotenv
+import incremental
 
 load_dotenv(os.path.join(pathlib.Path().resolve(), ".env"))
 
@@ -42,9 +43,11 @@ except Exception:
 idx = meili.index(INDEX_NAME)
 
 # Detectar quantos docs já estão indexados para retomar onde parou
+# (no modo incremental o index já está completo: só as pessoas alteradas são refeitas)
 already_indexed = 0
 try:
-    already_indexed = idx.get_stats().number_of_documents
+    if not incremental.ATIVO:
+        already_indexed = idx.get_stats().number_of_documents
 except Exception:
     pass
 if already_indexed > 0:
@@ -68,16 +71,7 @@ idx.update_settings({
 })
 print("  Settings atualizados.", flush=True)
 
-# ── Streaming e indexação em chunks ──────────────────────────────────────────
-print(f"\nIndexando {total:,} pessoas em chunks de {CHUNK:,}...", flush=True)
-t0 = time.time()
-
-conn2 = psycopg2.connect(DSN)
-cur2  = conn2.cursor("meili_stream")
-cur2.itersize = CHUNK
-offset_clause = f"OFFSET {already_indexed}" if already_indexed > 0 else ""
-cur2.execute(f"""
-    SELECT
+COLUNAS = """
         id::text,
         nome,
         slug,
@@ -87,7 +81,68 @@ cur2.execute(f"""
         score_inativas_pct,
         anos_experiencia,
         estados_count,
-        cnaes_count
+        cnaes_count"""
+
+def documento(r):
+    return {
+        "id":                 r[0],
+        "nome":               r[1],
+        "slug":               r[2],
+        "total_empresas":     r[3] or 0,
+        "ativas":             r[4] or 0,
+        "inativas":           r[5] or 0,
+        "score_inativas_pct": r[6] or 0,
+        "anos_experiencia":   r[7],
+        "estados_count":      r[8] or 0,
+        "cnaes_count":        r[9] or 0,
+    }
+
+# ── LOAD_MODE=incremental: só as pessoas de _pessoas_alteradas (ver incremental.py) ──
+if incremental.ATIVO:
+    t0 = time.time()
+    alteradas = f'SELECT id FROM "{SCHEMA}"."{incremental.PESSOAS_ALTERADAS}"'
+    cur.execute(f"""
+        SELECT {COLUNAS}
+        FROM "{SCHEMA}".pessoas_consolidado
+        WHERE nome IS NOT NULL AND nome != '' AND id IN ({alteradas})
+    """)
+    tasks = []
+    atualizadas = 0
+    while True:
+        rows = cur.fetchmany(CHUNK)
+        if not rows:
+            break
+        tasks.append(idx.add_documents([documento(r) for r in rows]).task_uid)
+        atualizadas += len(rows)
+    # Pessoas que deixaram de ter empresas (ou de ter nome) saem do index
+    cur.execute(f"""
+        SELECT a.id::text FROM "{SCHEMA}"."{incremental.PESSOAS_ALTERADAS}" a
+        WHERE NOT EXISTS (
+            SELECT 1 FROM "{SCHEMA}".pessoas_consolidado pc
+            WHERE pc.id = a.id AND pc.nome IS NOT NULL AND pc.nome != ''
+        )
+    """)
+    removidas = [r[0] for r in cur.fetchall()]
+    for i in range(0, len(removidas), CHUNK):
+        tasks.append(idx.delete_documents(removidas[i:i + CHUNK]).task_uid)
+    for task_uid in tasks:
+        meili.wait_for_task(task_uid, timeout_in_ms=300_000)
+    cur.close()
+    conn.close()
+    print(f"Incremental: {atualizadas:,} pessoas atualizadas, {len(removidas):,} removidas "
+          f"em {round(time.time()-t0)}s", flush=True)
+    sys.exit(0)
+
+# ── Streaming e indexação em chunks ──────────────────────────────────────────
+print(f"\nIndexando {total:,} pessoas em chunks de {CHUNK:,}...", flush=True)
+t0 = time.time()
+
+conn2 = psycopg2.connect(DSN)
+cur2  = conn2.cursor("meili_stream")
+cur2.itersize = CHUNK
+offset_clause = f"OFFSET {already_indexed}" if already_indexed > 0 else ""
+cur2.execute(f"""
+    SELECT {COLUNAS}
     FROM "{SCHEMA}".pessoas_consolidado
     WHERE nome IS NOT NULL AND nome != ''
     ORDER BY total_empresas DESC
@@ -104,21 +159,7 @@ while True:
         break
     chunk_num += 1
 
-    docs = [
-        {
-            "id":                 r[0],
-            "nome":               r[1],
-            "slug":               r[2],
-            "total_empresas":     r[3] or 0,
-            "ativas":             r[4] or 0,
-            "inativas":           r[5] or 0,
-            "score_inativas_pct": r[6] or 0,
-            "anos_experiencia":   r[7],
-            "estados_count":      r[8] or 0,
-            "cnaes_count":        r[9] or 0,
-        }
-        for r in rows
-    ]
+    docs = [documento(r) for r in rows]
 
     # Aguarda task anterior antes de enviar próximo chunk (backpressure)
     if pending_task is not None:
@@ -12,6 +12,7 @@ Deve rodar APÓS build_socios_consolidado.py.
 """
 import os, sys, time, pathlib, psycopg2, meilisearch
 from dotenv import load_dotenv
+import incremental
 
 load_dotenv(os.path.join(pathlib.Path().resolve(), ".env"))
 
@@ -47,7 +48,8 @@ idx = meili.index(INDEX_NAME)
 
 already_indexed = 0
 try:
-    already_indexed = idx.get_stats().number_of_documents
+    if not incremental.ATIVO:
+        already_indexed = idx.get_stats().number_of_documents
 except Exception:
     pass
 if already_indexed > 0:
@@ -68,16 +70,7 @@ idx.update_settings({
 })
 print("  Settings atualizados.", flush=True)
 
-print(f"\nIndexando {total:,} socios em chunks de {CHUNK:,}...", flush=True)
-t0 = time.time()
-
-conn2 = psycopg2.connect(DSN)
-cur2  = conn2.cursor("meili_socios_stream")
-cur2.itersize = CHUNK
-offset_clause = f"OFFSET {already_indexed}" if already_indexed > 0 else ""
-cur2.execute(f"""
-    SELECT
-        ROW_NUMBER() OVER (ORDER BY cnpj_basico, cpf_cnpj_socio) AS row_id,
+COLUNAS = """
         cnpj_basico,
         nome_socio_razao_social,
         cpf_cnpj_socio,
@@ -90,7 +83,78 @@ cur2.execute(f"""
         identificador_socio,
         razao_social,
         cnae_fiscal_principal,
-        desc_cnae_principal
+        desc_cnae_principal"""
+
+def documento(r):
+    return {
+        "row_id":                 r[0],
+        "cnpj_basico":            r[1],
+        "nome_socio_razao_social": r[2],
+        "cpf_cnpj_socio":         r[3],
+        "qualificacao_socio":     r[4],
+        "data_entrada_sociedade": r[5],
+        "situacao_cadastral":     r[6],
+        "uf":                     r[7],
+        "porte_empresa":          r[8],
+        "capital_social":         float(r[9]) if r[9] else 0.0,
+        "identificador_socio":    r[10],
+        "razao_social":           r[11],
+        "cnae_fiscal_principal":  r[12],
+        "desc_cnae_principal":    r[13],
+    }
+
+# ── LOAD_MODE=incremental: refaz os docs dos cnpj_basico alterados (ver incremental.py) ──
+# Os docs antigos saem por filtro em cnpj_basico; os novos recebem row_id
+# "<cnpj_basico>-<n>", que não colide com a numeração global da carga completa.
+FILTRO_LOTE = 500
+if incremental.ATIVO:
+    t0 = time.time()
+    conn = psycopg2.connect(DSN)
+    cur  = conn.cursor()
+    cur.execute(f'SELECT cnpj_basico FROM "{SCHEMA}"."{incremental.ALTERADOS}"')
+    alterados = [r[0] for r in cur.fetchall()]
+    tasks = []
+    for i in range(0, len(alterados), FILTRO_LOTE):
+        lista = ', '.join(f"'{b}'" for b in alterados[i:i + FILTRO_LOTE])
+        tasks.append(idx.delete_documents(filter=f'cnpj_basico IN [{lista}]').task_uid)
+    # A remoção precisa terminar antes da inclusão dos docs novos dos mesmos cnpj_basico
+    for task_uid in tasks:
+        meili.wait_for_task(task_uid, timeout_in_ms=300_000)
+
+    cur.execute(f"""
+        SELECT
+            cnpj_basico || '-' || ROW_NUMBER() OVER (
+                PARTITION BY cnpj_basico ORDER BY cpf_cnpj_socio, nome_socio_razao_social) AS row_id,
+            {COLUNAS}
+        FROM "{SCHEMA}".socios_consolidado
+        WHERE {incremental.filtro_alterados(SCHEMA)}
+    """)
+    tasks = []
+    indexed = 0
+    while True:
+        rows = cur.fetchmany(CHUNK)
+        if not rows:
+            break
+        tasks.append(idx.add_documents([documento(r) for r in rows]).task_uid)
+        indexed += len(rows)
+    for task_uid in tasks:
+        meili.wait_for_task(task_uid, timeout_in_ms=300_000)
+    cur.close(); conn.close()
+    print(f"Incremental: {len(alterados):,} cnpj_basico, {indexed:,} socios reindexados "
+          f"em {round(time.time()-t0)}s", flush=True)
+    sys.exit(0)
+
+print(f"\nIndexando {total:,} socios em chunks de {CHUNK:,}...", flush=True)
+t0 = time.time()
+
+conn2 = psycopg2.connect(DSN)
+cur2  = conn2.cursor("meili_socios_stream")
+cur2.itersize = CHUNK
+offset_clause = f"OFFSET {already_indexed}" if already_indexed > 0 else ""
+cur2.execute(f"""
+    SELECT
+        ROW_NUMBER() OVER (ORDER BY cnpj_basico, cpf_cnpj_socio) AS row_id,
+        {COLUNAS}
     FROM "{SCHEMA}".socios_consolidado
     ORDER BY cnpj_basico, cpf_cnpj_socio
     {offset_clause}
@@ -106,25 +170,7 @@ while True:
         break
     chunk_num += 1
 
-    docs = [
-        {
-            "row_id":                 r[0],
-            "cnpj_basico":            r[1],
-            "nome_socio_razao_social": r[2],
-            "cpf_cnpj_socio":         r[3],
-            "qualificacao_socio":     r[4],
-            "data_entrada_sociedade": r[5],
-            "situacao_cadastral":     r[6],
-            "uf":                     r[7],
-            "porte_empresa":          r[8],
-            "capital_social":         float(r[9]) if r[9] else 0.0,
-            "identificador_socio":    r[10],
-            "razao_social":           r[11],
-            "cnae_fiscal_principal":  r[12],
-            "desc_cnae_principal":    r[13],
-        }
-        for r in rows
-    ]
+    docs = [documento(r) for r in rows]
 
     if pending_task is not None:
         meili.wait_for_task(pending_task, timeout_in_ms=120_000)
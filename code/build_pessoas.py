@@ -1,19 +1,19 @@
 """
-ETL: deduplica socios por cpf_cnpj_socio e popula dados_rfb.pessoas com IDs canônicos.
+ETL: deduplica socios por (cpf_cnpj_socio, nome) e popula dados_rfb.pessoas com IDs canônicos.
 
-Pré-requisito: tabela dados_rfb.socios já populada.
+Pré-requisito: tabela dados_rfb.socios já populada, com socios.pessoa_id gravada
+pela própria carga (etl_postgres.py; ver pessoa_id.py).
 Pós-condição:
-  - dados_rfb.pessoas criada e populada
-  - dados_rfb.socios.pessoa_id preenchida com FK para pessoas.id
+  - dados_rfb.pessoas criada e populada a partir das pessoa_id distintas de socios
 """
 
 import os
-import re
-import uuid
 import pathlib
-import unicodedata
+import polars as pl
 import psycopg2
 from dotenv import load_dotenv
+from pg_copy import copia_de_saida, copiar_fluxo, csv_de_dataframe, tipos_da_consulta
+from pessoa_id import nome_canonico, slug
 
 # ---------------------------------------------------------------------------
 # Config
@@ -32,25 +32,6 @@ DSN = (
 )
 SCHEMA = os.getenv("DB_SCHEMA", "dados_rfb")
 
-# Namespace fixo — garante que o mesmo cpf_cnpj sempre gera o mesmo UUID
-UUID_NAMESPACE = uuid.UUID("a1b2c3d4-e5f6-7890-abcd-ef1234567890")
-
-
-# ---------------------------------------------------------------------------
-# Helpers
-# ---------------------------------------------------------------------------
-def normalize_name(name: str) -> str:
-    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
-    name = name.lower().strip()
-    name = re.sub(r"[^a-z0-9\s]", "", name)
-    name = re.sub(r"\s+", "-", name)
-    return name[:60]
-
-
-def make_slug(uid: uuid.UUID, name: str) -> str:
-    return f"{str(uid)[:8]}-{normalize_name(name)}"
-
-
 # ---------------------------------------------------------------------------
 # DDL
 # ---------------------------------------------------------------------------
@@ -88,7 +69,7 @@ def main():
     conn = psycopg2.connect(DSN)
     cur = conn.cursor()
 
-    # Cria coluna pessoa_id em socios se não existir
+    # Cria coluna pessoa_id em socios se não existir (cargas anteriores ao cálculo na carga)
     cur.execute(DDL_FK)
     conn.commit()
 
@@ -96,55 +77,38 @@ def main():
     print("Criando pessoas_new...")
     cur.execute(f'DROP TABLE IF EXISTS "{SCHEMA}".pessoas_new CASCADE')
     cur.execute(DDL_PESSOAS_NEW)
-    cur.execute(f'ALTER TABLE "{SCHEMA}".socios DROP COLUMN IF EXISTS pessoa_id')
-    cur.execute(DDL_FK)
     conn.commit()
 
-    print("Carregando distinct cpf_cnpj_socio + nome...")
-    cur.execute(f"""
-        SELECT cpf_cnpj_socio, nome_socio_razao_social
+    # Um único GROUP BY em socios: o id já identifica (cpf_cnpj, nome), e
+    # qualquer grafia do grupo dá o mesmo nome canônico
+    print("Carregando pessoa_id distintos de socios...")
+    query = f"""
+        SELECT pessoa_id::text AS id, MIN(cpf_cnpj_socio) AS cpf_cnpj, MIN(nome_socio_razao_social) AS nome
         FROM "{SCHEMA}".socios
-        WHERE cpf_cnpj_socio IS NOT NULL AND cpf_cnpj_socio <> ''
-        GROUP BY cpf_cnpj_socio, nome_socio_razao_social
-    """)
-    rows = cur.fetchall()
-    print(f"  {len(rows):,} combinações únicas encontradas")
-
-    # Chave de identidade: (cpf_cnpj + nome) — CPF mascarado não é único por pessoa
-    # O mesmo padrão ***052458** pode representar centenas de pessoas distintas
-    seen: dict[tuple[str, str], tuple[uuid.UUID, str]] = {}
-    for cpf_cnpj, nome in rows:
-        nome_clean = (nome or "").strip().upper()
-        key = (cpf_cnpj, nome_clean)
-        if key not in seen:
-            uid = uuid.uuid5(UUID_NAMESPACE, f"{cpf_cnpj}|{nome_clean}")
-            slug = make_slug(uid, nome_clean or cpf_cnpj)
-            seen[key] = (uid, nome_clean, slug)
-
-    print(f"  {len(seen):,} pessoas únicas após deduplicação")
-
-    print("Inserindo em pessoas (UPSERT)...")
-    insert_sql = f"""
-        INSERT INTO "{SCHEMA}".pessoas_new (id, cpf_cnpj, nome, slug)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (id) DO NOTHING
+        WHERE pessoa_id IS NOT NULL
+        GROUP BY pessoa_id
     """
-    batch = [(str(uid), cpf, nome, slug) for (cpf, _), (uid, nome, slug) in seen.items()]
-    cur.executemany(insert_sql, batch)
+    schema = tipos_da_consulta(conn, query)
+    with copia_de_saida(conn, query) as stream:
+        pessoas = pl.read_csv(stream, has_header=False, schema=schema, raise_if_empty=False)
     conn.commit()
-    print(f"  {cur.rowcount:,} linhas inseridas em pessoas_new")
-
-    print("Atualizando socios.pessoa_id (via pessoas_new)...")
-    cur.execute(f"""
-        UPDATE "{SCHEMA}".socios s
-        SET pessoa_id = p.id
-        FROM "{SCHEMA}".pessoas_new p
-        WHERE s.cpf_cnpj_socio = p.cpf_cnpj
-          AND UPPER(TRIM(s.nome_socio_razao_social)) = p.nome
-          AND s.pessoa_id IS NULL
-    """)
+    pessoas = (
+        pessoas
+        .with_columns(nome_canonico('nome').alias('nome'))
+        .with_columns(slug().alias('slug'))
+        .select(['id', 'cpf_cnpj', 'nome', 'slug'])
+    )
+    print(f"  {pessoas.height:,} pessoas únicas")
+
+    print("Inserindo em pessoas_new (COPY)...")
+    copiar_fluxo(
+        cur,
+        f'COPY "{SCHEMA}".pessoas_new (id, cpf_cnpj, nome, slug) FROM STDIN WITH (FORMAT CSV)',
+        csv_de_dataframe(pessoas),
+    )
     conn.commit()
-    print(f"  {cur.rowcount:,} vínculos atualizados")
+    print(f"  {pessoas.height:,} linhas inseridas em pessoas_new")
+    del pessoas
 
     # Índices em _new antes do swap
     print("Criando índices em pessoas_new...")
@@ -7,6 +7,9 @@ Estratégia zero-downtime: escreve em pessoas_consolidado_new, swap atômico ao
 import os, sys, time, pathlib
 import psycopg2
 from dotenv import load_dotenv
+from bulk_load import configuracao_de_carga, criar_tabela_de_carga, finalizar_tabela
+import incremental
+from indices import construir_indices
 
 load_dotenv(os.path.join(pathlib.Path().resolve(), ".env"))
 DSN    = f"dbname={os.getenv('DB_NAME')} user={os.getenv('DB_USER')} host={os.getenv('DB_HOST')} port={os.getenv('DB_PORT')} password={os.getenv('DB_PASSWORD')}"
@@ -23,37 +26,13 @@ if sc_count < 1_000_000:
     print("ERRO: socios_consolidado parece vazio. Rode build_socios_consolidado.py antes.", flush=True)
     sys.exit(1)
 
-# Cria _new
-print("Criando pessoas_consolidado_new...", flush=True)
-cur.execute(f'DROP TABLE IF EXISTS "{SCHEMA}"."pessoas_consolidado_new" CASCADE')
-cur.execute(f"""
-CREATE TABLE "{SCHEMA}"."pessoas_consolidado_new" (
-    id                  UUID        PRIMARY KEY,
-    cpf_cnpj            TEXT        NOT NULL,
-    nome                TEXT        NOT NULL,
-    slug                TEXT        NOT NULL UNIQUE,
-    total_empresas      INTEGER     DEFAULT 0,
-    ativas              INTEGER     DEFAULT 0,
-    inativas            INTEGER     DEFAULT 0,
-    score_inativas_pct  INTEGER     DEFAULT 0,
-    ano_primeira_entrada INTEGER,
-    anos_experiencia    INTEGER,
-    estados_count       INTEGER     DEFAULT 0,
-    cnaes_count         INTEGER     DEFAULT 0,
-    updated_at          TIMESTAMP   DEFAULT NOW()
-)
-""")
-conn.commit()
-
-print("Populando pessoas_consolidado_new (agregação via SQL)...", flush=True)
-t0 = time.time()
-
-cur.execute(f"""
-INSERT INTO "{SCHEMA}"."pessoas_consolidado_new"
-    (id, cpf_cnpj, nome, slug,
+COLUNAS = """(id, cpf_cnpj, nome, slug,
      total_empresas, ativas, inativas, score_inativas_pct,
      ano_primeira_entrada, anos_experiencia,
-     estados_count, cnaes_count, updated_at)
+     estados_count, cnaes_count, updated_at)"""
+
+# Estatísticas por pessoa; '{filtro}' restringe as pessoas agregadas
+AGREGACAO = f"""
 SELECT
     p.id,
     p.cpf_cnpj,
@@ -92,25 +71,72 @@ SELECT
     NOW()
 FROM "{SCHEMA}".pessoas p
 JOIN "{SCHEMA}".socios_consolidado sc
-  ON sc.cpf_cnpj_socio = p.cpf_cnpj
- AND UPPER(TRIM(sc.nome_socio_razao_social)) = p.nome
+  ON sc.pessoa_id = p.id
+WHERE {{filtro}}
 GROUP BY p.id, p.cpf_cnpj, p.nome, p.slug
-""")
+"""
+
+# LOAD_MODE=incremental: recalcula só as pessoas de _pessoas_alteradas, anotadas por
+# build_socios_consolidado.py (ver incremental.py)
+if incremental.ATIVO:
+    t0 = time.time()
+    alteradas = f'SELECT id FROM "{SCHEMA}"."{incremental.PESSOAS_ALTERADAS}"'
+    cur.execute(f'DELETE FROM "{SCHEMA}".pessoas_consolidado WHERE id IN ({alteradas})')
+    apagadas = cur.rowcount
+    cur.execute(f'INSERT INTO "{SCHEMA}".pessoas_consolidado {COLUNAS}'
+                + AGREGACAO.replace('{filtro}', f'p.id IN ({alteradas})'))
+    inseridas = cur.rowcount
+    conn.commit()
+    cur.execute(f'ANALYZE "{SCHEMA}".pessoas_consolidado')
+    conn.commit()
+    print(f"pessoas_consolidado (incremental): -{apagadas:,} +{inseridas:,} em {round(time.time()-t0)}s", flush=True)
+    cur.close()
+    conn.close()
+    sys.exit(0)
+
+# Cria _new (UNLOGGED e sem autovacuum durante a carga, ver bulk_load.py)
+print("Criando pessoas_consolidado_new...", flush=True)
+cur.execute(f'DROP TABLE IF EXISTS "{SCHEMA}"."pessoas_consolidado_new" CASCADE')
+criar_tabela_de_carga(cur, SCHEMA, 'pessoas_consolidado_new', """(
+    id                  UUID        PRIMARY KEY,
+    cpf_cnpj            TEXT        NOT NULL,
+    nome                TEXT        NOT NULL,
+    slug                TEXT        NOT NULL UNIQUE,
+    total_empresas      INTEGER     DEFAULT 0,
+    ativas              INTEGER     DEFAULT 0,
+    inativas            INTEGER     DEFAULT 0,
+    score_inativas_pct  INTEGER     DEFAULT 0,
+    ano_primeira_entrada INTEGER,
+    anos_experiencia    INTEGER,
+    estados_count       INTEGER     DEFAULT 0,
+    cnaes_count         INTEGER     DEFAULT 0,
+    updated_at          TIMESTAMP   DEFAULT NOW()
+)""")
+conn.commit()
+
+print("Populando pessoas_consolidado_new (agregação via SQL)...", flush=True)
+t0 = time.time()
+
+cur.execute(f"""
+INSERT INTO "{SCHEMA}"."pessoas_consolidado_new" {COLUNAS}
+""" + AGREGACAO.replace('{filtro}', 'TRUE'))
 conn.commit()
 
 cur.execute(f'SELECT COUNT(*) FROM "{SCHEMA}".pessoas_consolidado_new')
 total = cur.fetchone()[0]
 print(f"  {total:,} pessoas inseridas em {round(time.time()-t0)}s", flush=True)
 
-# Índices em _new
+# LOGGED + VACUUM (FREEZE, ANALYZE) antes dos índices
+with configuracao_de_carga(conn):
+    finalizar_tabela(conn, SCHEMA, 'pessoas_consolidado_new')
+
+# Índices em _new, em paralelo (ver indices.py)
 print("Criando índices...", flush=True)
-for sql in [
-    f'CREATE INDEX idx_pc_new_cpf_cnpj ON "{SCHEMA}".pessoas_consolidado_new (cpf_cnpj)',
-    f'CREATE INDEX idx_pc_new_slug     ON "{SCHEMA}".pessoas_consolidado_new (slug)',
-    f'CREATE INDEX idx_pc_new_score    ON "{SCHEMA}".pessoas_consolidado_new (score_inativas_pct)',
-]:
-    cur.execute(sql)
-conn.commit()
+construir_indices(DSN, SCHEMA, 'pessoas_consolidado', [
+    f'CREATE INDEX IF NOT EXISTS idx_pc_new_cpf_cnpj ON "{SCHEMA}".pessoas_consolidado_new USING btree (cpf_cnpj)',
+    f'CREATE INDEX IF NOT EXISTS idx_pc_new_slug ON "{SCHEMA}".pessoas_consolidado_new USING btree (slug)',
+    f'CREATE INDEX IF NOT EXISTS idx_pc_new_score ON "{SCHEMA}".pessoas_consolidado_new USING btree (score_inativas_pct)',
+])
 
 with conn.cursor() as c:
     c.execute(f'ANALYZE "{SCHEMA}"."pessoas_consolidado_new"')
@@ -1,19 +1,44 @@
 """
 build_socios_consolidado.py
-Cria dados_rfb.socios_consolidado: socios + dados da empresa (via cnpj_consolidado MATRIZ).
+Cria dados_rfb.socios_consolidado: socios + dados da empresa (via empresa_matriz, uma
+linha por cnpj_basico com os dados da matriz; ver empresa_matriz.py).
 
 Estratégia zero-downtime: escreve em socios_consolidado_new, swap atômico ao final.
+
+socios_consolidado_new é montada por faixas de cnpj_basico em SOCIOS_WORKERS
+conexões (ver faixas.py), com SOCIOS_BUILD_MODE:
+  postgres  (padrão) INSERT ... SELECT por faixa: os dados não saem do servidor
+  polars    cada faixa de socios e de empresa_matriz é lida por COPY TO, juntada
+            no Polars (os ids de pessoas vêm de um Parquet lido em modo streaming) e volta
+            por COPY; útil quando o banco é o gargalo
+
+Com AGUARDAR_INDICES=1 (pipeline_full.sh) roda junto com consolidar_fast.py: espera
+só os índices de consolidado_sql.DEPENDENCIAS_DAS_ETAPAS e lê empresa_matriz_new
+enquanto os GIN de cnpj_consolidado ainda estão sendo construídos. O swap de
+consolidar_fast.py espera esta leitura terminar.
 """
-import os, sys, time, pathlib
-from io import StringIO
-import csv
+import os, sys, time, pathlib, tempfile
+import polars as pl
 import psycopg2
 from dotenv import load_dotenv
+from bulk_load import configuracao_de_carga, criar_tabela_de_carga, finalizar_tabela
+from faixas import ExecutorDeFaixas, faixas_agrupadas, filtro_de_faixa
+from pg_copy import copia_de_saida, copiar_fluxo, csv_de_dataframe, tipos_da_consulta
+import empresa_matriz
+import incremental
+from consolidado_sql import DEPENDENCIAS_DAS_ETAPAS
+from indices import aguardar_indices, construir_indices
 
 load_dotenv(os.path.join(pathlib.Path().resolve(), ".env"))
 DSN    = f"dbname={os.getenv('DB_NAME')} user={os.getenv('DB_USER')} host={os.getenv('DB_HOST')} port={os.getenv('DB_PORT')} password={os.getenv('DB_PASSWORD')}"
 SCHEMA = os.getenv("DB_SCHEMA", "dados_rfb")
-CHUNK  = 500_000
+AGUARDAR_INDICES = os.getenv("AGUARDAR_INDICES", "0") == "1"
+SOCIOS_BUILD_MODE = os.getenv("SOCIOS_BUILD_MODE", "postgres").lower()
+SOCIOS_WORKERS    = int(os.getenv("SOCIOS_WORKERS", "4"))
+SOCIOS_FAIXAS     = int(os.getenv("SOCIOS_FAIXAS", "16"))
+if SOCIOS_BUILD_MODE not in ("postgres", "polars"):
+    print(f"ERRO: SOCIOS_BUILD_MODE inválido: {SOCIOS_BUILD_MODE} (use postgres ou polars).", flush=True)
+    sys.exit(1)
 
 conn = psycopg2.connect(DSN)
 cur  = conn.cursor()
@@ -26,18 +51,84 @@ if socios_count < 1_000_000:
     print("ERRO: socios parece vazio ou incompleto. Abortando.", flush=True)
     sys.exit(1)
 
-cur.execute(f'SELECT COUNT(*) FROM "{SCHEMA}".cnpj_consolidado')
-cc_count = cur.fetchone()[0]
-print(f"cnpj_consolidado: {cc_count:,} linhas", flush=True)
+# Origem dos dados da matriz. As faixas são lidas por várias conexões, então
+# conn2 segura até o fim da carga a trava de leitura de empresa_matriz (ver
+# empresa_matriz.reservar_leitura): o swap de consolidar_fast.py espera, e os
+# CREATE INDEX não são bloqueados.
+conn2 = psycopg2.connect(DSN)
+conn2.autocommit = True
+ORIGEM = empresa_matriz.TABELA
+if AGUARDAR_INDICES and not incremental.ATIVO:
+    for tarefa, nomes in DEPENDENCIAS_DAS_ETAPAS['build_socios_consolidado'].items():
+        aguardar_indices(DSN, SCHEMA, tarefa, nomes)
+    with conn2.cursor() as c:
+        empresa_matriz.reservar_leitura(c)
+        c.execute("SELECT to_regclass(%s)", (f'"{SCHEMA}"."{empresa_matriz.NOVA}"',))
+        # Sem a _new o swap já foi feito: empresa_matriz tem os dados novos
+        if c.fetchone()[0] is not None:
+            ORIGEM = empresa_matriz.NOVA
+
+with conn2.cursor() as c:
+    c.execute("SELECT to_regclass(%s)", (f'"{SCHEMA}"."{ORIGEM}"',))
+    cc_count = 0
+    if c.fetchone()[0] is not None:
+        c.execute(f'SELECT COUNT(*) FROM "{SCHEMA}"."{ORIGEM}"')
+        cc_count = c.fetchone()[0]
+print(f"{ORIGEM}: {cc_count:,} linhas", flush=True)
 if cc_count < 1_000_000:
-    print("ERRO: cnpj_consolidado parece vazio. Rode consolidar.py antes. Abortando.", flush=True)
+    print(f"ERRO: {ORIGEM} parece vazia. Rode consolidar_fast.py antes. Abortando.", flush=True)
     sys.exit(1)
 
-# Cria _new (sem índices para inserção rápida)
+# Colunas de socios_consolidado: as de socios, pessoa_id e as da matriz
+COLUNAS_DE_SOCIOS = [
+    'cnpj_basico', 'identificador_socio', 'nome_socio_razao_social', 'cpf_cnpj_socio',
+    'qualificacao_socio', 'data_entrada_sociedade', 'pais', 'faixa_etaria',
+]
+COLUNAS_DA_MATRIZ = [
+    'razao_social', 'situacao_cadastral', 'data_situacao_cadastral', 'data_inicio_atividade',
+    'cnae_fiscal_principal', 'desc_cnae_principal', 'uf', 'nome_municipio', 'porte_empresa', 'capital_social',
+]
+COLUNAS = COLUNAS_DE_SOCIOS + ['pessoa_id'] + COLUNAS_DA_MATRIZ
+
+# socios + pessoa + dados da matriz; '{filtro}' restringe as linhas de socios.
+# socios.pessoa_id já vem da carga (pessoa_id.py): o join só confirma que a pessoa existe
+SELECT_SOCIOS = f"""
+    SELECT
+        {', '.join(f's.{col}' for col in COLUNAS_DE_SOCIOS)},
+        p.id AS pessoa_id,
+        {', '.join(f'c.{col}' for col in COLUNAS_DA_MATRIZ)}
+    FROM "{SCHEMA}".socios s
+    LEFT JOIN "{SCHEMA}".pessoas p
+        ON p.id = s.pessoa_id
+    LEFT JOIN "{SCHEMA}"."{ORIGEM}" c
+        ON c.cnpj_basico = s.cnpj_basico
+    WHERE {{filtro}}
+"""
+
+# LOAD_MODE=incremental: refaz só as linhas dos cnpj_basico alterados (ver incremental.py),
+# anotando em _pessoas_alteradas as pessoas tocadas antes e depois da troca
+if incremental.ATIVO:
+    t0 = time.time()
+    incremental.registrar_pessoas(cur, SCHEMA)
+    cur.execute(f'DELETE FROM "{SCHEMA}".socios_consolidado WHERE {incremental.filtro_alterados(SCHEMA)}')
+    apagadas = cur.rowcount
+    cur.execute(f'INSERT INTO "{SCHEMA}".socios_consolidado '
+                + SELECT_SOCIOS.replace('{filtro}', incremental.filtro_alterados(SCHEMA, 's.cnpj_basico')))
+    inseridas = cur.rowcount
+    incremental.registrar_pessoas(cur, SCHEMA)
+    conn.commit()
+    cur.execute(f'ANALYZE "{SCHEMA}".socios_consolidado')
+    conn.commit()
+    print(f"socios_consolidado (incremental): -{apagadas:,} +{inseridas:,} em {round(time.time()-t0)}s", flush=True)
+    cur.close()
+    conn.close()
+    conn2.close()
+    sys.exit(0)
+
+# Cria _new (sem índices para inserção rápida; UNLOGGED e sem autovacuum, ver bulk_load.py)
 print("Criando socios_consolidado_new...", flush=True)
 cur.execute(f'DROP TABLE IF EXISTS "{SCHEMA}"."socios_consolidado_new" CASCADE')
-cur.execute(f"""
-CREATE TABLE "{SCHEMA}"."socios_consolidado_new" (
+criar_tabela_de_carga(cur, SCHEMA, 'socios_consolidado_new', """(
     cnpj_basico                      VARCHAR(8),
     identificador_socio              VARCHAR(1),
     nome_socio_razao_social          TEXT,
@@ -57,85 +148,114 @@ CREATE TABLE "{SCHEMA}"."socios_consolidado_new" (
     nome_municipio                   TEXT,
     porte_empresa                    VARCHAR(2),
     capital_social                   NUMERIC
-)
-""")
+)""")
 conn.commit()
 
-print("Populando socios_consolidado_new em chunks...", flush=True)
-t0 = time.time()
-total = 0
 
-cur.execute(f'SELECT COUNT(*) FROM "{SCHEMA}".socios')
-total_socios = cur.fetchone()[0]
+def preparar_conexao(c):
+    with c.cursor() as cur:
+        cur.execute("SET work_mem = '512MB';")
+    c.commit()
 
-conn2 = psycopg2.connect(DSN)
-cur2  = conn2.cursor("socios_stream")
-cur2.itersize = CHUNK
 
-cur2.execute(f"""
-    SELECT
-        s.cnpj_basico,
-        s.identificador_socio,
-        s.nome_socio_razao_social,
-        s.cpf_cnpj_socio,
-        s.qualificacao_socio,
-        s.data_entrada_sociedade,
-        s.pais,
-        s.faixa_etaria,
-        p.id AS pessoa_id,
-        c.razao_social,
-        c.situacao_cadastral,
-        c.data_situacao_cadastral,
-        c.data_inicio_atividade,
-        c.cnae_fiscal_principal,
-        c.desc_cnae_principal,
-        c.uf,
-        c.nome_municipio,
-        c.porte_empresa,
-        c.capital_social
-    FROM "{SCHEMA}".socios s
-    LEFT JOIN "{SCHEMA}".pessoas p
-        ON p.nome = s.nome_socio_razao_social
-        AND p.cpf_cnpj = s.cpf_cnpj_socio
-    LEFT JOIN LATERAL (
-        SELECT razao_social, situacao_cadastral, data_situacao_cadastral,
-               data_inicio_atividade, cnae_fiscal_principal, desc_cnae_principal,
-               uf, nome_municipio, porte_empresa, capital_social
-        FROM "{SCHEMA}".cnpj_consolidado
-        WHERE cnpj_basico = s.cnpj_basico
-          AND identificador_mf = '1'
-        LIMIT 1
-    ) c ON true
-""")
-
-chunk_num = 0
-while True:
-    rows = cur2.fetchmany(CHUNK)
-    if not rows:
-        break
-    chunk_num += 1
-    buf = StringIO()
-    w = csv.writer(buf)
-    for row in rows:
-        w.writerow(['' if v is None else v for v in row])
-    buf.seek(0)
-    cur.copy_expert(
-        f'COPY "{SCHEMA}"."socios_consolidado_new" FROM STDIN WITH (FORMAT CSV, NULL \'\')',
-        buf
-    )
+def com_parametros(conn, sql, parametros):
+    """`sql` com os parâmetros já no texto (COPY TO e tipos_da_consulta não recebem parâmetros)."""
+    with conn.cursor() as c:
+        return c.mogrify(sql, parametros).decode()
+
+
+def ler(conn, query):
+    """DataFrame com o resultado de `query`, via COPY TO STDOUT direto para o parser do Polars."""
+    schema = tipos_da_consulta(conn, query)
+    with copia_de_saida(conn, query) as stream:
+        df = pl.read_csv(stream, has_header=False, schema=schema, raise_if_empty=False)
     conn.commit()
-    total += len(rows)
-    pct = round(total / total_socios * 100, 1)
-    print(f"  Chunk {chunk_num}: {total:,} / {total_socios:,} ({pct}%)  {round(time.time()-t0)}s", flush=True)
+    return df
+
+
+def gravar_pessoas(diretorio):
+    """
+    Grava os ids de pessoas (coluna pessoa_id) em Parquet, passando por um CSV
+    em disco: nenhuma das duas etapas põe a tabela inteira na memória.
+    """
+    query = f'SELECT id AS pessoa_id FROM "{SCHEMA}".pessoas'
+    csv_path = os.path.join(diretorio, 'pessoas.csv')
+    parquet_path = os.path.join(diretorio, 'pessoas.parquet')
+    c = psycopg2.connect(DSN)
+    try:
+        schema = tipos_da_consulta(c, query)
+        with open(csv_path, 'wb') as f, c.cursor() as cc:
+            cc.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, ENCODING 'UTF8')", f)
+    finally:
+        c.close()
+    pl.scan_csv(csv_path, has_header=False, schema=schema).sink_parquet(parquet_path)
+    os.remove(csv_path)
+    return parquet_path
+
+
+def montar_faixa_polars(pessoas_path):
+    """Tarefa do ExecutorDeFaixas: junta a faixa no Polars e grava por COPY na mesma transação."""
+    pessoas = pl.scan_parquet(pessoas_path)
+
+    def montar(conn, faixa, inicio, fim):
+        filtro, parametros = filtro_de_faixa('cnpj_basico', inicio, fim)
+        socios = ler(conn, com_parametros(
+            conn, f'SELECT {", ".join(COLUNAS_DE_SOCIOS)}, pessoa_id AS pessoa_socio '
+                  f'FROM "{SCHEMA}".socios WHERE {filtro}', parametros))
+        matriz = ler(conn, com_parametros(
+            conn, f'SELECT cnpj_basico, {", ".join(COLUNAS_DA_MATRIZ)} FROM "{SCHEMA}"."{ORIGEM}" WHERE {filtro}',
+            parametros))
+        df = (
+            socios.lazy()
+            # Como o LEFT JOIN de SELECT_SOCIOS: pessoa_id nulo se a pessoa não existir
+            .join(pessoas, left_on='pessoa_socio', right_on='pessoa_id', how='left', coalesce=False)
+            .join(matriz.lazy(), on='cnpj_basico', how='left')
+            .select(COLUNAS)
+            .collect(engine='streaming')
+        )
+        with conn.cursor() as c:
+            copiar_fluxo(
+                c,
+                f'COPY "{SCHEMA}"."socios_consolidado_new" ({", ".join(COLUNAS)}) '
+                f"FROM STDIN WITH (FORMAT CSV, NULL '')",
+                csv_de_dataframe(df),
+            )
+        return df.height
 
-cur2.close()
+    return montar
+
+
+INSERT_SQL = f'INSERT INTO "{SCHEMA}"."socios_consolidado_new" ({", ".join(COLUNAS)}) ' + SELECT_SOCIOS
+
+
+def montar_sql(inicio, fim):
+    filtro, parametros = filtro_de_faixa('s.cnpj_basico', inicio, fim)
+    return INSERT_SQL.replace('{filtro}', filtro), parametros
+
+
+print(f"Populando socios_consolidado_new em {SOCIOS_FAIXAS} faixas (modo {SOCIOS_BUILD_MODE})...", flush=True)
+t0 = time.time()
+executor = ExecutorDeFaixas(DSN, SCHEMA, 'socios_consolidado', n_conexoes=SOCIOS_WORKERS,
+                            preparar=preparar_conexao)
+executor.iniciar(faixas_agrupadas(SOCIOS_FAIXAS))
+if SOCIOS_BUILD_MODE == 'polars':
+    with tempfile.TemporaryDirectory() as diretorio:
+        total = executor.executar_tarefa(montar_faixa_polars(gravar_pessoas(diretorio)))
+else:
+    total = executor.executar(montar_sql)
+executor.limpar()
+
+# Fim da leitura de empresa_matriz: libera o swap de consolidar_fast.py
 conn2.close()
 
-# Índices em _new
+# LOGGED + VACUUM (FREEZE, ANALYZE) antes dos índices
+print("\nFinalizando carga de socios_consolidado_new...", flush=True)
+with configuracao_de_carga(conn):
+    finalizar_tabela(conn, SCHEMA, 'socios_consolidado_new')
+
+# Índices em _new, em paralelo (ver indices.py)
 print("\nCriando índices em socios_consolidado_new...", flush=True)
-conn3 = psycopg2.connect(DSN)
-conn3.autocommit = True
-for name, col, method in [
+INDICES = [
     ("idx_sc_new_cnpj_basico",  "cnpj_basico",                          "btree"),
     ("idx_sc_new_cpf_cnpj",     "cpf_cnpj_socio",                       "btree"),
     ("idx_sc_new_pessoa_id",    "pessoa_id",                             "btree"),
@@ -143,13 +263,11 @@ for name, col, method in [
     ("idx_sc_new_uf",           "uf",                                    "btree"),
     ("idx_sc_new_cnpj_sit",     "cnpj_basico, situacao_cadastral",       "btree"),
     ("idx_sc_new_nome_trgm",    "nome_socio_razao_social gin_trgm_ops",  "gin"),
-]:
-    t1 = time.time()
-    print(f"  {name}... ", end='', flush=True)
-    with conn3.cursor() as c:
-        c.execute(f'CREATE INDEX {name} ON "{SCHEMA}"."socios_consolidado_new" USING {method} ({col})')
-    print(f"({round(time.time()-t1)}s)", flush=True)
-conn3.close()
+]
+construir_indices(DSN, SCHEMA, 'socios_consolidado', [
+    f'CREATE INDEX IF NOT EXISTS {name} ON "{SCHEMA}"."socios_consolidado_new" USING {method} ({col})'
+    for name, col, method in INDICES
+])
 
 with conn.cursor() as c:
     c.execute(f'ANALYZE "{SCHEMA}"."socios_consolidado_new"')
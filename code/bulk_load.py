@@ -0,0 +1,95 @@
+"""
+Modo de carga em massa das tabelas de staging e consolidadas.
+
+Durante a carga as tabelas ficam UNLOGGED e sem autovacuum (sem WAL e sem o
+autovacuum disputando com os INSERT/COPY); a sessão recebe valores maiores de
+maintenance_work_mem e afins. Ao final `finalizar_tabela` volta a tabela para
+LOGGED e roda VACUUM (FREEZE, ANALYZE) antes dos índices e do swap, para os
+leitores de produção não pegarem a onda de vacuum logo depois da troca.
+
+BULK_LOAD=0 desliga o modo: as funções criam tabelas comuns e não mexem em nada.
+"""
+import os
+from contextlib import contextmanager
+
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, TRANSACTION_STATUS_INTRANS
+
+ATIVO = os.getenv('BULK_LOAD', '1') == '1'
+
+# Parâmetros de sessão usados durante a carga, a criação de índices e o VACUUM
+CONFIGURACAO = {
+    'maintenance_work_mem': os.getenv('BULK_MAINTENANCE_WORK_MEM', '2GB'),
+    'max_parallel_maintenance_workers': os.getenv('BULK_MAINTENANCE_WORKERS', '4'),
+    'synchronous_commit': 'off',
+}
+
+_SEM_AUTOVACUUM = 'autovacuum_enabled = false, toast.autovacuum_enabled = false'
+
+
+def criar_tabela_de_carga(cur, schema, tabela, definicao):
+    """
+    CREATE TABLE "schema"."tabela" <definicao>, UNLOGGED e sem autovacuum.
+    `definicao` é a lista de colunas entre parênteses, ex.: '(LIKE x INCLUDING DEFAULTS)'.
+    """
+    if ATIVO:
+        cur.execute(f'CREATE UNLOGGED TABLE "{schema}"."{tabela}" {definicao} WITH ({_SEM_AUTOVACUUM})')
+    else:
+        cur.execute(f'CREATE TABLE "{schema}"."{tabela}" {definicao}')
+
+
+def preparar_tabela(cur, schema, tabela):
+    """Coloca uma tabela já existente (e vazia, ex.: recém truncada) no modo de carga."""
+    if ATIVO:
+        cur.execute(f'ALTER TABLE "{schema}"."{tabela}" SET UNLOGGED')
+        cur.execute(f'ALTER TABLE "{schema}"."{tabela}" SET ({_SEM_AUTOVACUUM})')
+
+
+def finalizar_tabela(conn, schema, tabela):
+    """
+    Volta a tabela para LOGGED, reativa o autovacuum e roda VACUUM (FREEZE, ANALYZE).
+    Chamar depois da carga e antes dos índices: o SET LOGGED reescreve a tabela e
+    reconstruiria qualquer índice que já existisse. Com BULK_LOAD=0 só roda ANALYZE.
+    """
+    if not ATIVO:
+        with conn.cursor() as c:
+            c.execute(f'ANALYZE "{schema}"."{tabela}"')
+        conn.commit()
+        return
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True  # VACUUM não roda dentro de transação
+    try:
+        with conn.cursor() as c:
+            c.execute(f'ALTER TABLE "{schema}"."{tabela}" SET LOGGED')
+            c.execute(f'ALTER TABLE "{schema}"."{tabela}" RESET (autovacuum_enabled, toast.autovacuum_enabled)')
+            c.execute(f'VACUUM (FREEZE, ANALYZE) "{schema}"."{tabela}"')
+    finally:
+        conn.autocommit = autocommit
+
+
+@contextmanager
+def configuracao_de_carga(conn):
+    """Aplica CONFIGURACAO na sessão de `conn` e restaura os valores anteriores ao sair."""
+    if not ATIVO:
+        yield
+        return
+    anteriores = {}
+    with conn.cursor() as c:
+        for nome, valor in CONFIGURACAO.items():
+            c.execute('SELECT current_setting(%s), set_config(%s, %s, false)', (nome, nome, valor))
+            anteriores[nome] = c.fetchone()[0]
+    if not conn.autocommit:
+        conn.commit()
+    try:
+        yield
+    finally:
+        if not conn.closed:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_INERROR:
+                conn.rollback()
+            with conn.cursor() as c:
+                for nome, valor in anteriores.items():
+                    c.execute('SELECT set_config(%s, %s, false)', (nome, valor))
+            # Transação em aberto fica com o chamador; sem ela, grava a restauração
+            if not conn.autocommit and status != TRANSACTION_STATUS_INTRANS:
+                conn.commit()
@@ -0,0 +1,189 @@
+"""
+SQL de montagem de cnpj_consolidado, compartilhado por consolidar_fast.py
+(tabela única) e consolidar_particionado.py (uma partição por faixa de
+cnpj_basico).
+"""
+
+FINAL_COLS = [
+    'cnpj', 'cnpj_basico', 'razao_social', 'nome_fantasia',
+    'situacao_cadastral', 'data_situacao_cadastral', 'motivo_situacao_cadastral', 'data_inicio_atividade',
+    'cnae_fiscal_principal', 'desc_cnae_principal',
+    'natureza_juridica', 'desc_natureza_juridica',
+    'capital_social', 'porte_empresa',
+    'opcao_pelo_simples', 'data_opcao_simples',
+    'opcao_mei', 'data_opcao_mei',
+    'identificador_mf',
+    'logradouro', 'numero', 'complemento', 'bairro', 'cep',
+    'uf', 'municipio', 'nome_municipio',
+    'ddd_1', 'telefone_1', 'correio_eletronico',
+    'busca',
+]
+
+# Coluna de busca: razão social + nome fantasia sem acentos, em maiúsculas e com
+# os espaços colapsados. É calculada uma vez na carga (no Polars, ou com
+# BUSCA_SQL nos INSERT ... SELECT) e os índices de texto ficam só sobre ela e
+# sobre busca_tsv, gerada a partir dela pelo servidor. As consultas devem
+# normalizar o termo do mesmo jeito: upper(immutable_unaccent(termo)).
+COLUNAS_DE_BUSCA = {
+    'busca': 'TEXT',
+    'busca_tsv': "tsvector GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, COALESCE(busca, ''::text))) STORED",
+}
+
+BUSCA_SQL = ("upper(btrim(regexp_replace(immutable_unaccent("
+             "COALESCE(emp.razao_social, '') || ' ' || COALESCE(es.nome_fantasia, '')), "
+             "'[[:space:]]+', ' ', 'g')))")
+
+# Registro dos índices de cnpj_consolidado, usado por todos os construtores:
+# (nome, UNIQUE?, método e expressão). Nomes repetidos de uma mesma definição
+# ficam aqui para que os DROP os alcancem, mas só um de cada é construído
+# (ver equivalentes). GIN levam 20-60min cada na tabela inteira.
+INDICES = [
+    # --- btree simples (rápidos) ---
+    ('cnpj_consolidado_cnpj', True, 'btree (cnpj)'),
+    ('cnpj_consolidado_basico', False, 'btree (cnpj_basico)'),
+    ('cnpj_consolidado_sit', False, 'btree (situacao_cadastral)'),
+    ('cnpj_consolidado_uf', False, 'btree (uf)'),
+    ('cnpj_consolidado_uf_mun', False, 'btree (uf, nome_municipio)'),
+    ('cnpj_consolidado_razao', False, 'btree (razao_social)'),
+    ('cnpj_consolidado_endereco', False, 'btree (cep, logradouro, numero)'),
+    ('cnpj_consolidado_email', False, 'btree (correio_eletronico) WHERE (correio_eletronico IS NOT NULL)'),
+    ('idx_cnpj_consolidado_cnpj_basico', False, 'btree (cnpj_basico)'),
+    ('idx_consolidado_cep', False, 'btree (cep)'),
+    ('idx_consolidado_cnae', False, 'btree (cnae_fiscal_principal)'),
+    ('idx_consolidado_email', False, 'btree (correio_eletronico)'),
+    ('idx_razao_social_btree', False, 'btree (razao_social)'),
+    # --- GIN sobre as colunas de busca (lentos) ---
+    ('cnpj_consolidado_busca_trgm', False, 'gin (busca gin_trgm_ops)'),
+    ('cnpj_consolidado_busca_tsv', False, 'gin (busca_tsv)'),
+    ('cnpj_consolidado_busca_tsv_ativa', False, "gin (busca_tsv) WHERE ((situacao_cadastral)::text = '02'::text)"),
+]
+
+# Índices de que cada etapa seguinte precisa para começar: {etapa: {tarefa: [nomes]}},
+# com a tarefa de indices.TABELA_PROGRESSO. Com AGUARDAR_INDICES=1 a etapa lê as
+# tabelas _new assim que eles ficam prontos, enquanto os GIN de cnpj_consolidado
+# continuam (ver indices.aguardar_indices); o swap de consolidar_fast.py espera a
+# leitura terminar. build_pessoas_consolidado.py só depende de socios_consolidado.
+DEPENDENCIAS_DAS_ETAPAS = {
+    # Hash join com empresa_matriz_new (ver empresa_matriz.py)
+    'build_socios_consolidado': {'empresa_matriz': ['empresa_matriz_new_cnpj_basico']},
+}
+
+# Índices de texto substituídos pelos de busca: só saem das tabelas antigas
+INDICES_SUBSTITUIDOS = [
+    'cnpj_consolidado_razao_trgm', 'cnpj_consolidado_fantasia_trgm', 'idx_cnpj_consolidado_razao_trgm',
+    'idx_fantasia_trgm', 'idx_fantasia_unaccent_trgm', 'idx_razao_trgm', 'idx_razao_unaccent_trgm',
+    'idx_cnpj_consolidado_razao', 'idx_fts_simple', 'idx_fts_simple_ativa',
+]
+
+
+def nomes_dos_indices():
+    """Todos os nomes a remover antes de recriar os índices: INDICES e INDICES_SUBSTITUIDOS."""
+    return [nome for nome, _, _ in INDICES] + INDICES_SUBSTITUIDOS
+
+
+def colunas_de_busca_faltando(cur, schema, tabela='cnpj_consolidado'):
+    """Nomes de COLUNAS_DE_BUSCA que `tabela` ainda não tem (tabelas de antes das colunas de busca)."""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+         WHERE table_schema = %s AND table_name = %s
+    """, (schema, tabela))
+    existentes = {r[0] for r in cur.fetchall()}
+    return [nome for nome in COLUNAS_DE_BUSCA if nome not in existentes]
+
+
+def definicao_da_tabela(cur, schema, tabela='cnpj_consolidado'):
+    """
+    Definição '(LIKE ...)' para criar uma tabela nova a partir de `tabela`,
+    acrescentando as COLUNAS_DE_BUSCA que ela ainda não tiver.
+    """
+    extras = ''.join(f', {nome} {COLUNAS_DE_BUSCA[nome]}' for nome in colunas_de_busca_faltando(cur, schema, tabela))
+    return f'(LIKE "{schema}"."{tabela}" INCLUDING DEFAULTS INCLUDING GENERATED{extras})'
+
+
+def sql_de_insercao(schema, tabela):
+    """
+    INSERT ... SELECT do JOIN de estabelecimento com empresa, simples e as
+    tabelas de códigos em "schema"."tabela". O trecho '{filtro}' deve ser
+    trocado pela condição sobre es.cnpj_basico (ver faixas.filtro_de_faixa).
+    """
+    col_list = ', '.join(f'"{c}"' for c in FINAL_COLS)
+    return f"""
+    INSERT INTO "{schema}"."{tabela}" ({col_list})
+    SELECT
+        es.cnpj_basico || es.cnpj_ordem || es.cnpj_dv        AS cnpj,
+        es.cnpj_basico,
+        emp.razao_social,
+        es.nome_fantasia,
+        es.situacao_cadastral,
+        es.data_situacao_cadastral,
+        es.motivo_situacao_cadastral,
+        es.data_inicio_atividade,
+        es.cnae_fiscal_principal,
+        c.descricao                                          AS desc_cnae_principal,
+        emp.natureza_juridica,
+        nj.descricao                                         AS desc_natureza_juridica,
+        emp.capital_social,
+        emp.porte_empresa,
+        si.opcao_pelo_simples,
+        si.data_opcao_simples,
+        si.opcao_mei,
+        si.data_opcao_mei,
+        es.identificador_matriz_filial                        AS identificador_mf,
+        es.logradouro,
+        es.numero,
+        es.complemento,
+        es.bairro,
+        es.cep,
+        es.uf,
+        es.municipio,
+        mu.descricao                                         AS nome_municipio,
+        es.ddd_1,
+        es.telefone_1,
+        es.correio_eletronico,
+        {BUSCA_SQL} AS busca
+    FROM "{schema}"."estabelecimento" es
+    LEFT JOIN "{schema}"."empresa" emp ON emp.cnpj_basico = es.cnpj_basico
+    LEFT JOIN "{schema}"."cnae"    c   ON c.codigo        = es.cnae_fiscal_principal
+    LEFT JOIN "{schema}"."natju"   nj  ON nj.codigo       = emp.natureza_juridica
+    LEFT JOIN "{schema}"."munic"   mu  ON mu.codigo       = es.municipio
+    LEFT JOIN "{schema}"."simples" si  ON si.cnpj_basico  = es.cnpj_basico
+    WHERE {{filtro}};
+"""
+
+
+def equivalentes():
+    """
+    {nome: nome do índice anterior de INDICES com a mesma definição} dos índices
+    repetidos na lista (mesmo método, expressão e predicado). Só o primeiro de
+    cada grupo é construído: os outros custariam o mesmo tempo e nunca seriam
+    escolhidos pelo planejador no lugar dele.
+    """
+    vistos, repetidos = {}, {}
+    for nome, unico, definicao in INDICES:
+        chave = (unico, ' '.join(definicao.split()))
+        if chave in vistos:
+            repetidos[nome] = vistos[chave]
+        else:
+            vistos[chave] = nome
+    return repetidos
+
+
+def ddl_dos_indices(schema, tabela, prefixo='', particionada=False):
+    """
+    CREATE INDEX de cada item de INDICES em "schema"."tabela", com `prefixo` no
+    nome, sem os repetidos (ver equivalentes). Em tabela particionada por
+    cnpj_basico o índice único precisa conter a chave de partição: vira
+    UNIQUE (cnpj, cnpj_basico), que é equivalente, pois cnpj começa por cnpj_basico.
+    """
+    repetidos = equivalentes()
+    ddls = []
+    for nome, unico, definicao in INDICES:
+        if nome in repetidos:
+            continue
+        if unico and particionada:
+            definicao = definicao.replace('(cnpj)', '(cnpj, cnpj_basico)')
+        ddls.append(
+            f'CREATE {"UNIQUE " if unico else ""}INDEX IF NOT EXISTS {prefixo}{nome} '
+            f'ON "{schema}"."{tabela}" USING {definicao}'
+        )
+    return ddls
@@ -2,9 +2,12 @@
 consolidar_fast.py — rebuild de cnpj_consolidado sem indexes durante o INSERT.
 
 Diferenças do consolidar.py original:
-- Dropa TODOS os 23 índices antes de inserir (inclui UNIQUE)
+- Dropa TODOS os índices do registro (consolidado_sql.INDICES) antes de inserir (inclui UNIQUE)
 - INSERT simples sem ON CONFLICT (sem índice único não há como verificar conflito)
-- Recria todos os índices ao final em ordem: btree primeiro, GIN depois
+- Monta empresa_matriz (uma linha por cnpj_basico, ver empresa_matriz.py) antes dos índices
+- Recria os índices ao final em várias conexões, GIN primeiro (ver indices.py); o índice de
+  que as etapas seguintes dependem (consolidado_sql.DEPENDENCIAS_DAS_ETAPAS) é o de
+  empresa_matriz_new, construído antes deles
 
 Resultado esperado: ~95% mais rápido na fase de inserção (15h → 30-60min).
 """
@@ -16,6 +19,13 @@ import time
 import psycopg2
 from dotenv import load_dotenv
 
+from bulk_load import configuracao_de_carga, criar_tabela_de_carga, finalizar_tabela
+from consolidado_sql import ddl_dos_indices, definicao_da_tabela, nomes_dos_indices, sql_de_insercao
+import empresa_matriz
+from faixas import ExecutorDeFaixas, faixas_de_prefixo, filtro_de_faixa
+from indices import construir_indices
+import incremental
+
 # ── env ──────────────────────────────────────────────────────────────────────
 current_path = pathlib.Path().resolve()
 dotenv_path = os.path.join(current_path, '.env')
@@ -33,35 +43,24 @@ db_schema = os.getenv('DB_SCHEMA')
 
 DSN = f"dbname={database} user={user} host={host} port={port} password={password}"
 
+# Conexões que inserem faixas em paralelo e tentativas por faixa
+CONSOLIDAR_WORKERS    = int(os.getenv('CONSOLIDAR_WORKERS', '4'))
+CONSOLIDAR_TENTATIVAS = int(os.getenv('CONSOLIDAR_TENTATIVAS', '3'))
+
 conn = psycopg2.connect(DSN)
 conn.autocommit = False
 
+# LOAD_MODE=incremental: só os cnpj_basico alterados na última carga (ver incremental.py)
+if incremental.ATIVO:
+    t0 = time.time()
+    apagadas, inseridas = incremental.atualizar_cnpj_consolidado(conn, db_schema)
+    print(f"cnpj_consolidado (incremental): -{apagadas:,} +{inseridas:,} em {round(time.time() - t0)}s", flush=True)
+    conn.close()
+    sys.exit(0)
+
 # ── 1. DROP todos os índices de cnpj_consolidado ──────────────────────────────
-DROP_INDEXES = [
-    "cnpj_consolidado_basico",
-    "cnpj_consolidado_cnpj",
-    "cnpj_consolidado_email",
-    "cnpj_consolidado_endereco",
-    "cnpj_consolidado_fantasia_trgm",
-    "cnpj_consolidado_razao",
-    "cnpj_consolidado_razao_trgm",
-    "cnpj_consolidado_sit",
-    "cnpj_consolidado_uf",
-    "cnpj_consolidado_uf_mun",
-    "idx_cnpj_consolidado_cnpj_basico",
-    "idx_cnpj_consolidado_razao",
-    "idx_cnpj_consolidado_razao_trgm",
-    "idx_consolidado_cep",
-    "idx_consolidado_cnae",
-    "idx_consolidado_email",
-    "idx_fantasia_trgm",
-    "idx_fantasia_unaccent_trgm",
-    "idx_fts_simple",
-    "idx_fts_simple_ativa",
-    "idx_razao_social_btree",
-    "idx_razao_trgm",
-    "idx_razao_unaccent_trgm",
-]
+# Todos os nomes do registro, inclusive os repetidos e os substituídos (ver consolidado_sql.py)
+DROP_INDEXES = nomes_dos_indices()
 
 print("=== FASE 1: Dropando índices ===", flush=True)
 with conn.cursor() as c:
@@ -72,12 +71,31 @@ conn.commit()
 print(f"  {len(DROP_INDEXES)} índices removidos.\n", flush=True)
 
 # ── 2. Staging: cria cnpj_consolidado_new (sem truncar a tabela ativa) ────────
-print("=== FASE 2: Criando staging cnpj_consolidado_new ===", flush=True)
+def preparar_conexao(c):
+    with c.cursor() as cur:
+        cur.execute("SET work_mem = '512MB';")
+    c.commit()
+
+executor = ExecutorDeFaixas(DSN, db_schema, 'cnpj_consolidado', n_conexoes=CONSOLIDAR_WORKERS,
+                            max_tentativas=CONSOLIDAR_TENTATIVAS, preparar=preparar_conexao)
+
 with conn.cursor() as c:
-    c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."cnpj_consolidado_new";')
-    c.execute(f'CREATE TABLE "{db_schema}"."cnpj_consolidado_new" (LIKE "{db_schema}"."cnpj_consolidado" INCLUDING DEFAULTS);')
+    c.execute("SELECT to_regclass(%s) IS NOT NULL", (f'"{db_schema}"."cnpj_consolidado_new"',))
+    staging_existe = c.fetchone()[0]
 conn.commit()
-print("  Staging criada. cnpj_consolidado segue ativa com dados antigos.\n", flush=True)
+
+if staging_existe and executor.tem_progresso():
+    # Execução anterior interrompida: mantém a staging e insere só as faixas pendentes
+    print("=== FASE 2: Retomando staging cnpj_consolidado_new existente ===\n", flush=True)
+else:
+    print("=== FASE 2: Criando staging cnpj_consolidado_new ===", flush=True)
+    with conn.cursor() as c:
+        c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."cnpj_consolidado_new";')
+        # UNLOGGED e sem autovacuum durante a carga (ver bulk_load.py)
+        criar_tabela_de_carga(c, db_schema, 'cnpj_consolidado_new', definicao_da_tabela(c, db_schema))
+    conn.commit()
+    executor.iniciar(faixas_de_prefixo())
+    print("  Staging criada. cnpj_consolidado segue ativa com dados antigos.\n", flush=True)
 
 # ── 3. Verifica índice de suporte em estabelecimento ─────────────────────────
 print("=== FASE 3: Verificando índice em estabelecimento ===", flush=True)
@@ -97,152 +115,61 @@ with conn.cursor() as c:
         print("  Índice criado.", flush=True)
     else:
         print(f"  OK: {idx[0]}", flush=True)
+print()
 
-with conn.cursor() as c:
-    c.execute("SET work_mem = '512MB';")
-conn.commit()
-print("  work_mem = 512MB\n", flush=True)
-
-# ── 4. INSERT em 100 faixas (sem ON CONFLICT) ─────────────────────────────────
-FINAL_COLS = [
-    'cnpj', 'cnpj_basico', 'razao_social', 'nome_fantasia',
-    'situacao_cadastral', 'data_situacao_cadastral', 'motivo_situacao_cadastral', 'data_inicio_atividade',
-    'cnae_fiscal_principal', 'desc_cnae_principal',
-    'natureza_juridica', 'desc_natureza_juridica',
-    'capital_social', 'porte_empresa',
-    'opcao_pelo_simples', 'data_opcao_simples',
-    'opcao_mei', 'data_opcao_mei',
-    'identificador_mf',
-    'logradouro', 'numero', 'complemento', 'bairro', 'cep',
-    'uf', 'municipio', 'nome_municipio',
-    'ddd_1', 'telefone_1', 'correio_eletronico',
-]
+# ── 4. INSERT em 100 faixas paralelas (sem ON CONFLICT) ───────────────────────
+INSERT_SQL = sql_de_insercao(db_schema, 'cnpj_consolidado_new')
 
-col_list = ', '.join(f'"{c}"' for c in FINAL_COLS)
+def montar_sql(inicio, fim):
+    # Limites >= / < usam o índice de estabelecimento.cnpj_basico (o LIKE 'NN%' não usava)
+    filtro, parametros = filtro_de_faixa('es.cnpj_basico', inicio, fim)
+    return INSERT_SQL.replace('{filtro}', filtro), parametros
 
-SELECT_SQL = f"""
-    SELECT
-        es.cnpj_basico || es.cnpj_ordem || es.cnpj_dv        AS cnpj,
-        es.cnpj_basico,
-        emp.razao_social,
-        es.nome_fantasia,
-        es.situacao_cadastral,
-        es.data_situacao_cadastral,
-        es.motivo_situacao_cadastral,
-        es.data_inicio_atividade,
-        es.cnae_fiscal_principal,
-        c.descricao                                          AS desc_cnae_principal,
-        emp.natureza_juridica,
-        nj.descricao                                         AS desc_natureza_juridica,
-        emp.capital_social,
-        emp.porte_empresa,
-        si.opcao_pelo_simples,
-        si.data_opcao_simples,
-        si.opcao_mei,
-        si.data_opcao_mei,
-        es.identificador_matriz_filial                        AS identificador_mf,
-        es.logradouro,
-        es.numero,
-        es.complemento,
-        es.bairro,
-        es.cep,
-        es.uf,
-        es.municipio,
-        mu.descricao                                         AS nome_municipio,
-        es.ddd_1,
-        es.telefone_1,
-        es.correio_eletronico
-    FROM "{db_schema}"."estabelecimento" es
-    LEFT JOIN "{db_schema}"."empresa" emp ON emp.cnpj_basico = es.cnpj_basico
-    LEFT JOIN "{db_schema}"."cnae"    c   ON c.codigo        = es.cnae_fiscal_principal
-    LEFT JOIN "{db_schema}"."natju"   nj  ON nj.codigo       = emp.natureza_juridica
-    LEFT JOIN "{db_schema}"."munic"   mu  ON mu.codigo       = es.municipio
-    LEFT JOIN "{db_schema}"."simples" si  ON si.cnpj_basico  = es.cnpj_basico
-    WHERE es.cnpj_basico LIKE '{{digit}}%'
-"""
-
-INSERT_SQL = f'INSERT INTO "{db_schema}"."cnpj_consolidado_new" ({col_list}) {SELECT_SQL};'
-
-print("=== FASE 4: Inserindo 100 faixas (sem índices) ===", flush=True)
-total_inserted = 0
+print("=== FASE 4: Inserindo 100 faixas (sem índices, work_mem = 512MB) ===", flush=True)
 start = time.time()
+executor.executar(montar_sql)
 
-for digit in range(100):
-    t0 = time.time()
-    digit_str = f"{digit:02d}"
-    print(f"  Faixa {digit_str}... ", end='', flush=True)
-    with conn.cursor() as c:
-        c.execute(INSERT_SQL.replace('{digit}', digit_str))
-        n = c.rowcount
-        conn.commit()
-    total_inserted += n
-    elapsed = round(time.time() - t0)
-    print(f"{n:,} inseridos ({elapsed}s) — total: {total_inserted:,}", flush=True)
+with conn.cursor() as c:
+    c.execute(f'SELECT COUNT(*) FROM "{db_schema}"."cnpj_consolidado_new";')
+    total_inserted = c.fetchone()[0]
+conn.commit()
 
 total_secs = round(time.time() - start)
 print(f"\n  TOTAL: {total_inserted:,} registros em {total_secs}s ({round(total_secs/60)}min)\n", flush=True)
 
-# ── 5. ANALYZE antes dos índices ──────────────────────────────────────────────
-print("=== FASE 5: ANALYZE ===", flush=True)
-with conn.cursor() as c:
-    c.execute(f'ANALYZE "{db_schema}"."cnpj_consolidado_new";')
-conn.commit()
-print("  Estatísticas atualizadas.\n", flush=True)
+# ── 5. LOGGED + VACUUM (FREEZE, ANALYZE) antes dos índices ────────────────────
+print("=== FASE 5: VACUUM (FREEZE, ANALYZE) ===", flush=True)
+with configuracao_de_carga(conn):
+    finalizar_tabela(conn, db_schema, 'cnpj_consolidado_new')
+print("  Tabela congelada e estatísticas atualizadas.\n", flush=True)
 
-# ── 6. Recriar TODOS os 23 índices ───────────────────────────────────────────
-# CREATE INDEX CONCURRENTLY requer autocommit = True
+# ── 6. empresa_matriz_new a partir de _new ───────────────────────────────────
+print("=== FASE 6: empresa_matriz ===", flush=True)
+t0 = time.time()
+linhas_matriz = empresa_matriz.montar(conn, db_schema, 'cnpj_consolidado_new')
 conn.close()
-conn2 = psycopg2.connect(DSN)
-conn2.autocommit = True
+construir_indices(DSN, db_schema, empresa_matriz.TAREFA, [empresa_matriz.ddl_do_indice(db_schema)])
+print(f"  {linhas_matriz:,} empresas em {round(time.time() - t0)}s\n", flush=True)
 
-INDEX_DDLS = [
-    # --- btree simples (rápidos) ---
-    f'CREATE UNIQUE INDEX IF NOT EXISTS cnpj_consolidado_cnpj ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnpj)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_basico ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnpj_basico)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_sit ON "{db_schema}"."cnpj_consolidado_new" USING btree (situacao_cadastral)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_uf ON "{db_schema}"."cnpj_consolidado_new" USING btree (uf)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_uf_mun ON "{db_schema}"."cnpj_consolidado_new" USING btree (uf, nome_municipio)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_razao ON "{db_schema}"."cnpj_consolidado_new" USING btree (razao_social)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_endereco ON "{db_schema}"."cnpj_consolidado_new" USING btree (cep, logradouro, numero)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_email ON "{db_schema}"."cnpj_consolidado_new" USING btree (correio_eletronico) WHERE (correio_eletronico IS NOT NULL)',
-    f'CREATE INDEX IF NOT EXISTS idx_cnpj_consolidado_cnpj_basico ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnpj_basico)',
-    f'CREATE INDEX IF NOT EXISTS idx_consolidado_cep ON "{db_schema}"."cnpj_consolidado_new" USING btree (cep)',
-    f'CREATE INDEX IF NOT EXISTS idx_consolidado_cnae ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnae_fiscal_principal)',
-    f'CREATE INDEX IF NOT EXISTS idx_consolidado_email ON "{db_schema}"."cnpj_consolidado_new" USING btree (correio_eletronico)',
-    f'CREATE INDEX IF NOT EXISTS idx_razao_social_btree ON "{db_schema}"."cnpj_consolidado_new" USING btree (razao_social)',
-    # --- GIN trgm (lentos — 20-60min cada) ---
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_razao_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(razao_social) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_fantasia_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(nome_fantasia) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_cnpj_consolidado_razao_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (razao_social gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_fantasia_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(nome_fantasia) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_fantasia_unaccent_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(nome_fantasia) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_razao_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(razao_social) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_razao_unaccent_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(razao_social) gin_trgm_ops)',
-    # --- GIN FTS (lentos) ---
-    f"""CREATE INDEX IF NOT EXISTS idx_cnpj_consolidado_razao ON "{db_schema}"."cnpj_consolidado_new" USING gin (to_tsvector('simple'::regconfig, ((COALESCE(razao_social, ''::text) || ' '::text) || COALESCE(nome_fantasia, ''::text))))""",
-    f"""CREATE INDEX IF NOT EXISTS idx_fts_simple ON "{db_schema}"."cnpj_consolidado_new" USING gin (to_tsvector('simple'::regconfig, ((immutable_unaccent(COALESCE(razao_social, ''::text)) || ' '::text) || immutable_unaccent(COALESCE(nome_fantasia, ''::text)))))""",
-    f"""CREATE INDEX IF NOT EXISTS idx_fts_simple_ativa ON "{db_schema}"."cnpj_consolidado_new" USING gin (to_tsvector('simple'::regconfig, ((immutable_unaccent(COALESCE(razao_social, ''::text)) || ' '::text) || immutable_unaccent(COALESCE(nome_fantasia, ''::text))))) WHERE ((situacao_cadastral)::text = '02'::text)""",
-]
+# ── 7. Recriar os índices do registro (sem os repetidos), em paralelo ────────
+INDEX_DDLS = ddl_dos_indices(db_schema, 'cnpj_consolidado_new')
 
-print(f"=== FASE 6: Recriando {len(INDEX_DDLS)} índices ===", flush=True)
-for ddl in INDEX_DDLS:
-    name = ddl.split('INDEX IF NOT EXISTS ')[1].split(' ')[0]
-    print(f"  {name}... ", end='', flush=True)
-    t0 = time.time()
-    with conn2.cursor() as c:
-        c.execute(ddl)
-    print(f"ok ({round(time.time()-t0)}s)", flush=True)
+print(f"=== FASE 7: Recriando {len(INDEX_DDLS)} índices ===", flush=True)
+construir_indices(DSN, db_schema, 'cnpj_consolidado', INDEX_DDLS)
 
-conn2.close()
-
-# ── 7. Swap atômico: cnpj_consolidado_new → cnpj_consolidado ─────────────────
-print("\n=== FASE 7: Swap atômico (RENAME) ===", flush=True)
+# ── 8. Swap atômico: cnpj_consolidado_new → cnpj_consolidado (e empresa_matriz) ─
+print("\n=== FASE 8: Swap atômico (RENAME) ===", flush=True)
 conn3 = psycopg2.connect(DSN)
 conn3.autocommit = False
 with conn3.cursor() as c:
     # Se cnpj_consolidado_old sobrou de run anterior, limpar primeiro
     c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."cnpj_consolidado_old";')
     conn3.commit()
+    # Espera quem ainda lê as _new (ex.: build_socios_consolidado.py com
+    # AGUARDAR_INDICES=1) antes de pegar o lock das tabelas em uso, para não
+    # bloquear as consultas a elas durante a espera
+    c.execute(f'LOCK TABLE "{db_schema}"."cnpj_consolidado_new" IN ACCESS EXCLUSIVE MODE;')
+    empresa_matriz.trocar(c, db_schema)
     # Se cnpj_consolidado existe (run normal), renomear para _old; senão (primeiro run), skip
     c.execute(f"""
         SELECT EXISTS (
@@ -254,11 +181,14 @@ with conn3.cursor() as c:
         c.execute(f'ALTER TABLE "{db_schema}"."cnpj_consolidado" RENAME TO "cnpj_consolidado_old";')
     c.execute(f'ALTER TABLE "{db_schema}"."cnpj_consolidado_new" RENAME TO "cnpj_consolidado";')
 conn3.commit()
-print("  cnpj_consolidado agora aponta para os dados novos.", flush=True)
+print("  cnpj_consolidado e empresa_matriz agora apontam para os dados novos.", flush=True)
 with conn3.cursor() as c:
     c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."cnpj_consolidado_old";')
 conn3.commit()
 conn3.close()
 print("  Tabela antiga removida.\n", flush=True)
 
+# Construção concluída: a próxima execução começa do zero
+executor.limpar()
+
 print(f"=== CONCLUIDO: cnpj_consolidado reconstruida com {total_inserted:,} registros e {len(INDEX_DDLS)} indices (zero-downtime) ===", flush=True)
@@ -0,0 +1,244 @@
+"""
+consolidar_particionado.py — cnpj_consolidado particionada por faixa de cnpj_basico.
+
+A tabela vira PARTITION BY RANGE (cnpj_basico), com CONSOLIDAR_PARTICOES
+partições (padrão 16) de prefixos contíguos. Cada partição é montada como uma
+tabela avulsa `cnpj_consolidado_pNN_new` numa das CONSOLIDAR_WORKERS conexões:
+INSERT ... SELECT da faixa, VACUUM, os índices de `consolidado_sql.INDICES`
+(deduplicados por `equivalentes`; pequenos, um backend por partição), ANALYZE e
+um CHECK com os limites da faixa (o ATTACH não precisa varrer a tabela). Em seguida, numa transação curta, a partição antiga sai com
+DETACH PARTITION e a nova entra com ATTACH PARTITION.
+
+    python consolidar_particionado.py          # todas as partições
+    python consolidar_particionado.py 06 43    # só as partições p06 e p43
+
+Na primeira execução, com cnpj_consolidado ainda comum, monta a tabela
+particionada inteira como cnpj_consolidado_new e faz o swap por RENAME, como o
+consolidar_fast.py. Uma execução interrompida retoma só as partições que
+faltaram (ver faixas.py). No fim, empresa_matriz é remontada inteira a partir
+da tabela nova (ver empresa_matriz.py).
+"""
+import os
+import pathlib
+import sys
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+from bulk_load import configuracao_de_carga, criar_tabela_de_carga, finalizar_tabela
+from consolidado_sql import INDICES, colunas_de_busca_faltando, ddl_dos_indices, definicao_da_tabela, sql_de_insercao
+from faixas import ExecutorDeFaixas, faixas_agrupadas, filtro_de_faixa
+from indices import construir_indices
+import empresa_matriz
+
+# ── env ──────────────────────────────────────────────────────────────────────
+current_path = pathlib.Path().resolve()
+dotenv_path = os.path.join(current_path, '.env')
+if not os.path.isfile(dotenv_path):
+    print(f"Arquivo .env não encontrado em {dotenv_path}")
+    sys.exit(1)
+load_dotenv(dotenv_path=dotenv_path)
+
+user      = os.getenv('DB_USER')
+password  = os.getenv('DB_PASSWORD')
+host      = os.getenv('DB_HOST')
+port      = os.getenv('DB_PORT')
+database  = os.getenv('DB_NAME')
+db_schema = os.getenv('DB_SCHEMA')
+
+DSN = f"dbname={database} user={user} host={host} port={port} password={password}"
+
+CONSOLIDAR_PARTICOES  = int(os.getenv('CONSOLIDAR_PARTICOES', '16'))
+CONSOLIDAR_WORKERS    = int(os.getenv('CONSOLIDAR_WORKERS', '4'))
+CONSOLIDAR_TENTATIVAS = int(os.getenv('CONSOLIDAR_TENTATIVAS', '3'))
+
+TABELA = 'cnpj_consolidado'
+FAIXAS = faixas_agrupadas(CONSOLIDAR_PARTICOES)
+pedidas = sys.argv[1:]
+desconhecidas = set(pedidas) - {faixa for faixa, _, _ in FAIXAS}
+if desconhecidas:
+    print(f"Partições inexistentes: {', '.join(sorted(desconhecidas))}. "
+          f"Válidas: {', '.join(f for f, _, _ in FAIXAS)}")
+    sys.exit(1)
+
+
+def particao(faixa):
+    return f'{TABELA}_p{faixa}'
+
+
+def limites(inicio, fim):
+    """Trecho FOR VALUES da partição e parâmetros."""
+    de = '%s' if inicio is not None else 'MINVALUE'
+    ate = '%s' if fim is not None else 'MAXVALUE'
+    return f'FOR VALUES FROM ({de}) TO ({ate})', tuple(v for v in (inicio, fim) if v is not None)
+
+
+def tipo_da_tabela(cur, tabela):
+    """'p' (particionada), 'r' (comum) ou None se não existir."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (f'"{db_schema}"."{tabela}"',))
+    linha = cur.fetchone()
+    return linha[0] if linha else None
+
+
+def renomear_indices(cur, de, para):
+    """Troca o prefixo `de` por `para` no nome dos índices de INDICES."""
+    for nome, _, _ in INDICES:
+        cur.execute(f'ALTER INDEX IF EXISTS "{db_schema}"."{de}{nome}" RENAME TO "{para}{nome}"')
+
+
+def particoes_anexadas(cur, tabela):
+    cur.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = to_regclass(%s)",
+                (f'"{db_schema}"."{tabela}"',))
+    return {nome.split('.')[-1].strip('"') for nome, in cur.fetchall()}
+
+
+# ── 1. Tabela pai ─────────────────────────────────────────────────────────────
+conn = psycopg2.connect(DSN)
+with conn.cursor() as c:
+    # Tabela comum, particionada com outro CONSOLIDAR_PARTICOES ou sem as colunas de
+    # busca (ver consolidado_sql.py): monta uma pai nova
+    migrando = (tipo_da_tabela(c, TABELA) != 'p'
+                or particoes_anexadas(c, TABELA) != {particao(f) for f, _, _ in FAIXAS}
+                or bool(colunas_de_busca_faltando(c, db_schema, TABELA)))
+conn.commit()
+
+if migrando and pedidas:
+    print(f"{TABELA} não tem as {len(FAIXAS)} partições esperadas: rode sem argumentos para montar todas.")
+    sys.exit(1)
+
+# Na migração as partições entram numa tabela pai nova, trocada no fim por RENAME
+PAI = f'{TABELA}_new' if migrando else TABELA
+
+executor = ExecutorDeFaixas(DSN, db_schema, f'{TABELA}_particoes', n_conexoes=CONSOLIDAR_WORKERS,
+                            max_tentativas=CONSOLIDAR_TENTATIVAS)
+with conn.cursor() as c:
+    pai_existe = tipo_da_tabela(c, PAI) == 'p'
+conn.commit()
+
+print("=== FASE 1: Tabela particionada ===", flush=True)
+if pedidas:
+    executor.iniciar([f for f in FAIXAS if f[0] in pedidas])
+    print(f"  Reconstruindo as partições: {', '.join(pedidas)}\n", flush=True)
+elif executor.tem_progresso() and pai_existe:
+    print(f"  Retomando a construção anterior de {PAI}\n", flush=True)
+else:
+    if migrando:
+        with conn.cursor() as c:
+            # DROP da pai leva junto as partições que estiverem anexadas
+            c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."{PAI}"')
+            c.execute(f'''
+                CREATE TABLE "{db_schema}"."{PAI}"
+                {definicao_da_tabela(c, db_schema, TABELA)}
+                PARTITION BY RANGE (cnpj_basico)
+            ''')
+        conn.commit()
+        print(f"  {PAI} criada com {len(FAIXAS)} partições por faixa de cnpj_basico.", flush=True)
+    executor.iniciar(FAIXAS)
+    print(f"  {len(FAIXAS)} partições a montar.\n", flush=True)
+
+# ── 2. Partições em paralelo ──────────────────────────────────────────────────
+def montar_particao(conn, faixa, inicio, fim):
+    """
+    Monta `cnpj_consolidado_pNN_new`, indexa, analisa e troca pela partição
+    atual. Idempotente: uma nova tentativa recomeça do DROP da tabela avulsa.
+    """
+    nova = f'{particao(faixa)}_new'
+    t0 = time.time()
+    with conn.cursor() as c:
+        c.execute("SET work_mem = '512MB'")
+        c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."{nova}"')
+        criar_tabela_de_carga(c, db_schema, nova, definicao_da_tabela(c, db_schema, PAI))
+        filtro, parametros = filtro_de_faixa('es.cnpj_basico', inicio, fim)
+        c.execute(sql_de_insercao(db_schema, nova).replace('{filtro}', filtro), parametros)
+        linhas = c.rowcount
+    conn.commit()
+    print(f"  p{faixa}: {linhas:,} linhas inseridas ({round(time.time() - t0)}s)", flush=True)
+
+    with configuracao_de_carga(conn):
+        finalizar_tabela(conn, db_schema, nova)
+        with conn.cursor() as c:
+            for ddl in ddl_dos_indices(db_schema, nova, prefixo=f'{nova}_', particionada=True):
+                c.execute(ddl)
+            conn.commit()
+            c.execute(f'ANALYZE "{db_schema}"."{nova}"')
+            # Mesmos limites da partição: o ATTACH usa o CHECK e não varre a tabela
+            filtro, parametros = filtro_de_faixa('cnpj_basico', inicio, fim)
+            c.execute(f'ALTER TABLE "{db_schema}"."{nova}" ADD CONSTRAINT "{nova}_faixa" '
+                      f'CHECK (cnpj_basico IS NOT NULL AND {filtro})', parametros)
+        conn.commit()
+    print(f"  p{faixa}: índices e estatísticas prontos ({round(time.time() - t0)}s)", flush=True)
+
+    # Troca: DETACH da antiga, ATTACH da nova (transação curta, a tarefa marca o progresso)
+    atual = particao(faixa)
+    with conn.cursor() as c:
+        c.execute("""
+            SELECT i.inhparent = to_regclass(%s)
+              FROM pg_inherits i WHERE i.inhrelid = to_regclass(%s)
+        """, (f'"{db_schema}"."{PAI}"', f'"{db_schema}"."{atual}"'))
+        anexada = c.fetchone()
+        if anexada and anexada[0]:
+            c.execute(f'ALTER TABLE "{db_schema}"."{PAI}" DETACH PARTITION "{db_schema}"."{atual}"')
+        elif anexada:
+            # Partição da tabela ativa com outro CONSOLIDAR_PARTICOES: só libera o nome
+            # (sai junto com a tabela antiga no swap da FASE 3)
+            c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."{atual}_old"')
+            c.execute(f'ALTER TABLE "{db_schema}"."{atual}" RENAME TO "{atual}_old"')
+            renomear_indices(c, f'{atual}_', f'{atual}_old_')
+        c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."{atual}"')
+        c.execute(f'ALTER TABLE "{db_schema}"."{nova}" RENAME TO "{atual}"')
+        c.execute(f'ALTER TABLE "{db_schema}"."{atual}" RENAME CONSTRAINT "{nova}_faixa" TO "{atual}_faixa"')
+        renomear_indices(c, f'{nova}_', f'{atual}_')
+        para_valores, parametros = limites(inicio, fim)
+        c.execute(f'ALTER TABLE "{db_schema}"."{PAI}" ATTACH PARTITION "{db_schema}"."{atual}" {para_valores}',
+                  parametros)
+        c.execute(f'ALTER TABLE "{db_schema}"."{atual}" DROP CONSTRAINT "{atual}_faixa"')
+    print(f"  p{faixa}: anexada a {PAI} ({round(time.time() - t0)}s)", flush=True)
+    return linhas
+
+
+print(f"=== FASE 2: Montando partições em {CONSOLIDAR_WORKERS} conexões ===", flush=True)
+start = time.time()
+executor.executar_tarefa(montar_particao)
+print(f"  Partições prontas em {round((time.time() - start) / 60)}min\n", flush=True)
+
+# ── 3. Migração: índices da pai e swap atômico ────────────────────────────────
+if migrando:
+    # Cada partição já tem os índices equivalentes: o CREATE INDEX na pai só os anexa
+    print("=== FASE 3: Índices particionados e swap (RENAME) ===", flush=True)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        for ddl in ddl_dos_indices(db_schema, PAI, prefixo='new_', particionada=True):
+            c.execute(ddl)
+    conn.autocommit = False
+    with conn.cursor() as c:
+        c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."{TABELA}_old"')
+        if tipo_da_tabela(c, TABELA):
+            c.execute(f'ALTER TABLE "{db_schema}"."{TABELA}" RENAME TO "{TABELA}_old"')
+        c.execute(f'ALTER TABLE "{db_schema}"."{PAI}" RENAME TO "{TABELA}"')
+        # Libera os nomes dos índices antigos antes de renomear os novos
+        c.execute(f'DROP TABLE IF EXISTS "{db_schema}"."{TABELA}_old"')
+        renomear_indices(c, 'new_', '')
+    conn.commit()
+    print(f"  {TABELA} agora é particionada.\n", flush=True)
+
+# ── 4. empresa_matriz ─────────────────────────────────────────────────────────
+print("=== FASE 4: empresa_matriz ===", flush=True)
+t0 = time.time()
+linhas_matriz = empresa_matriz.montar(conn, db_schema, TABELA)
+construir_indices(DSN, db_schema, empresa_matriz.TAREFA, [empresa_matriz.ddl_do_indice(db_schema)])
+with conn.cursor() as c:
+    empresa_matriz.trocar(c, db_schema)
+conn.commit()
+print(f"  {linhas_matriz:,} empresas em {round(time.time() - t0)}s\n", flush=True)
+
+with conn.cursor() as c:
+    c.execute(f'SELECT COUNT(*) FROM "{db_schema}"."{TABELA}"')
+    total = c.fetchone()[0]
+conn.commit()
+conn.close()
+
+# Construção concluída: a próxima execução começa do zero
+executor.limpar()
+
+print(f"=== CONCLUIDO: {TABELA} com {total:,} registros em {len(FAIXAS)} partições ===", flush=True)
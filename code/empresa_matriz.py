@@ -0,0 +1,156 @@
+"""
+empresa_matriz: uma linha por cnpj_basico, derivada de cnpj_consolidado.
+
+Guarda os dados do estabelecimento matriz (identificador_mf = '1') e um resumo
+dos estabelecimentos da empresa: quantos são, quantas filiais, quantos ativos
+e as UFs em que aparecem. É montada pelos consolidadores junto com
+cnpj_consolidado e serve a build_socios_consolidado.py (um hash join no lugar
+de uma busca em cnpj_consolidado por linha de socios) e às páginas por empresa.
+
+Empresas sem matriz em cnpj_consolidado têm linha com as colunas da matriz
+nulas, como ficavam no LEFT JOIN LATERAL de socios_consolidado.
+
+    montar(conn, schema, 'cnpj_consolidado_new')    # cria empresa_matriz_new
+    construir_indices(DSN, schema, TAREFA, [ddl_do_indice(schema)])
+    ...
+    trocar(cur, schema)                             # na transação do swap
+"""
+from bulk_load import configuracao_de_carga, criar_tabela_de_carga, finalizar_tabela
+
+TABELA = 'empresa_matriz'
+NOVA = f'{TABELA}_new'
+
+# Tarefa do índice em indices.TABELA_PROGRESSO (ver consolidado_sql.DEPENDENCIAS_DAS_ETAPAS)
+TAREFA = TABELA
+# O índice é criado na _new com este nome e renomeado no swap, liberando o nome para a próxima carga
+INDICE_NOVO = f'{NOVA}_cnpj_basico'
+INDICE = f'{TABELA}_cnpj_basico'
+
+# Trava consultiva (pg_advisory_lock) entre quem lê empresa_matriz_new em várias
+# conexões e o swap: um LOCK TABLE numa conexão só não basta, pois as outras
+# ficariam na fila atrás do ACCESS EXCLUSIVE do swap
+TRAVA_DE_LEITURA = 0x656d6174
+
+# Colunas copiadas da linha da matriz em cnpj_consolidado
+COLUNAS_DA_MATRIZ = {
+    'cnpj':                    'VARCHAR(14)',
+    'razao_social':            'TEXT',
+    'nome_fantasia':           'TEXT',
+    'situacao_cadastral':      'VARCHAR(2)',
+    'data_situacao_cadastral': 'VARCHAR(8)',
+    'data_inicio_atividade':   'VARCHAR(8)',
+    'cnae_fiscal_principal':   'VARCHAR(7)',
+    'desc_cnae_principal':     'TEXT',
+    'natureza_juridica':       'VARCHAR(4)',
+    'desc_natureza_juridica':  'TEXT',
+    'porte_empresa':           'VARCHAR(2)',
+    'capital_social':          'NUMERIC',
+    'opcao_pelo_simples':      'VARCHAR(1)',
+    'opcao_mei':               'VARCHAR(1)',
+    'uf':                      'VARCHAR(2)',
+    'nome_municipio':          'TEXT',
+}
+
+# Resumo de todos os estabelecimentos do cnpj_basico
+COLUNAS_DO_RESUMO = {
+    'n_estabelecimentos':        'INTEGER',
+    'n_filiais':                 'INTEGER',
+    'n_estabelecimentos_ativos': 'INTEGER',
+    'ufs':                       'TEXT[]',
+}
+
+DEFINICAO = '(\n    cnpj_basico VARCHAR(8),\n' + ',\n'.join(
+    f'    {nome} {tipo}' for nome, tipo in {**COLUNAS_DA_MATRIZ, **COLUNAS_DO_RESUMO}.items()
+) + '\n)'
+
+
+def sql_de_insercao(schema, origem, destino):
+    """
+    INSERT ... SELECT de `destino` a partir de `origem` (cnpj_consolidado ou a
+    _new). O trecho '{filtro}' deve ser trocado pela condição sobre cnpj_basico.
+    """
+    matriz = ', '.join(COLUNAS_DA_MATRIZ)
+    colunas = ', '.join(['cnpj_basico', *COLUNAS_DA_MATRIZ, *COLUNAS_DO_RESUMO])
+    return f"""
+    INSERT INTO "{schema}"."{destino}" ({colunas})
+    SELECT r.cnpj_basico, {', '.join(f'm.{c}' for c in COLUNAS_DA_MATRIZ)},
+           r.n_estabelecimentos, r.n_filiais, r.n_estabelecimentos_ativos, r.ufs
+    FROM (
+        SELECT cnpj_basico,
+               COUNT(*)                                              AS n_estabelecimentos,
+               COUNT(*) FILTER (WHERE identificador_mf = '2')        AS n_filiais,
+               COUNT(*) FILTER (WHERE situacao_cadastral = '02')     AS n_estabelecimentos_ativos,
+               array_agg(DISTINCT uf ORDER BY uf) FILTER (WHERE uf IS NOT NULL) AS ufs
+          FROM "{schema}"."{origem}"
+         WHERE {{filtro}}
+         GROUP BY cnpj_basico
+    ) r
+    LEFT JOIN (
+        SELECT DISTINCT ON (cnpj_basico) cnpj_basico, {matriz}
+          FROM "{schema}"."{origem}"
+         WHERE identificador_mf = '1' AND {{filtro}}
+         ORDER BY cnpj_basico
+    ) m ON m.cnpj_basico = r.cnpj_basico
+"""
+
+
+def ddl_do_indice(schema):
+    """CREATE INDEX de cnpj_basico em empresa_matriz_new (UNIQUE: uma linha por empresa)."""
+    return f'CREATE UNIQUE INDEX IF NOT EXISTS {INDICE_NOVO} ON "{schema}"."{NOVA}" USING btree (cnpj_basico)'
+
+
+def montar(conn, schema, origem):
+    """
+    Recria empresa_matriz_new a partir de `origem`, já LOGGED e congelada (sem
+    o índice, ver ddl_do_indice). Retorna o número de linhas.
+    """
+    with conn.cursor() as c:
+        c.execute("SET work_mem = '512MB'")
+        c.execute(f'DROP TABLE IF EXISTS "{schema}"."{NOVA}"')
+        criar_tabela_de_carga(c, schema, NOVA, DEFINICAO)
+        c.execute(sql_de_insercao(schema, origem, NOVA).replace('{filtro}', 'TRUE'))
+        linhas = c.rowcount
+    conn.commit()
+    with configuracao_de_carga(conn):
+        finalizar_tabela(conn, schema, NOVA)
+    return linhas
+
+
+def reservar_leitura(cur):
+    """
+    Impede o swap até a sessão de `cur` terminar (ou chamar pg_advisory_unlock_shared).
+    Se um swap estiver em andamento, espera ele acabar: confira depois se a _new existe.
+    """
+    cur.execute('SELECT pg_advisory_lock_shared(%s)', (TRAVA_DE_LEITURA,))
+
+
+def trocar(cur, schema):
+    """
+    empresa_matriz_new passa a ser empresa_matriz, na transação de `cur`. As
+    travas vêm antes para esperar quem ainda lê a _new (ver reservar_leitura)
+    sem segurar a tabela em uso.
+    """
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (TRAVA_DE_LEITURA,))
+    cur.execute(f'LOCK TABLE "{schema}"."{NOVA}" IN ACCESS EXCLUSIVE MODE')
+    cur.execute(f'DROP TABLE IF EXISTS "{schema}"."{TABELA}_old"')
+    cur.execute(f'ALTER TABLE IF EXISTS "{schema}"."{TABELA}" RENAME TO "{TABELA}_old"')
+    cur.execute(f'ALTER TABLE "{schema}"."{NOVA}" RENAME TO "{TABELA}"')
+    cur.execute(f'DROP TABLE IF EXISTS "{schema}"."{TABELA}_old"')
+    cur.execute(f'ALTER INDEX IF EXISTS "{schema}"."{INDICE_NOVO}" RENAME TO "{INDICE}"')
+
+
+def atualizar(cur, schema, filtro):
+    """
+    Refaz em empresa_matriz só as linhas de `filtro` (condição sobre cnpj_basico),
+    a partir de cnpj_consolidado. Se a tabela ainda não existir, é criada inteira.
+    Retorna (apagadas, inseridas).
+    """
+    cur.execute('SELECT to_regclass(%s)', (f'"{schema}"."{TABELA}"',))
+    if cur.fetchone()[0] is None:
+        cur.execute(f'CREATE TABLE "{schema}"."{TABELA}" {DEFINICAO}')
+        cur.execute(f'CREATE UNIQUE INDEX {INDICE} ON "{schema}"."{TABELA}" USING btree (cnpj_basico)')
+        filtro = 'TRUE'
+    cur.execute(f'DELETE FROM "{schema}"."{TABELA}" WHERE {filtro}')
+    apagadas = cur.rowcount
+    cur.execute(sql_de_insercao(schema, 'cnpj_consolidado', TABELA).replace('{filtro}', filtro))
+    return apagadas, cur.rowcount
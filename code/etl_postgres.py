@@ -11,10 +11,24 @@ import zipfile
 import xml.etree.ElementTree as ET
 import polars as pl
 import psycopg2
-from io import StringIO
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from bulk_load import configuracao_de_carga, criar_tabela_de_carga, finalizar_tabela, preparar_tabela
+import incremental
+from mudancas import FeedDeMudancas, criar_tabela as criar_tabela_de_mudancas
+from consolidado_sql import FINAL_COLS, ddl_dos_indices, definicao_da_tabela, nomes_dos_indices
+from indices import construir_indices
+import empresa_matriz
+from particoes import Particoes
+from pessoa_id import com_pessoa_id
+from pg_copy import CargaParalela, copia_de_saida, copiar_binario, copiar_fluxo, csv_de_dataframe, tipos_da_consulta
 import shutil
 import random
+import mmap
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 #############################################
 # Controle de Execução (Log)
@@ -25,24 +39,257 @@ etl_status = 'Sucesso'
 #############################################
 # Funções de apoio
 #############################################
-def check_diff(url, file_name, auth=None):
+class ServidorOcupado(Exception):
+    """Servidor respondeu 429/503: o download deve ser refeito após o backoff."""
+
+
+class LimitadorAdaptativo:
     """
-    Verifica se o arquivo no servidor existe no disco e se ele tem o mesmo tamanho.
+    Limita quantas conexões de download ficam abertas ao mesmo tempo.
+    Quando o servidor responde 429/503 o limite cai pela metade e todas as threads
+    aguardam o backoff; cada download concluído devolve uma vaga, até o limite inicial.
     """
-    if not os.path.isfile(file_name):
-        return True
+    def __init__(self, limite):
+        self.maximo = limite
+        self.limite = limite
+        self.ativos = 0
+        self.pausa_ate = 0.0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.ativos >= self.limite:
+                self._cond.wait()
+            self.ativos += 1
+            espera = self.pausa_ate - time.time()
+        if espera > 0:
+            time.sleep(espera)
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.ativos -= 1
+            self._cond.notify_all()
+        return False
+
+    def penalizar(self, espera):
+        with self._cond:
+            novo = max(1, self.limite // 2)
+            if novo < self.limite:
+                print(f"\nServidor sobrecarregado: concorrência de download reduzida para {novo}.", flush=True)
+            self.limite = novo
+            self.pausa_ate = max(self.pausa_ate, time.time() + espera)
+
+    def recompensar(self):
+        with self._cond:
+            if self.limite < self.maximo:
+                self.limite += 1
+                self._cond.notify_all()
+
 
+def tamanho_remoto(session, url, auth=None, headers=None):
+    """
+    Retorna o tamanho do arquivo no servidor (content-length do HEAD) ou 0 se desconhecido.
+    """
     try:
-        response = requests.head(url, auth=auth, timeout=30)
-        new_size = int(response.headers.get('content-length', 0))
-        old_size = os.path.getsize(file_name)
-        if new_size != old_size:
-            os.remove(file_name)
-            return True
+        response = session.head(url, auth=auth, headers=headers, timeout=30)
+        return int(response.headers.get('content-length', 0))
+    except Exception:
+        return 0
+
+
+class RangeNaoSuportado(Exception):
+    """Servidor ignorou o header Range de um segmento (respondeu 200 em vez de 206)."""
+
+
+class Progresso:
+    """Contador de bytes baixados de um arquivo, compartilhado entre os segmentos."""
+    def __init__(self, nome, total, inicial=0):
+        self.nome = nome
+        self.total = total
+        self.baixado = inicial
+        self.proximo_aviso = 10
+        self._lock = threading.Lock()
+
+    def avancar(self, n):
+        with self._lock:
+            self.baixado += n
+            if not self.total:
+                return
+            percent = int(self.baixado / self.total * 100)
+            if percent >= self.proximo_aviso:
+                print(f"  {self.nome}: {percent}% [{self.baixado} / {self.total}] bytes", flush=True)
+                self.proximo_aviso = (percent // 10 + 1) * 10
+
+
+def baixar_intervalo(session, url, destino, inicio, fim, limitador, progresso, auth=None, headers=None,
+                     segmento=False):
+    """
+    Baixa os bytes [inicio, fim] de `url` em `destino` (fim=None: até o final do arquivo).
+    Se `destino` já contém parte do intervalo, continua de onde parou via header Range.
+    Com segmento=True o servidor precisa responder 206; caso contrário levanta RangeNaoSuportado.
+    """
+    offset = os.path.getsize(destino) if os.path.isfile(destino) else 0
+    esperado = None if fim is None else fim - inicio + 1
+    if esperado is not None and offset >= esperado:
+        if offset > esperado:
+            os.truncate(destino, esperado)
+        return
+
+    req_headers = dict(headers or {})
+    if segmento or offset:
+        req_headers['Range'] = f"bytes={inicio + offset}-{'' if fim is None else fim}"
+
+    with limitador:
+        with session.get(url, auth=auth, headers=req_headers, stream=True, timeout=(30, 300)) as r:
+            if r.status_code in (429, 503):
+                espera = int(r.headers.get('Retry-After', 0) or 0) or random.randint(30, 120)
+                limitador.penalizar(espera)
+                raise ServidorOcupado(f"HTTP {r.status_code}, nova tentativa em {espera}s")
+            r.raise_for_status()
+            if 'Range' in req_headers and r.status_code != 206:
+                if segmento:
+                    raise RangeNaoSuportado(url)
+                # Servidor ignorou o Range: recomeça do zero
+                progresso.avancar(-offset)
+                offset = 0
+
+            with open(destino, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        f.write(chunk)
+                        offset += len(chunk)
+                        progresso.avancar(len(chunk))
+                        if esperado is not None and offset >= esperado:
+                            break
+
+    if esperado is not None and os.path.getsize(destino) < esperado:
+        raise IOError(f"download incompleto ({os.path.getsize(destino)} de {esperado} bytes)")
+
+
+def plano_de_segmentos(total_length, tamanho_minimo, max_segmentos):
+    """
+    Divide um arquivo de `total_length` bytes em intervalos [inicio, fim] de pelo menos
+    `tamanho_minimo` bytes, no máximo `max_segmentos`. Arquivos pequenos ou de tamanho
+    desconhecido ficam em um único intervalo.
+    """
+    n = 1
+    if total_length and tamanho_minimo > 0:
+        n = max(1, min(max_segmentos, total_length // tamanho_minimo))
+    if n == 1:
+        return [(0, total_length - 1 if total_length else None)]
+    passo = -(-total_length // n)
+    return [(i, min(i + passo, total_length) - 1) for i in range(0, total_length, passo)]
+
+
+def baixar_arquivo(session, url, file_name, total_length, limitador, auth=None, headers=None,
+                   tamanho_segmento=0, max_segmentos=1):
+    """
+    Baixa `url` em `file_name`, retomando downloads parciais via header Range.
+    Arquivos grandes são divididos em segmentos baixados em paralelo em arquivos
+    `<nome>.segN`, concatenados no final. Retorna False se o arquivo já estava completo.
+    """
+    nome = os.path.basename(file_name)
+
+    # Descarta parciais de outra publicação (mesmo nome de arquivo, outra pasta/tamanho)
+    origem_path = file_name + '.origem'
+    origem = f"{url}|{total_length}"
+    origem_anterior = open(origem_path).read() if os.path.isfile(origem_path) else None
+    if origem_anterior != origem:
+        # Sem registro de origem, só um arquivo já completo é aproveitado
+        manter = (origem_anterior is None and os.path.isfile(file_name)
+                  and os.path.getsize(file_name) == total_length)
+        for parcial in [file_name] + [f"{file_name}.seg{i}" for i in range(max(max_segmentos, 1))]:
+            if os.path.isfile(parcial) and not (manter and parcial == file_name):
+                os.remove(parcial)
+        with open(origem_path, 'w') as f:
+            f.write(origem)
+
+    atual = os.path.getsize(file_name) if os.path.isfile(file_name) else 0
+    if total_length and atual == total_length:
         return False
-    except:
+    if total_length and atual > total_length:
+        os.remove(file_name)
+        atual = 0
+
+    segmentos = plano_de_segmentos(total_length, tamanho_segmento, max_segmentos)
+    if atual or len(segmentos) == 1:
+        # Download parcial em stream único continua em stream único
+        if atual:
+            print(f"Retomando {nome} a partir do byte {atual}", flush=True)
+        baixar_intervalo(session, url, file_name, 0, total_length - 1 if total_length else None,
+                         limitador, Progresso(nome, total_length, atual), auth=auth, headers=headers)
+        limitador.recompensar()
+        return True
+
+    partes = [f"{file_name}.seg{i}" for i in range(len(segmentos))]
+    ja_baixado = sum(min(os.path.getsize(p), fim - inicio + 1)
+                     for p, (inicio, fim) in zip(partes, segmentos) if os.path.isfile(p))
+    print(f"Baixando {nome} em {len(segmentos)} segmentos"
+          + (f" (retomando de {ja_baixado} bytes)" if ja_baixado else ""), flush=True)
+    progresso = Progresso(nome, total_length, ja_baixado)
+    try:
+        with ThreadPoolExecutor(max_workers=len(segmentos)) as pool:
+            futuros = [pool.submit(baixar_intervalo, session, url, parte, inicio, fim, limitador,
+                                   progresso, auth, headers, True)
+                       for parte, (inicio, fim) in zip(partes, segmentos)]
+            for futuro in futuros:
+                futuro.result()
+    except RangeNaoSuportado:
+        print(f"{nome}: servidor não aceita Range, baixando em stream único.", flush=True)
+        for parte in partes:
+            if os.path.isfile(parte):
+                os.remove(parte)
+        baixar_intervalo(session, url, file_name, 0, total_length - 1, limitador,
+                         Progresso(nome, total_length), auth=auth, headers=headers)
+        limitador.recompensar()
         return True
 
+    # Junta os segmentos; só remove as partes depois que o arquivo final está completo
+    temporario = file_name + '.part'
+    with open(temporario, 'wb') as destino:
+        for parte in partes:
+            with open(parte, 'rb') as origem_seg:
+                shutil.copyfileobj(origem_seg, destino, 16 * 1024 * 1024)
+    if os.path.getsize(temporario) != total_length:
+        os.remove(temporario)
+        raise IOError(f"segmentos de {nome} não somam {total_length} bytes")
+    os.replace(temporario, file_name)
+    for parte in partes:
+        os.remove(parte)
+    limitador.recompensar()
+    return True
+
+
+def baixar_com_tentativas(session, url, file_name, total_length, limitador, auth=None, headers=None,
+                          max_tentativas=5, tamanho_segmento=0, max_segmentos=1):
+    """
+    Executa baixar_arquivo com novas tentativas. Arquivos e segmentos parciais são
+    mantidos entre as tentativas, de modo que cada uma continua de onde a anterior parou.
+    Retorna None em caso de sucesso ou a mensagem do último erro.
+    """
+    file_entry = os.path.basename(file_name)
+    for tentativa in range(1, max_tentativas + 1):
+        try:
+            if baixar_arquivo(session, url, file_name, total_length, limitador, auth=auth, headers=headers,
+                              tamanho_segmento=tamanho_segmento, max_segmentos=max_segmentos):
+                print(f"Download de {file_entry} concluído com sucesso!", flush=True)
+            else:
+                print(f"O arquivo {file_entry} já existe e está completo. Pulando o download.", flush=True)
+            return None
+        except ServidorOcupado as e:
+            print(f"{file_entry}: {e} (tentativa {tentativa}/{max_tentativas})", flush=True)
+            erro = str(e)
+        except Exception as e:
+            print(f"{file_entry}: a conexão caiu ou travou durante o download: {e} (tentativa {tentativa}/{max_tentativas})", flush=True)
+            erro = str(e)
+            if tentativa < max_tentativas:
+                tempo_espera = random.randint(5, 120)
+                print(f"Aguardando {tempo_espera} segundos antes de retomar {file_entry}...", flush=True)
+                time.sleep(tempo_espera)
+    print(f"Limite de tentativas atingido. Pulando o arquivo {file_entry}.", flush=True)
+    return erro
+
 def makedirs(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -51,18 +298,229 @@ def to_sql(df: pl.DataFrame, table_name: str, conn, schema: str):
     """
     Insere os registros no banco via PostgreSQL COPY FROM STDIN (bulk insert nativo).
     Muito mais rápido do que INSERT por lotes.
+    Com COPY_FORMAT=binary as colunas são codificadas direto no formato binário do
+    COPY (ver pg_copy.py); tabelas com tipos não suportados continuam em CSV.
     """
     cur = conn.cursor()
-    col_list = ', '.join(f'"{c}"' for c in df.columns)
-    copy_sql = (
-        f'COPY "{schema}"."{table_name}" ({col_list}) '
-        f"FROM STDIN WITH (FORMAT CSV, HEADER TRUE, NULL '')"
-    )
-    csv_data = df.write_csv(null_value='').replace('\x00', '')
-    cur.copy_expert(copy_sql, StringIO(csv_data))
+    if COPY_FORMAT != 'binary' or not copiar_binario(df, table_name, cur, schema):
+        col_list = ', '.join(f'"{c}"' for c in df.columns)
+        copy_sql = (
+            f'COPY "{schema}"."{table_name}" ({col_list}) '
+            f"FROM STDIN WITH (FORMAT CSV, NULL '')"
+        )
+        # CSV gerado fatia a fatia enquanto o COPY lê (sem o texto do chunk inteiro
+        # em memória). Os leitores já entregam os dados sem bytes \x00 (ver para_utf8)
+        copiar_fluxo(cur, copy_sql, csv_de_dataframe(df))
     conn.commit()
     cur.close()
 
+def descompactar(zip_path, destino, utf8=True, tamanho_bloco=64 * 1024 * 1024):
+    """
+    Extrai `zip_path` em `destino`. Executado nos processos do pool de extração.
+    Com utf8=True cada membro é convertido de latin1 para UTF-8 (sem bytes \\x00)
+    enquanto é descompactado e gravado como `<membro>.utf8`.
+    Retorna (bytes descompactados, segundos, caminhos dos arquivos gravados).
+    """
+    t0 = time.time()
+    caminhos = []
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        if not utf8:
+            for info in zip_ref.infolist():
+                convertido = os.path.join(destino, os.path.basename(info.filename) + '.utf8')
+                if os.path.isfile(convertido):
+                    os.remove(convertido)
+            zip_ref.extractall(destino)
+            caminhos = [os.path.join(destino, info.filename) for info in zip_ref.infolist() if not info.is_dir()]
+        else:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                original = os.path.join(destino, os.path.basename(info.filename))
+                # Uma cópia latin1 de execução anterior seria carregada em duplicidade
+                if os.path.isfile(original):
+                    os.remove(original)
+                temporario = original + '.utf8.tmp'
+                with zip_ref.open(info) as origem, open(temporario, 'wb') as saida:
+                    # latin1 tem 1 byte por caractere: qualquer corte de bloco é válido
+                    while True:
+                        bloco = origem.read(tamanho_bloco)
+                        if not bloco:
+                            break
+                        saida.write(para_utf8(bloco))
+                os.replace(temporario, original + '.utf8')
+                caminhos.append(original + '.utf8')
+        total = sum(info.file_size for info in zip_ref.infolist())
+    return total, time.time() - t0, caminhos
+
+def pool_de_processos(max_workers):
+    """
+    Pool de processos via fork: o script executa o ETL no import, então um processo
+    iniciado com spawn/forkserver refaria tudo. Sem fork (Windows), usa threads —
+    a descompressão do zlib libera o GIL.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def fim_de_registro(bloco):
+    """
+    Posição da última quebra de linha de `bloco` que está fora de aspas, ou -1.
+    Assume que `bloco` começa no início de um registro.
+    """
+    pos = bloco.rfind(b'\n')
+    if pos < 0:
+        return -1
+    aspas = bloco.count(b'"', 0, pos)
+    while aspas % 2:
+        anterior = bloco.rfind(b'\n', 0, pos)
+        if anterior < 0:
+            return -1
+        aspas -= bloco.count(b'"', anterior, pos)
+        pos = anterior
+    return pos
+
+def para_utf8(bloco):
+    """Remove bytes \\x00 e converte o bloco de latin1 para UTF-8."""
+    return bloco.replace(b'\x00', b'').decode('latin1').encode('utf-8')
+
+def eh_utf8(fonte):
+    """Arquivo extraído já convertido para UTF-8 pela extração (sufixo .utf8)."""
+    return not isinstance(fonte, tuple) and fonte.endswith('.utf8')
+
+def iter_blocos_csv(stream, tamanho_bloco, converter=True):
+    """
+    Lê um stream binário de CSV em blocos de ~tamanho_bloco bytes, sempre terminados
+    em fim de registro (quebra de linha fora de aspas), já convertidos para UTF-8
+    (converter=False para streams que já estão em UTF-8).
+    """
+    para_utf8_ = para_utf8 if converter else bytes
+    resto = b''
+    while True:
+        dados = stream.read(tamanho_bloco)
+        if not dados:
+            break
+        bloco = resto + dados if resto else dados
+        corte = fim_de_registro(bloco)
+        if corte < 0:
+            resto = bloco
+            continue
+        resto = bloco[corte + 1:]
+        yield para_utf8_(bloco[:corte + 1])
+    if resto:
+        yield para_utf8_(resto)
+
+def ler_bloco_csv(bloco, colunas, **opcoes):
+    """Converte um bloco (ou arquivo) UTF-8 do layout da RFB em DataFrame (todas as colunas Utf8)."""
+    return pl.read_csv(
+        bloco,
+        separator=';',
+        has_header=False,
+        infer_schema_length=0,
+        new_columns=colunas,
+        **opcoes,
+    )
+
+def nome_da_fonte(fonte):
+    """Nome legível de uma fonte: caminho do arquivo extraído ou (zip, membro)."""
+    return f"{os.path.basename(fonte[0])}:{fonte[1]}" if isinstance(fonte, tuple) else os.path.basename(fonte)
+
+@contextmanager
+def abrir_fonte(fonte):
+    """Abre uma fonte como stream binário: arquivo extraído ou membro de um zip."""
+    if isinstance(fonte, tuple):
+        zip_path, membro = fonte
+        with zipfile.ZipFile(zip_path) as zf, zf.open(membro) as stream:
+            yield stream
+    else:
+        with open(fonte, 'rb') as stream:
+            yield stream
+
+def em_partes(df, n_rows):
+    """Divide um DataFrame em fatias de no máximo n_rows linhas (n_rows=None: inteiro)."""
+    if n_rows is None or len(df) <= n_rows:
+        yield df
+        return
+    for inicio in range(0, len(df), n_rows):
+        yield df.slice(inicio, n_rows)
+
+def ler_arquivo(fonte, colunas, n_rows=None, **opcoes):
+    """
+    Gera DataFrames (todas as colunas Utf8) com o conteúdo de um arquivo da RFB.
+    `fonte` é o caminho de um arquivo extraído ou uma tupla (caminho do zip, membro);
+    no segundo caso o membro é descompactado direto da memória, sem passar pelo disco.
+
+    Arquivos extraídos sem n_rows são lidos de uma vez. Nos demais casos a leitura é
+    feita em uma única passada, em blocos de STREAM_BLOCK_SIZE bytes, e cada bloco é
+    entregue em partes de no máximo n_rows linhas.
+    Em todos os casos o parser recebe UTF-8 sem bytes \\x00.
+    """
+    # O parser sempre recebe UTF-8: pode usar todas as threads
+    opcoes.pop('n_threads', None)
+    if n_rows is None and not isinstance(fonte, tuple):
+        if eh_utf8(fonte):
+            yield ler_bloco_csv(fonte, colunas, **opcoes)
+        else:
+            with open(fonte, 'rb') as f:
+                yield ler_bloco_csv(para_utf8(f.read()), colunas, **opcoes)
+        return
+
+    with abrir_fonte(fonte) as stream:
+        for bloco in iter_blocos_csv(stream, STREAM_BLOCK_SIZE, converter=not eh_utf8(fonte)):
+            df = ler_bloco_csv(bloco, colunas, **opcoes)
+            del bloco
+            yield from em_partes(df, n_rows)
+
+def iter_intervalos(mm, tamanho_alvo):
+    """
+    Divide o arquivo mapeado em intervalos [inicio, fim) de ~tamanho_alvo bytes que
+    terminam em fim de registro. Conta as aspas em uma passada sequencial para saber
+    se cada quebra de linha candidata está dentro de um campo entre aspas.
+    """
+    tamanho = len(mm)
+    inicio = 0
+    while inicio < tamanho:
+        alvo = min(inicio + tamanho_alvo, tamanho)
+        aspas = mm[inicio:alvo].count(b'"')
+        fim = alvo
+        while fim < tamanho:
+            nl = mm.find(b'\n', fim)
+            if nl < 0:
+                fim = tamanho
+                break
+            aspas += mm[fim:nl].count(b'"')
+            fim = nl + 1
+            if aspas % 2 == 0:
+                break
+        yield inicio, fim
+        inicio = fim
+
+def ler_arquivo_paralelo(fonte, colunas, n_rows=None, **opcoes):
+    """
+    Como ler_arquivo, mas para arquivos extraídos: mapeia o arquivo em memória,
+    divide-o em intervalos de bytes alinhados a fim de registro e converte/lê cada
+    intervalo em uma thread do pool (PARSE_WORKERS). Os DataFrames saem na ordem do
+    arquivo; no máximo PARSE_WORKERS + 1 intervalos ficam em memória ao mesmo tempo.
+    """
+    if isinstance(fonte, tuple) or PARSE_WORKERS <= 1 or os.path.getsize(fonte) == 0:
+        yield from ler_arquivo(fonte, colunas, n_rows=n_rows, **opcoes)
+        return
+
+    opcoes.pop('n_threads', None)
+    converter = para_utf8 if not eh_utf8(fonte) else bytes
+
+    def ler_intervalo(mm, inicio, fim):
+        return ler_bloco_csv(converter(mm[inicio:fim]), colunas, **opcoes)
+
+    with open(fonte, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            ThreadPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        pendentes = []
+        for inicio, fim in iter_intervalos(mm, STREAM_BLOCK_SIZE):
+            pendentes.append(pool.submit(ler_intervalo, mm, inicio, fim))
+            if len(pendentes) > PARSE_WORKERS:
+                yield from em_partes(pendentes.pop(0).result(), n_rows)
+        for futuro in pendentes:
+            yield from em_partes(futuro.result(), n_rows)
+
 def get_latest_update_url_by_name():
     """
     Lista as pastas via protocolo WebDAV do Nextcloud e retorna a URL da mais recente.
@@ -141,6 +599,31 @@ load_dotenv(dotenv_path=dotenv_path)
 
 output_files = os.getenv('OUTPUT_FILES_PATH')
 extracted_files = os.getenv('EXTRACTED_FILES_PATH')
+
+# Quantos .zip são descompactados ao mesmo tempo
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+# Converte os arquivos para UTF-8 (sem \x00) durante a extração, gravando <nome>.utf8
+TRANSCODE_UTF8 = os.getenv('TRANSCODE_UTF8', '1') == '1'
+
+# INGEST_MODE=stream lê os CSVs direto de dentro dos zips, sem extrair para o disco
+INGEST_MODE = os.getenv('INGEST_MODE', 'extract').lower()
+# Threads de leitura paralela (por intervalos de bytes) dos arquivos grandes extraídos
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', str(os.cpu_count() or 1)))
+# Tamanho do bloco das leituras em passada única (modo stream, ESTABELECIMENTO e SIMPLES)
+STREAM_BLOCK_SIZE = int(os.getenv('STREAM_BLOCK_SIZE', str(64 * 1024 * 1024)))
+# Formato do COPY usado por to_sql: csv (padrão) ou binary
+COPY_FORMAT = os.getenv('COPY_FORMAT', 'csv').lower()
+# Conexões de escrita em paralelo na carga das tabelas
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', '4'))
+# Consolidação: postgres (lê as tabelas brutas de volta do banco) ou files (junta as
+# partições em Parquet gravadas durante a carga, em CONSOLIDATE_DIR)
+CONSOLIDATE_MODE = os.getenv('CONSOLIDATE_MODE', 'postgres').lower()
+CONSOLIDATE_PARTITIONS = int(os.getenv('CONSOLIDATE_PARTITIONS', '16'))
+CONSOLIDATE_DIR = os.getenv('CONSOLIDATE_DIR') or os.path.join(extracted_files, '_particoes')
+# Feed de mudanças entre gerações (cnpj_changes, ver mudancas.py). O retrato da
+# geração anterior fica em CHANGES_DIR, que precisa sobreviver entre execuções
+CHANGE_FEED = os.getenv('CHANGE_FEED', '1') == '1'
+CHANGES_DIR = os.getenv('CHANGES_DIR') or os.path.join(current_path, 'retratos')
 makedirs(output_files)
 makedirs(extracted_files)
 print(f"Diretórios definidos:\n output_files: {output_files}\n extracted_files: {extracted_files}")
@@ -152,14 +635,26 @@ port = os.getenv('DB_PORT')
 database = os.getenv('DB_NAME')
 db_schema = os.getenv('DB_SCHEMA')
 
-conn = psycopg2.connect(f"dbname={database} user={user} host={host} port={port} password={password}")
+DSN = f"dbname={database} user={user} host={host} port={port} password={password}"
+conn = psycopg2.connect(DSN)
 cur = conn.cursor()
 
 #############################################
 # Truncar tabelas existentes
 #############################################
 tables = ["empresa", "estabelecimento", "socios", "simples", "cnae", "moti", "munic", "natju", "pais", "quals"]
-truncate_tables(cur, conn, tables, db_schema)
+# LOAD_MODE=incremental: as tabelas grandes não são truncadas; a carga do mês vai
+# para <tabela>_carga e só a diferença é aplicada depois (ver incremental.py)
+recarregadas = [t for t in tables if t not in incremental.TABELAS] if incremental.ATIVO else tables
+# pessoa_id é calculado na carga de socios (ver pessoa_id.py)
+cur.execute(f'ALTER TABLE IF EXISTS "{db_schema}"."socios" ADD COLUMN IF NOT EXISTS pessoa_id UUID')
+truncate_tables(cur, conn, recarregadas, db_schema)
+# Modo de carga em massa (ver bulk_load.py): UNLOGGED e sem autovacuum até o fim da carga
+for table in recarregadas:
+    preparar_tabela(cur, db_schema, table)
+if incremental.ATIVO:
+    incremental.preparar(cur, db_schema)
+conn.commit()
 
 #############################################
 # Definindo a URL dos dados com base na última atualização
@@ -179,9 +674,18 @@ from urllib3.util.retry import Retry
 
 auth = ('gn672Ad4CF8N6TK', '')
 
+# Quantos arquivos são baixados ao mesmo tempo
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+# Teto de conexões HTTP simultâneas (somando os segmentos de todos os arquivos)
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv('DOWNLOAD_MAX_CONNECTIONS', '12'))
+# Arquivos maiores que DOWNLOAD_SEGMENT_SIZE são baixados em até DOWNLOAD_MAX_SEGMENTS partes paralelas
+DOWNLOAD_SEGMENT_SIZE = int(os.getenv('DOWNLOAD_SEGMENT_SIZE', str(128 * 1024 * 1024)))
+DOWNLOAD_MAX_SEGMENTS = int(os.getenv('DOWNLOAD_MAX_SEGMENTS', '8'))
+
 session = requests.Session()
-retries = Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504])
-session.mount('https://', HTTPAdapter(max_retries=retries))
+# 429/503 ficam fora do Retry: o downloader trata esses códigos reduzindo a concorrência
+retries = Retry(total=5, backoff_factor=2, status_forcelist=[500, 502, 504])
+session.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(10, DOWNLOAD_MAX_CONNECTIONS)))
 
 headers = {
     'Depth': '1',
@@ -200,11 +704,15 @@ root_zips = ET.fromstring(response_zips.content)
 namespaces = {'d': 'DAV:'}
 
 Files = []
+file_sizes = {}
 for node in root_zips.findall('d:response', namespaces):
     href = node.find('d:href', namespaces).text
     if href.endswith('.zip'):
         file_name = href.split('/')[-1]
         Files.append(file_name)
+        size_node = node.find('.//d:getcontentlength', namespaces)
+        if size_node is not None and size_node.text:
+            file_sizes[file_name] = int(size_node.text)
 
 print("Arquivos que serão baixados:")
 for idx, f in enumerate(Files, 1):
@@ -212,137 +720,67 @@ for idx, f in enumerate(Files, 1):
 
 headers_download = {'User-Agent': headers['User-Agent']}
 max_tentativas_download = 5
+limitador_download = LimitadorAdaptativo(DOWNLOAD_MAX_CONNECTIONS)
 
-for i_l, file_entry in enumerate(Files, 1):
+def _baixar(file_entry):
     url = dados_rf + file_entry
     file_name = os.path.join(output_files, file_entry)
-
-    if check_diff(url, file_name, auth=auth):
-        for tentativa in range(1, max_tentativas_download + 1):
-            print(f"\nBaixando arquivo {i_l} - {file_entry} (Tentativa {tentativa}/{max_tentativas_download}) ...")
-            try:
-                with session.get(url, auth=auth, headers=headers_download, stream=True, timeout=(30, 300)) as r:
-                    r.raise_for_status()
-                    total_length = int(r.headers.get('content-length', 0))
-                    downloaded = 0
-                    with open(file_name, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=1024 * 1024):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                if total_length:
-                                    percent = int(downloaded / total_length * 100)
-                                    sys.stdout.write(f"\rDownloading: {percent}% [{downloaded} / {total_length}] bytes")
-                                    sys.stdout.flush()
-                                    if downloaded >= total_length:
-                                        r.close()
-                                        break
-                    print("\nDownload concluído com sucesso!")
-                    break
-
-                    print("\n")
-                print("\nDownload concluído com sucesso!")
-                break
-            except Exception as e:
-                print(f"\nA conexão caiu ou travou durante o download: {e}")
-                if tentativa == max_tentativas_download:
-                    print(f"Limite de tentativas atingido. Pulando o arquivo {file_entry}.")
-                    etl_status = f'Falha no arquivo {file_entry}'
-                else:
-                    tempo_espera = random.randint(5, 120)
-                    print(f"Aguardando {tempo_espera} segundos antes de recomeçar o download desse arquivo...")
-                    time.sleep(tempo_espera)
-    else:
-        print(f"\nO arquivo {i_l} - {file_entry} já existe e está completo. Pulando o download.")
+    total_length = file_sizes.get(file_entry) or tamanho_remoto(session, url, auth=auth, headers=headers_download)
+    return baixar_com_tentativas(session, url, file_name, total_length, limitador_download,
+                                 auth=auth, headers=headers_download, max_tentativas=max_tentativas_download,
+                                 tamanho_segmento=DOWNLOAD_SEGMENT_SIZE, max_segmentos=DOWNLOAD_MAX_SEGMENTS)
 
 #############################################
-# Extração dos arquivos .zip baixados
+# Carga de cada tipo de arquivo
 #############################################
-for i_l, file_entry in enumerate(Files, 1):
-    try:
-        print(f"Descompactando arquivo {i_l} - {file_entry}")
-        full_path = os.path.join(output_files, file_entry)
-        with zipfile.ZipFile(full_path, 'r') as zip_ref:
-            zip_ref.extractall(extracted_files)
-    except Exception as e:
-        print(f"Erro ao descompactar {file_entry}: {e}")
+# Escrita de uma parte numa das conexões da CargaParalela
+def escrever(df, table_name, conn):
+    to_sql(df, table_name, conn, db_schema)
+
+# Colunas de cada tabela usadas na consolidação (gravadas nas partições no modo files)
+COLUNAS_CONSOLIDACAO = {
+    'empresa': ['cnpj_basico', 'razao_social', 'natureza_juridica', 'capital_social', 'porte_empresa'],
+    'simples': ['cnpj_basico', 'opcao_pelo_simples', 'data_opcao_simples', 'opcao_mei', 'data_opcao_mei'],
+    'estabelecimento': [
+        'cnpj_basico', 'cnpj_ordem', 'cnpj_dv', 'nome_fantasia',
+        'situacao_cadastral', 'data_situacao_cadastral', 'motivo_situacao_cadastral', 'data_inicio_atividade',
+        'cnae_fiscal_principal', 'identificador_matriz_filial',
+        'logradouro', 'numero', 'complemento', 'bairro', 'cep',
+        'uf', 'municipio', 'ddd_1', 'telefone_1', 'correio_eletronico',
+    ],
+    'cnae': ['codigo', 'descricao'],
+    'natju': ['codigo', 'descricao'],
+    'munic': ['codigo', 'descricao'],
+}
 
-#############################################
-# Classificação dos arquivos extraídos
-#############################################
-Items = [name for name in os.listdir(extracted_files) if os.path.isfile(os.path.join(extracted_files, name))]
-arquivos_empresa = []
-arquivos_estabelecimento = []
-arquivos_socios = []
-arquivos_simples = []
-arquivos_cnae = []
-arquivos_moti = []
-arquivos_munic = []
-arquivos_natju = []
-arquivos_pais = []
-arquivos_quals = []
-
-for item in Items:
-    if "EMPRE" in item:
-        arquivos_empresa.append(item)
-    elif "ESTABELE" in item:
-        arquivos_estabelecimento.append(item)
-    elif "SOCIO" in item:
-        arquivos_socios.append(item)
-    elif "SIMPLES" in item:
-        arquivos_simples.append(item)
-    elif "CNAE" in item:
-        arquivos_cnae.append(item)
-    elif "MOTI" in item:
-        arquivos_moti.append(item)
-    elif "MUNIC" in item:
-        arquivos_munic.append(item)
-    elif "NATJU" in item:
-        arquivos_natju.append(item)
-    elif "PAIS" in item:
-        arquivos_pais.append(item)
-    elif "QUALS" in item:
-        arquivos_quals.append(item)
+particoes = None
+if CONSOLIDATE_MODE == 'files' and not incremental.ATIVO:
+    particoes = Particoes(CONSOLIDATE_DIR, CONSOLIDATE_PARTITIONS, COLUNAS_CONSOLIDACAO)
+
+feed = FeedDeMudancas(CHANGES_DIR) if CHANGE_FEED else None
+
+def enviar(carga, df, tabela):
+    """Envia a parte para a carga e, no modo files, grava também nas partições da consolidação."""
+    if particoes is not None:
+        particoes.gravar(tabela, df)
+    if feed is not None:
+        feed.gravar(tabela, df)
+    carga.enviar(df, incremental.tabela_de_carga(tabela))
 
-#############################################
-# Processamento dos Arquivos de EMPRESA
-#############################################
-empresa_insert_start = time.time()
-print("\n#######################\n## Arquivos de EMPRESA:\n#######################")
 EMPRESA_COLS = ['cnpj_basico', 'razao_social', 'natureza_juridica',
                 'qualificacao_responsavel', 'capital_social', 'porte_empresa',
                 'ente_federativo_responsavel']
 
-for arquivo in arquivos_empresa:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    empresa = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=EMPRESA_COLS,
-    )
-    empresa = empresa.with_columns([
-        pl.col('natureza_juridica').cast(pl.Int32, strict=False),
-        pl.col('qualificacao_responsavel').cast(pl.Int32, strict=False),
-        pl.col('porte_empresa').cast(pl.Int32, strict=False),
-        pl.col('capital_social').str.replace(',', '.', literal=True).cast(pl.Float64, strict=False),
-    ])
-    to_sql(empresa, 'empresa', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del empresa
-
-empresa_insert_end = time.time()
-print("Tempo de execução do processo de EMPRESA (segundos):", round(empresa_insert_end - empresa_insert_start))
-
-#############################################
-# Processamento dos Arquivos de ESTABELECIMENTO
-#############################################
-estabelecimento_insert_start = time.time()
-print("\n###############################\n## Arquivos de ESTABELECIMENTO:\n###############################")
-print(f"Tem {len(arquivos_estabelecimento)} arquivos de estabelecimento!")
+def carregar_empresa(arquivo, carga):
+    for empresa in ler_arquivo_paralelo(arquivo, EMPRESA_COLS):
+        empresa = empresa.with_columns([
+            pl.col('natureza_juridica').cast(pl.Int32, strict=False),
+            pl.col('qualificacao_responsavel').cast(pl.Int32, strict=False),
+            pl.col('porte_empresa').cast(pl.Int32, strict=False),
+            pl.col('capital_social').str.replace(',', '.', literal=True).cast(pl.Float64, strict=False),
+        ])
+        enviar(carga, empresa, 'empresa')
+        del empresa
 
 ESTAB_COLS = ['cnpj_basico', 'cnpj_ordem', 'cnpj_dv', 'identificador_matriz_filial',
               'nome_fantasia', 'situacao_cadastral', 'data_situacao_cadastral',
@@ -359,97 +797,37 @@ ESTAB_INT_COLS = ['identificador_matriz_filial', 'situacao_cadastral', 'data_sit
 
 NROWS = 250_000
 
-for arquivo in arquivos_estabelecimento:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    
-    skip = 0
-    part = 0
-    while True:
-        # Usamos o read_csv puro, mas com n_threads=1 para evitar erro de UTF-8
-        # e n_rows para controlar a memória.
-        try:
-            chunk = pl.read_csv(
-                extracted_file_path,
-                separator=';',
-                has_header=False,
-                encoding='latin1',         # Latin1 é mais resiliente no read_csv puro
-                infer_schema_length=0,
-                new_columns=ESTAB_COLS,
-                n_rows=NROWS,
-                skip_rows=skip,
-                truncate_ragged_lines=True, # Pula colunas extras se a linha estiver suja
-                n_threads=1                 # <--- O SEGREDO: evita o erro de 'invalid utf-8'
-            )
-        except Exception as e:
-            print(f"Erro ao ler chunk na linha {skip}: {e}")
-            break
-
-        if chunk.is_empty():
-            break
-
+def carregar_estabelecimento(arquivo, carga):
+    # Leitura paralela por intervalos de bytes (sem skip_rows); truncate_ragged_lines
+    # pula colunas extras se a linha estiver suja
+    chunks = ler_arquivo_paralelo(arquivo, ESTAB_COLS, n_rows=NROWS, truncate_ragged_lines=True)
+    for part, chunk in enumerate(chunks):
         # Conversão de tipos
         chunk = chunk.with_columns([
             pl.col(c).cast(pl.Int32, strict=False) for c in ESTAB_INT_COLS
         ])
 
-        # Insere no SQL
-        to_sql(chunk, 'estabelecimento', conn, db_schema)
-        print(f"Arquivo {arquivo} / parte {part} inserida com sucesso!")
-
-        # Atualiza ponteiros
-        skip += NROWS
-        part += 1
-
-        # Se o chunk veio menor que o NROWS, chegamos ao fim do arquivo
-        if len(chunk) < NROWS:
-            del chunk
-            break
-            
+        # Enfileira para as conexões de escrita
+        enviar(carga, chunk, 'estabelecimento')
+        print(f"Arquivo {nome_da_fonte(arquivo)} / parte {part} enviada para a carga!")
         del chunk
         gc.collect()
 
-estabelecimento_insert_end = time.time()
-print("Tempo total ESTABELECIMENTO:", round(estabelecimento_insert_end - estabelecimento_insert_start))
-
-#############################################
-# Processamento dos Arquivos de SÓCIOS
-#############################################
-socios_insert_start = time.time()
-print("\n######################\n## Arquivos de SÓCIOS:\n######################")
-
 SOCIOS_COLS = ['cnpj_basico', 'identificador_socio', 'nome_socio_razao_social', 'cpf_cnpj_socio',
                'qualificacao_socio', 'data_entrada_sociedade', 'pais', 'representante_legal',
                'nome_do_representante', 'qualificacao_representante_legal', 'faixa_etaria']
 
 SOCIOS_INT_COLS = ['identificador_socio', 'qualificacao_socio', 'qualificacao_representante_legal', 'faixa_etaria']
 
-for arquivo in arquivos_socios:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    socios = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=SOCIOS_COLS,
-    )
-    socios = socios.with_columns([
-        pl.col(c).cast(pl.Int32, strict=False) for c in SOCIOS_INT_COLS
-    ])
-    to_sql(socios, 'socios', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del socios
-
-socios_insert_end = time.time()
-print("Tempo de execução do processo de SÓCIOS (segundos):", round(socios_insert_end - socios_insert_start))
-
-#############################################
-# Processamento dos Arquivos do SIMPLES NACIONAL
-#############################################
-simples_insert_start = time.time()
-print("\n################################\n## Arquivos do SIMPLES NACIONAL:\n################################")
+def carregar_socios(arquivo, carga):
+    for socios in ler_arquivo_paralelo(arquivo, SOCIOS_COLS):
+        socios = socios.with_columns([
+            pl.col(c).cast(pl.Int32, strict=False) for c in SOCIOS_INT_COLS
+        ])
+        # pessoa_id vai no próprio COPY: build_pessoas.py não precisa de UPDATE em socios
+        socios = com_pessoa_id(socios)
+        enviar(carga, socios, 'socios')
+        del socios
 
 SIMPLES_COLS = ['cnpj_basico', 'opcao_pelo_simples', 'data_opcao_simples',
                 'data_exclusao_simples', 'opcao_mei', 'data_opcao_mei', 'data_exclusao_mei']
@@ -458,317 +836,349 @@ SIMPLES_INT_COLS = ['data_opcao_simples', 'data_exclusao_simples', 'data_opcao_m
 
 NROWS_SIMPLES = 50_000
 
-for arquivo in arquivos_simples:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    skip = 0
-    part = 0
-    while True:
-        chunk = pl.read_csv(
-            extracted_file_path,
-            separator=';',
-            has_header=False,
-            encoding='latin1',
-            infer_schema_length=0,
-            new_columns=SIMPLES_COLS,
-            n_rows=NROWS_SIMPLES,
-            skip_rows=skip,
-        )
-        if chunk.is_empty():
-            break
+def carregar_simples(arquivo, carga):
+    for part, chunk in enumerate(ler_arquivo_paralelo(arquivo, SIMPLES_COLS, n_rows=NROWS_SIMPLES)):
         chunk = chunk.with_columns([
             pl.col(c).cast(pl.Int32, strict=False) for c in SIMPLES_INT_COLS
         ])
-        to_sql(chunk, 'simples', conn, db_schema)
-        print(f"Arquivo {arquivo} parte {part + 1} inserida com sucesso!")
-        skip += NROWS_SIMPLES
-        part += 1
-        if len(chunk) < NROWS_SIMPLES:
-            del chunk
-            break
+        enviar(carga, chunk, 'simples')
+        print(f"Arquivo {nome_da_fonte(arquivo)} parte {part + 1} enviada para a carga!")
         del chunk
 
-simples_insert_end = time.time()
-print("Tempo de execução do processo do SIMPLES (segundos):", round(simples_insert_end - simples_insert_start))
-
-#############################################
-# Processamento dos Arquivos de CNAE
-#############################################
-cnae_insert_start = time.time()
-print("\n######################\n## Arquivos de CNAE:\n######################")
-for arquivo in arquivos_cnae:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    cnae = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=['codigo', 'descricao'],
-    )
-    to_sql(cnae, 'cnae', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del cnae
-
-cnae_insert_end = time.time()
-print("Tempo de execução do processo de CNAE (segundos):", round(cnae_insert_end - cnae_insert_start))
-
-#############################################
-# Processamento dos Arquivos de MOTIVOS (MOTI)
-#############################################
-moti_insert_start = time.time()
-print("\n#########################################\n## Arquivos de MOTIVOS:\n#########################################")
-for arquivo in arquivos_moti:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    moti = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=['codigo', 'descricao'],
-    )
-    moti = moti.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
-    to_sql(moti, 'moti', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del moti
-
-moti_insert_end = time.time()
-print("Tempo de execução do processo de MOTI (segundos):", round(moti_insert_end - moti_insert_start))
-
-#############################################
-# Processamento dos Arquivos de MUNICÍPIOS (MUNIC)
-#############################################
-munic_insert_start = time.time()
-print("\n##########################\n## Arquivos de MUNICÍPIOS:\n##########################")
-for arquivo in arquivos_munic:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    munic = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=['codigo', 'descricao'],
-    )
-    munic = munic.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
-    to_sql(munic, 'munic', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del munic
-
-munic_insert_end = time.time()
-print("Tempo de execução do processo de MUNICÍPIOS (segundos):", round(munic_insert_end - munic_insert_start))
-
-#############################################
-# Processamento dos Arquivos de NATUREZA JURÍDICA (NATJU)
-#############################################
-natju_insert_start = time.time()
-print("\n#################################\n## Arquivos de NATUREZA JURÍDICA:\n#################################")
-for arquivo in arquivos_natju:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    natju = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=['codigo', 'descricao'],
-    )
-    natju = natju.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
-    to_sql(natju, 'natju', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del natju
-
-natju_insert_end = time.time()
-print("Tempo de execução do processo de NATUREZA JURÍDICA (segundos):", round(natju_insert_end - natju_insert_start))
-
-#############################################
-# Processamento dos Arquivos de PAÍS
-#############################################
-pais_insert_start = time.time()
-print("\n######################\n## Arquivos de PAÍS:\n######################")
-for arquivo in arquivos_pais:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    pais = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=['codigo', 'descricao'],
-    )
-    pais = pais.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
-    to_sql(pais, 'pais', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del pais
+def carregador_de_referencia(tabela, codigo_inteiro=True):
+    """Carga das tabelas de códigos (codigo;descricao): CNAE, MOTI, MUNIC, NATJU, PAIS, QUALS."""
+    def carregar(arquivo, carga):
+        for df in ler_arquivo(arquivo, ['codigo', 'descricao']):
+            if codigo_inteiro:
+                df = df.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
+            enviar(carga, df, tabela)
+            del df
+    return carregar
+
+# Trecho do nome do arquivo → (tabela, função de carga), na ordem em que é testado
+CARGAS = [
+    ("EMPRE", 'empresa', carregar_empresa),
+    ("ESTABELE", 'estabelecimento', carregar_estabelecimento),
+    ("SOCIO", 'socios', carregar_socios),
+    ("SIMPLES", 'simples', carregar_simples),
+    ("CNAE", 'cnae', carregador_de_referencia('cnae', codigo_inteiro=False)),
+    ("MOTI", 'moti', carregador_de_referencia('moti')),
+    ("MUNIC", 'munic', carregador_de_referencia('munic')),
+    ("NATJU", 'natju', carregador_de_referencia('natju')),
+    ("PAIS", 'pais', carregador_de_referencia('pais')),
+    ("QUALS", 'quals', carregador_de_referencia('quals')),
+]
 
-pais_insert_end = time.time()
-print("Tempo de execução do processo de PAÍS (segundos):", round(pais_insert_end - pais_insert_start))
+def tabela_do_arquivo(item):
+    """(tabela, função de carga) do arquivo extraído ou (zip, membro), ou (None, None)."""
+    nome = item[1] if isinstance(item, tuple) else os.path.basename(item)
+    for trecho, tabela, carregar in CARGAS:
+        if trecho in nome:
+            return tabela, carregar
+    return None, None
 
 #############################################
-# Processamento dos Arquivos de QUALIFICAÇÃO DE SÓCIOS (QUALS)
+# Download, extração e carga em pipeline
 #############################################
-quals_insert_start = time.time()
-print("\n######################################\n## Arquivos de QUALIFICAÇÃO DE SÓCIOS:\n######################################")
-for arquivo in arquivos_quals:
-    print(f"Trabalhando no arquivo: {arquivo} [...]")
-    extracted_file_path = os.path.join(extracted_files, arquivo)
-    quals = pl.read_csv(
-        extracted_file_path,
-        separator=';',
-        has_header=False,
-        encoding='latin1',
-        infer_schema_length=0,
-        new_columns=['codigo', 'descricao'],
-    )
-    quals = quals.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
-    to_sql(quals, 'quals', conn, db_schema)
-    print(f"Arquivo {arquivo} inserido com sucesso no banco de dados!")
-    del quals
-
-quals_insert_end = time.time()
-print("Tempo de execução do processo de QUALIFICAÇÃO DE SÓCIOS (segundos):", round(quals_insert_end - quals_insert_start))
+# Cada arquivo segue para a extração assim que termina de baixar e para a carga
+# assim que termina de extrair: as tabelas pequenas e as EMPRESAS são carregadas
+# enquanto os ESTABELECIMENTOS ainda estão sendo baixados.
+# Quantos arquivos já extraídos podem aguardar a carga (limita o disco ocupado)
+PIPELINE_QUEUE = int(os.getenv('PIPELINE_QUEUE', '4'))
+
+fila_carga = queue.Queue(maxsize=PIPELINE_QUEUE)
+falhas_download = []
+relatorio_extracao = []
+erros_extracao = []
+
+def membros_do_zip(file_entry):
+    """Itens (caminho do zip, membro) para o modo stream."""
+    full_path = os.path.join(output_files, file_entry)
+    with zipfile.ZipFile(full_path, 'r') as zip_ref:
+        return [(full_path, membro) for membro in zip_ref.namelist() if not membro.endswith('/')]
+
+def agendar(pool_extracao):
+    """
+    Thread que baixa, extrai e coloca na fila_carga (file_entry, itens) de cada
+    arquivo pronto. Termina com None na fila, ou com a exceção se algo quebrar.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool_download:
+            pendentes = {pool_download.submit(_baixar, f): ('download', f) for f in Files}
+            while pendentes:
+                prontos, _ = wait(pendentes, return_when=FIRST_COMPLETED)
+                for futuro in prontos:
+                    etapa, file_entry = pendentes.pop(futuro)
+                    if etapa == 'download':
+                        if futuro.result() is not None:
+                            falhas_download.append(file_entry)
+                            continue
+                        print(f"Baixado {file_entry}", flush=True)
+                        if pool_extracao is None:
+                            try:
+                                itens = membros_do_zip(file_entry)
+                            except Exception as e:
+                                print(f"Erro ao abrir {file_entry}: {e}", flush=True)
+                                erros_extracao.append((file_entry, str(e)))
+                                continue
+                            fila_carga.put((file_entry, itens))
+                        else:
+                            zip_path = os.path.join(output_files, file_entry)
+                            futuro_extracao = pool_extracao.submit(descompactar, zip_path, extracted_files, TRANSCODE_UTF8)
+                            pendentes[futuro_extracao] = ('extracao', file_entry)
+                    else:
+                        try:
+                            total, segundos, itens = futuro.result()
+                        except Exception as e:
+                            print(f"Erro ao descompactar {file_entry}: {e}", flush=True)
+                            erros_extracao.append((file_entry, str(e)))
+                            continue
+                        relatorio_extracao.append((file_entry, total, segundos))
+                        print(f"Descompactado {file_entry} ({round(segundos)}s)", flush=True)
+                        # Espera se a carga estiver atrasada (fila limitada)
+                        fila_carga.put((file_entry, itens))
+    except BaseException as e:
+        fila_carga.put(e)
+        return
+    fila_carga.put(None)
+
+if INGEST_MODE == 'stream':
+    print("\nINGEST_MODE=stream: os arquivos serão lidos direto dos .zip, sem extração.")
+    pool_extracao = None
+else:
+    print(f"\nDescompactando com {EXTRACT_WORKERS} processos"
+          + (" (convertendo para UTF-8)" if TRANSCODE_UTF8 else ""))
+    pool_extracao = pool_de_processos(EXTRACT_WORKERS)
+    # Com fork, todos os processos do pool são criados na primeira tarefa: faz isso
+    # agora, antes de existirem as threads de download e de carga
+    pool_extracao.submit(os.getpid).result()
+
+insert_start = time.time()
+print(f"\nBaixando {len(Files)} arquivos com até {DOWNLOAD_WORKERS} downloads simultâneos; "
+      f"cada arquivo é extraído e carregado assim que fica pronto...")
+threading.Thread(target=agendar, args=(pool_extracao,), daemon=True).start()
+
+tempo_por_tabela = {}
+with CargaParalela(DSN, None, escrever, LOAD_WORKERS) as carga:
+    while True:
+        pronto = fila_carga.get()
+        if pronto is None:
+            break
+        if isinstance(pronto, BaseException):
+            raise pronto
+        file_entry, itens = pronto
+        for arquivo in itens:
+            tabela, carregar = tabela_do_arquivo(arquivo)
+            if carregar is None:
+                continue
+            t0 = time.time()
+            print(f"Trabalhando no arquivo: {nome_da_fonte(arquivo)} ({tabela}) [...]")
+            carregar(arquivo, carga)
+            tempo_por_tabela[tabela] = tempo_por_tabela.get(tabela, 0) + time.time() - t0
+            print(f"Arquivo {nome_da_fonte(arquivo)} enviado para a carga!")
+
+if pool_extracao is not None:
+    pool_extracao.shutdown()
+
+print("\nTempo de leitura por tabela (segundos):")
+for tabela, segundos in tempo_por_tabela.items():
+    print(f"  {tabela:<16} {round(segundos):>6}")
+
+if falhas_download:
+    etl_status = f'Falha no arquivo {falhas_download[-1]}'
+
+if relatorio_extracao:
+    print("\nRelatório da extração:")
+    print(f"  {'arquivo':<28} {'MB':>9} {'seg':>6} {'MB/s':>7}")
+    for file_entry, total, segundos in sorted(relatorio_extracao, key=lambda r: -r[2]):
+        mb = total / 1024 / 1024
+        print(f"  {file_entry:<28} {mb:>9.1f} {segundos:>6.0f} {mb / max(segundos, 0.001):>7.1f}")
+
+if erros_extracao:
+    print(f"\n{len(erros_extracao)} arquivo(s) com erro na extração:")
+    for file_entry, erro in erros_extracao:
+        print(f"  {file_entry}: {erro}")
+        # Remove o zip corrompido para que a próxima execução baixe de novo
+        for caminho in (os.path.join(output_files, file_entry), os.path.join(output_files, file_entry + '.origem')):
+            if os.path.isfile(caminho):
+                os.remove(caminho)
+    etl_status = f"Falha na extração: {', '.join(f for f, _ in erros_extracao)}"[:50]
 
 #############################################
 # Finalizando a carga e informando o tempo total
 #############################################
 insert_end = time.time()
-Tempo_insert = round(insert_end - empresa_insert_start)
+Tempo_insert = round(insert_end - insert_start)
 print("\n#############################################")
 print("## Processo de carga dos arquivos finalizado!")
 print(f"Tempo total de execução do processo (segundos): {Tempo_insert}")
 
+if incremental.ATIVO:
+    print("\n## Aplicando a diferença para a geração anterior...")
+    diff_start = time.time()
+    for table in incremental.TABELAS:
+        apagadas, inseridas = incremental.aplicar(conn, db_schema, table)
+        print(f"  {table:<16} -{apagadas:,} +{inseridas:,}", flush=True)
+    print(f"cnpj_basico alterados: {incremental.contar_alterados(cur, db_schema):,} "
+          f"({round(time.time() - diff_start)}s)")
+
+#############################################
+# Feed de mudanças (cnpj_changes): retrato desta geração × anterior
+#############################################
+if feed is not None:
+    referencia = dados_rf.strip('/').split('/')[-1]
+    if etl_status != 'Sucesso':
+        # Retrato incompleto geraria remoções falsas: fica valendo o anterior
+        print("\nCarga incompleta: feed de mudanças não gerado.")
+        feed.descartar()
+    elif not feed.tem_anterior():
+        print("\nFeed de mudanças: primeira geração, só o retrato foi gravado.")
+        feed.girar()
+    else:
+        print(f"\n## Gerando feed de mudanças ({referencia})...")
+        mudancas_start = time.time()
+        criar_tabela_de_mudancas(cur, db_schema)
+        cur.execute(f'DELETE FROM "{db_schema}"."cnpj_changes" WHERE referencia = %s', (referencia,))
+        conn.commit()
+        total_eventos = 0
+        with CargaParalela(DSN, 'cnpj_changes', escrever, LOAD_WORKERS) as carga_mudancas:
+            for eventos in feed.comparar(referencia):
+                for parte in em_partes(eventos, 500_000):
+                    carga_mudancas.enviar(parte)
+                total_eventos += eventos.height
+        feed.girar()
+        print(f"cnpj_changes: {total_eventos:,} eventos em {round(time.time() - mudancas_start)}s")
+
 #############################################
 # Criação de índices nas tabelas
 #############################################
 index_start = time.time()
-cur.execute(f"""
-    CREATE INDEX IF NOT EXISTS empresa_cnpj ON "{db_schema}"."empresa"(cnpj_basico);
-    CREATE INDEX IF NOT EXISTS estabelecimento_cnpj ON "{db_schema}"."estabelecimento"(cnpj_basico);
-    CREATE INDEX IF NOT EXISTS socios_cnpj ON "{db_schema}"."socios"(cnpj_basico);
-    CREATE INDEX IF NOT EXISTS simples_cnpj ON "{db_schema}"."simples"(cnpj_basico);
-""")
-conn.commit()
+with configuracao_de_carga(conn):
+    # Volta as tabelas recarregadas para LOGGED e congela/analisa antes dos índices;
+    # as de incremental.TABELAS não saíram do modo normal, só mudaram por aplicar()
+    for table in recarregadas:
+        finalizar_tabela(conn, db_schema, table)
+    if incremental.ATIVO:
+        for table in incremental.TABELAS:
+            cur.execute(f'ANALYZE "{db_schema}"."{table}"')
+        conn.commit()
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS empresa_cnpj ON "{db_schema}"."empresa"(cnpj_basico);
+        CREATE INDEX IF NOT EXISTS estabelecimento_cnpj ON "{db_schema}"."estabelecimento"(cnpj_basico);
+        CREATE INDEX IF NOT EXISTS socios_cnpj ON "{db_schema}"."socios"(cnpj_basico);
+        CREATE INDEX IF NOT EXISTS idx_socios_pessoa_id ON "{db_schema}"."socios"(pessoa_id);
+        CREATE INDEX IF NOT EXISTS simples_cnpj ON "{db_schema}"."simples"(cnpj_basico);
+    """)
+    conn.commit()
 index_end = time.time()
 print("Índices criados nas tabelas (empresa, estabelecimento, socios, simples).")
 print("Tempo para criar os índices (segundos):", round(index_end - index_start))
 
 #############################################
 # Consolidação: popula cnpj_consolidado via Polars (JOIN em memória)
-# Estratégia: carrega lookup tables no Polars, faz stream de estabelecimento
-# via server-side cursor (sem OFFSET), JOIN no Python. ~20min vs dias no SQL.
+# CONSOLIDATE_MODE=postgres: carrega as lookups no Polars por COPY TO STDOUT e
+# lê estabelecimento do banco em fluxo. CONSOLIDATE_MODE=files: junta, uma
+# partição de cnpj_basico por vez, os Parquet gravados durante a carga, sem
+# ler as tabelas brutas de volta do banco. ~20min vs dias no SQL.
 #############################################
-print("\n#############################################")
-print("## Populando tabela cnpj_consolidado (Polars + streaming)...")
-consolidado_start = time.time()
-
-DSN = f"dbname={database} user={user} host={host} port={port} password={password}"
-
-# Cria staging para swap zero-downtime (cnpj_consolidado nunca fica vazia)
-cur.execute(f'DROP TABLE IF EXISTS "{db_schema}"."cnpj_consolidado_new";')
-cur.execute(f'CREATE TABLE "{db_schema}"."cnpj_consolidado_new" (LIKE "{db_schema}"."cnpj_consolidado" INCLUDING DEFAULTS);')
-conn.commit()
+if incremental.ATIVO:
+    # Só as linhas dos cnpj_basico alterados; índices e tabela continuam os mesmos
+    print("\n#############################################")
+    print("## Atualizando cnpj_consolidado (modo incremental)...")
+    consolidado_start = time.time()
+    apagadas, inseridas = incremental.atualizar_cnpj_consolidado(conn, db_schema)
+    print(f"cnpj_consolidado: -{apagadas:,} +{inseridas:,} em {round(time.time() - consolidado_start)}s")
+else:
+    print("\n#############################################")
+    print(f"## Populando tabela cnpj_consolidado (Polars, modo {CONSOLIDATE_MODE})...")
+    consolidado_start = time.time()
+
+    # Cria staging para swap zero-downtime (cnpj_consolidado nunca fica vazia)
+    cur.execute(f'DROP TABLE IF EXISTS "{db_schema}"."cnpj_consolidado_new";')
+    criar_tabela_de_carga(cur, db_schema, 'cnpj_consolidado_new', definicao_da_tabela(cur, db_schema))
+    conn.commit()
 
-def fetch_lookup(conn, name, query, chunk_size=1_000_000):
-    """Carrega tabela de lookup no Polars via server-side cursor (baixo pico de RAM).
-    Nota: com cursores nomeados (server-side) do psycopg2, cursor.description só é
-    populado após o primeiro fetchmany() — não acessar antes disso.
-    """
-    parts = []
-    cols = None
-    with conn.cursor(f'lookup_{name}') as lc:
-        lc.execute(query)
+    def ler_consulta(conn, query):
+        """
+        Gera DataFrames com o resultado de `query` via COPY TO STDOUT (ver pg_copy.py):
+        o CSV é cortado em blocos de STREAM_BLOCK_SIZE bytes terminados em fim de
+        registro e cada bloco vai direto para o parser do Polars, com o schema tipado
+        das colunas da consulta.
+        """
+        schema = tipos_da_consulta(conn, query)
+        with copia_de_saida(conn, query) as stream:
+            for bloco in iter_blocos_csv(stream, STREAM_BLOCK_SIZE, converter=False):
+                yield pl.read_csv(bloco, has_header=False, schema=schema)
+        conn.commit()
+
+    def fetch_lookup(conn, name, query):
+        """Carrega tabela de lookup no Polars via COPY TO STDOUT (sem objetos Python por linha)."""
+        parts = list(ler_consulta(conn, query))
+        if not parts:
+            return pl.DataFrame(schema=tipos_da_consulta(conn, query))
+        df = pl.concat(parts, rechunk=True)
+        del parts
+        gc.collect()
+        print(f"  {name}: {len(df):,} linhas", flush=True)
+        return df
+
+    def em_segundo_plano(gerador, tamanho_fila=2):
+        """
+        Consome `gerador` numa thread, deixando até `tamanho_fila` itens prontos à
+        frente de quem lê. Uma exceção do gerador é relançada no leitor.
+        """
+        fila = queue.Queue(maxsize=tamanho_fila)
+        fim = object()
+
+        def produzir():
+            try:
+                for item in gerador:
+                    fila.put(item)
+            except BaseException as e:
+                fila.put(e)
+                return
+            fila.put(fim)
+
+        threading.Thread(target=produzir, daemon=True).start()
         while True:
-            rows = lc.fetchmany(chunk_size)
-            if not rows:
-                break
-            if cols is None:
-                cols = [d[0] for d in lc.description]
-            data = {col: [r[i] for r in rows] for i, col in enumerate(cols)}
-            parts.append(pl.DataFrame(data))
-            del rows, data
-    conn.commit()  # fecha o server-side cursor
-    if not parts:
-        return pl.DataFrame()
-    df = pl.concat(parts)
-    del parts
-    gc.collect()
-    print(f"  {name}: {len(df):,} linhas", flush=True)
-    return df
-
-print("Carregando lookups na memória (Polars)...")
-lookup_start = time.time()
-
-empresa_df = fetch_lookup(conn, 'empresa', f'SELECT cnpj_basico, razao_social, natureza_juridica, capital_social, porte_empresa FROM "{db_schema}"."empresa"')
-simples_df = fetch_lookup(conn, 'simples', f'SELECT cnpj_basico, opcao_pelo_simples, data_opcao_simples, opcao_mei, data_opcao_mei FROM "{db_schema}"."simples"')
-cnae_df    = fetch_lookup(conn, 'cnae',    f'SELECT codigo, descricao FROM "{db_schema}"."cnae"')
-natju_df   = fetch_lookup(conn, 'natju',   f'SELECT codigo, descricao FROM "{db_schema}"."natju"')
-munic_df   = fetch_lookup(conn, 'munic',   f'SELECT codigo, descricao FROM "{db_schema}"."munic"')
-
-# Normaliza chaves de JOIN para Utf8
-empresa_df = empresa_df.with_columns([
-    pl.col('cnpj_basico').cast(pl.Utf8),
-    pl.col('natureza_juridica').cast(pl.Utf8),
-])
-simples_df = simples_df.with_columns(pl.col('cnpj_basico').cast(pl.Utf8))
-cnae_df    = cnae_df.rename({'codigo': 'cnae_fiscal_principal', 'descricao': 'desc_cnae_principal'}).with_columns(pl.col('cnae_fiscal_principal').cast(pl.Utf8))
-natju_df   = natju_df.rename({'codigo': 'natureza_juridica', 'descricao': 'desc_natureza_juridica'}).with_columns(pl.col('natureza_juridica').cast(pl.Utf8))
-munic_df   = munic_df.rename({'codigo': 'municipio', 'descricao': 'nome_municipio'}).with_columns(pl.col('municipio').cast(pl.Utf8))
-
-print(f"Lookups prontos em {round(time.time()-lookup_start)}s")
-
-# Conexão separada para escrita (COPY) — conn não pode commitar durante o cursor de leitura
-conn_write = psycopg2.connect(DSN)
-
-ESTAB_COLS = [
-    'cnpj_basico', 'cnpj_ordem', 'cnpj_dv', 'nome_fantasia',
-    'situacao_cadastral', 'data_situacao_cadastral', 'motivo_situacao_cadastral', 'data_inicio_atividade',
-    'cnae_fiscal_principal', 'identificador_matriz_filial',
-    'logradouro', 'numero', 'complemento', 'bairro', 'cep',
-    'uf', 'municipio', 'ddd_1', 'telefone_1', 'correio_eletronico',
-]
-FINAL_COLS = [
-    'cnpj', 'cnpj_basico', 'razao_social', 'nome_fantasia',
-    'situacao_cadastral', 'data_situacao_cadastral', 'motivo_situacao_cadastral', 'data_inicio_atividade',
-    'cnae_fiscal_principal', 'desc_cnae_principal',
-    'natureza_juridica', 'desc_natureza_juridica',
-    'capital_social', 'porte_empresa',
-    'opcao_pelo_simples', 'data_opcao_simples',
-    'opcao_mei', 'data_opcao_mei',
-    'identificador_mf',
-    'logradouro', 'numero', 'complemento', 'bairro', 'cep',
-    'uf', 'municipio', 'nome_municipio',
-    'ddd_1', 'telefone_1', 'correio_eletronico',
-]
-
-CHUNK_SIZE = 50_000
-chunk_num = 0
-total_inserted = 0
-
-# Server-side cursor: stream sem OFFSET, PostgreSQL mantém posição
-with conn.cursor('estab_stream') as sc:
-    sc.itersize = CHUNK_SIZE
-    sc.execute(f'SELECT {", ".join(ESTAB_COLS)} FROM "{db_schema}"."estabelecimento"')
-
-    while True:
-        rows = sc.fetchmany(CHUNK_SIZE)
-        if not rows:
-            break
-
-        chunk_num += 1
-        t0 = time.time()
-
-        chunk_df = pl.DataFrame(
-            {col: [r[i] for r in rows] for i, col in enumerate(ESTAB_COLS)}
+            item = fila.get()
+            if item is fim:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def normalizar_lookups(empresa_df, simples_df, cnae_df, natju_df, munic_df):
+        """Chaves de JOIN em Utf8 e colunas das tabelas de códigos com o nome do consolidado.
+        Aceita DataFrames ou LazyFrames."""
+        empresa_df = empresa_df.with_columns([
+            pl.col('cnpj_basico').cast(pl.Utf8),
+            pl.col('natureza_juridica').cast(pl.Utf8),
+        ])
+        simples_df = simples_df.with_columns(pl.col('cnpj_basico').cast(pl.Utf8))
+        cnae_df    = cnae_df.rename({'codigo': 'cnae_fiscal_principal', 'descricao': 'desc_cnae_principal'}).with_columns(pl.col('cnae_fiscal_principal').cast(pl.Utf8))
+        natju_df   = natju_df.rename({'codigo': 'natureza_juridica', 'descricao': 'desc_natureza_juridica'}).with_columns(pl.col('natureza_juridica').cast(pl.Utf8))
+        munic_df   = munic_df.rename({'codigo': 'municipio', 'descricao': 'nome_municipio'}).with_columns(pl.col('municipio').cast(pl.Utf8))
+        return empresa_df, simples_df, cnae_df, natju_df, munic_df
+
+    def coluna_de_busca():
+        """busca (ver consolidado_sql.COLUNAS_DE_BUSCA): razão social + nome fantasia sem
+        acentos, em maiúsculas e com os espaços colapsados, como BUSCA_SQL."""
+        texto = pl.concat_str([pl.col('razao_social').fill_null(''), pl.col('nome_fantasia').fill_null('')],
+                              separator=' ')
+        return (
+            texto.str.normalize('NFKD').str.replace_all(r'\p{Mn}', '')
+            .str.to_uppercase()
+            # Letras sem decomposição que o unaccent do PostgreSQL também troca
+            .str.replace_many(['Æ', 'Ø', 'Ð', 'Þ', 'Œ'], ['AE', 'O', 'D', 'TH', 'OE'])
+            .str.replace_all(r'[[:space:]]+', ' ')
+            .str.strip_chars(' ')
+            .alias('busca')
         )
-        del rows
-        gc.collect()
 
+    def consolidar(chunk_df, empresa_df, simples_df, cnae_df, natju_df, munic_df):
+        """JOIN de um pedaço de estabelecimento com as lookups já normalizadas.
+        Todos DataFrames ou todos LazyFrames."""
         # Cast chaves de JOIN e campos de texto para Utf8
         chunk_df = chunk_df.with_columns([
             pl.col('cnpj_basico').cast(pl.Utf8),
@@ -785,90 +1195,113 @@ with conn.cursor('estab_stream') as sc:
         ).rename({'identificador_matriz_filial': 'identificador_mf'})
 
         # JOIN em memória (sub-segundo por chunk)
-        result = (
+        return (
             chunk_df
             .join(empresa_df, on='cnpj_basico', how='left')
             .join(simples_df, on='cnpj_basico', how='left')
             .join(cnae_df,    on='cnae_fiscal_principal', how='left')
             .join(natju_df,   on='natureza_juridica', how='left')
             .join(munic_df,   on='municipio', how='left')
+            .with_columns(coluna_de_busca())
             .select(FINAL_COLS)
         )
 
-        to_sql(result, 'cnpj_consolidado_new', conn_write, db_schema)
-        total_inserted += len(result)
-        print(f"  Chunk {chunk_num}: {total_inserted:,} inseridos ({round(time.time()-t0)}s)", flush=True)
-        del chunk_df, result
-        gc.collect()
+    CHUNK_SIZE = 50_000
+    chunk_num = 0
+    total_inserted = 0
+
+    if particoes is not None:
+        def particao(tabela, k=0):
+            """LazyFrame da partição, ou vazio (todas as colunas Utf8) se nada foi gravado nela."""
+            lf = particoes.ler(tabela, k)
+            if lf is None:
+                lf = pl.LazyFrame(schema={c: pl.Utf8 for c in COLUNAS_CONSOLIDACAO[tabela]})
+            return lf
+
+        # Tabelas de códigos são pequenas: ficam em memória para todas as partições
+        cnae_df, natju_df, munic_df = (particao(t).collect().lazy() for t in ('cnae', 'natju', 'munic'))
+        # cnae.codigo sai do arquivo como texto ('0111301'); estabelecimento.cnae_fiscal_principal
+        # é inteiro. Passa pelo inteiro como acontece ao gravar numa coluna numérica do banco
+        cnae_df = cnae_df.with_columns(pl.col('codigo').cast(pl.Int32, strict=False))
+
+        with CargaParalela(DSN, 'cnpj_consolidado_new', escrever, LOAD_WORKERS) as carga_consolidado:
+            for k in range(particoes.n):
+                if particoes.ler('estabelecimento', k) is None:
+                    continue
+                t0 = time.time()
+                lookups = normalizar_lookups(particao('empresa', k), particao('simples', k), cnae_df, natju_df, munic_df)
+                # Só a partição k das três tabelas grandes fica em memória
+                result = consolidar(particao('estabelecimento', k), *lookups).collect()
+                for parte in em_partes(result, CHUNK_SIZE):
+                    carga_consolidado.enviar(parte)
+                total_inserted += len(result)
+                print(f"  Partição {k + 1}/{particoes.n}: {len(result):,} linhas — total: {total_inserted:,} "
+                      f"({round(time.time()-t0)}s)", flush=True)
+                del result, lookups
+                gc.collect()
+        particoes.remover()
+    else:
+        print("Carregando lookups na memória (Polars)...")
+        lookup_start = time.time()
+
+        empresa_df = fetch_lookup(conn, 'empresa', f'SELECT cnpj_basico, razao_social, natureza_juridica, capital_social, porte_empresa FROM "{db_schema}"."empresa"')
+        simples_df = fetch_lookup(conn, 'simples', f'SELECT cnpj_basico, opcao_pelo_simples, data_opcao_simples, opcao_mei, data_opcao_mei FROM "{db_schema}"."simples"')
+        cnae_df    = fetch_lookup(conn, 'cnae',    f'SELECT codigo, descricao FROM "{db_schema}"."cnae"')
+        natju_df   = fetch_lookup(conn, 'natju',   f'SELECT codigo, descricao FROM "{db_schema}"."natju"')
+        munic_df   = fetch_lookup(conn, 'munic',   f'SELECT codigo, descricao FROM "{db_schema}"."munic"')
+        lookups = normalizar_lookups(empresa_df, simples_df, cnae_df, natju_df, munic_df)
+        del empresa_df, simples_df
+
+        print(f"Lookups prontos em {round(time.time()-lookup_start)}s")
+
+        # Três estágios ligados por filas limitadas: a leitura (COPY TO em conn, numa
+        # thread) busca o próximo bloco enquanto o JOIN roda aqui e as LOAD_WORKERS
+        # conexões de escrita fazem o COPY dos pedaços já consolidados
+        ESTAB_COLS = COLUNAS_CONSOLIDACAO['estabelecimento']
+        blocos = em_segundo_plano(
+            ler_consulta(conn, f'SELECT {", ".join(ESTAB_COLS)} FROM "{db_schema}"."estabelecimento"'))
+        with CargaParalela(DSN, 'cnpj_consolidado_new', escrever, LOAD_WORKERS) as carga_consolidado:
+            for bloco_df in blocos:
+                t0 = time.time()
+                for chunk_df in em_partes(bloco_df, CHUNK_SIZE):
+                    chunk_num += 1
+                    result = consolidar(chunk_df, *lookups)
+                    carga_consolidado.enviar(result)
+                    total_inserted += len(result)
+                print(f"  Chunk {chunk_num}: {total_inserted:,} enviados ({round(time.time()-t0)}s)", flush=True)
+                del bloco_df, chunk_df, result
+
+    consolidado_end = time.time()
+    print(f"cnpj_consolidado_new populado com {total_inserted:,} registros em {round(consolidado_end - consolidado_start)}s")
+
+    with configuracao_de_carga(conn):
+        finalizar_tabela(conn, db_schema, 'cnpj_consolidado_new')
+
+    # Uma linha por cnpj_basico com os dados da matriz (ver empresa_matriz.py)
+    linhas_matriz = empresa_matriz.montar(conn, db_schema, 'cnpj_consolidado_new')
+    construir_indices(DSN, db_schema, empresa_matriz.TAREFA, [empresa_matriz.ddl_do_indice(db_schema)])
+    print(f"empresa_matriz_new populada com {linhas_matriz:,} empresas")
+
+    # ── Rebuild índices em cnpj_consolidado_new, depois swap zero-downtime ─────────
+    print("\n## Recriando índices em cnpj_consolidado_new...")
+    with conn.cursor() as _c:
+        for _idx in nomes_dos_indices():
+            _c.execute(f'DROP INDEX IF EXISTS "{db_schema}"."{_idx}";')
+    conn.commit()
+    print("  Índices antigos removidos (libera nomes para a staging).")
 
-conn.commit()  # fecha o named cursor
-conn_write.close()
-
-consolidado_end = time.time()
-print(f"cnpj_consolidado_new populado com {total_inserted:,} registros em {round(consolidado_end - consolidado_start)}s")
-
-# ── Rebuild índices em cnpj_consolidado_new, depois swap zero-downtime ─────────
-print("\n## Recriando índices em cnpj_consolidado_new...")
-_DROP_OLD_IDX = [
-    "cnpj_consolidado_basico", "cnpj_consolidado_cnpj", "cnpj_consolidado_email",
-    "cnpj_consolidado_endereco", "cnpj_consolidado_fantasia_trgm", "cnpj_consolidado_razao",
-    "cnpj_consolidado_razao_trgm", "cnpj_consolidado_sit", "cnpj_consolidado_uf",
-    "cnpj_consolidado_uf_mun", "idx_cnpj_consolidado_cnpj_basico", "idx_cnpj_consolidado_razao",
-    "idx_cnpj_consolidado_razao_trgm", "idx_consolidado_cep", "idx_consolidado_cnae",
-    "idx_consolidado_email", "idx_fantasia_trgm", "idx_fantasia_unaccent_trgm",
-    "idx_fts_simple", "idx_fts_simple_ativa", "idx_razao_social_btree",
-    "idx_razao_trgm", "idx_razao_unaccent_trgm",
-]
-with conn.cursor() as _c:
-    for _idx in _DROP_OLD_IDX:
-        _c.execute(f'DROP INDEX IF EXISTS "{db_schema}"."{_idx}";')
-conn.commit()
-print("  Índices antigos removidos (libera nomes para a staging).")
-
-_INDEX_DDLS = [
-    f'CREATE UNIQUE INDEX IF NOT EXISTS cnpj_consolidado_cnpj ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnpj)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_basico ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnpj_basico)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_sit ON "{db_schema}"."cnpj_consolidado_new" USING btree (situacao_cadastral)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_uf ON "{db_schema}"."cnpj_consolidado_new" USING btree (uf)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_uf_mun ON "{db_schema}"."cnpj_consolidado_new" USING btree (uf, nome_municipio)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_razao ON "{db_schema}"."cnpj_consolidado_new" USING btree (razao_social)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_endereco ON "{db_schema}"."cnpj_consolidado_new" USING btree (cep, logradouro, numero)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_email ON "{db_schema}"."cnpj_consolidado_new" USING btree (correio_eletronico) WHERE (correio_eletronico IS NOT NULL)',
-    f'CREATE INDEX IF NOT EXISTS idx_cnpj_consolidado_cnpj_basico ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnpj_basico)',
-    f'CREATE INDEX IF NOT EXISTS idx_consolidado_cep ON "{db_schema}"."cnpj_consolidado_new" USING btree (cep)',
-    f'CREATE INDEX IF NOT EXISTS idx_consolidado_cnae ON "{db_schema}"."cnpj_consolidado_new" USING btree (cnae_fiscal_principal)',
-    f'CREATE INDEX IF NOT EXISTS idx_consolidado_email ON "{db_schema}"."cnpj_consolidado_new" USING btree (correio_eletronico)',
-    f'CREATE INDEX IF NOT EXISTS idx_razao_social_btree ON "{db_schema}"."cnpj_consolidado_new" USING btree (razao_social)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_razao_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(razao_social) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS cnpj_consolidado_fantasia_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(nome_fantasia) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_cnpj_consolidado_razao_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (razao_social gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_fantasia_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(nome_fantasia) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_fantasia_unaccent_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(nome_fantasia) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_razao_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(razao_social) gin_trgm_ops)',
-    f'CREATE INDEX IF NOT EXISTS idx_razao_unaccent_trgm ON "{db_schema}"."cnpj_consolidado_new" USING gin (immutable_unaccent(razao_social) gin_trgm_ops)',
-    f"""CREATE INDEX IF NOT EXISTS idx_cnpj_consolidado_razao ON "{db_schema}"."cnpj_consolidado_new" USING gin (to_tsvector('simple'::regconfig, ((COALESCE(razao_social, ''::text) || ' '::text) || COALESCE(nome_fantasia, ''::text))))""",
-    f"""CREATE INDEX IF NOT EXISTS idx_fts_simple ON "{db_schema}"."cnpj_consolidado_new" USING gin (to_tsvector('simple'::regconfig, ((immutable_unaccent(COALESCE(razao_social, ''::text)) || ' '::text) || immutable_unaccent(COALESCE(nome_fantasia, ''::text)))))""",
-    f"""CREATE INDEX IF NOT EXISTS idx_fts_simple_ativa ON "{db_schema}"."cnpj_consolidado_new" USING gin (to_tsvector('simple'::regconfig, ((immutable_unaccent(COALESCE(razao_social, ''::text)) || ' '::text) || immutable_unaccent(COALESCE(nome_fantasia, ''::text))))) WHERE ((situacao_cadastral)::text = '02'::text)""",
-]
-_conn_idx = psycopg2.connect(DSN)
-_conn_idx.autocommit = True
-for _ddl in _INDEX_DDLS:
-    _name = _ddl.split('INDEX IF NOT EXISTS ')[1].split(' ')[0]
-    print(f"  {_name}... ", end='', flush=True)
-    _t0 = time.time()
-    with _conn_idx.cursor() as _c:
-        _c.execute(_ddl)
-    print(f"ok ({round(time.time()-_t0)}s)", flush=True)
-_conn_idx.close()
-
-with conn.cursor() as _c:
-    _c.execute(f'ALTER TABLE "{db_schema}"."cnpj_consolidado" RENAME TO "cnpj_consolidado_old";')
-    _c.execute(f'ALTER TABLE "{db_schema}"."cnpj_consolidado_new" RENAME TO "cnpj_consolidado";')
-conn.commit()
-with conn.cursor() as _c:
-    _c.execute(f'DROP TABLE "{db_schema}"."cnpj_consolidado_old";')
-conn.commit()
-print(f"Swap zero-downtime concluído. cnpj_consolidado com {total_inserted:,} registros e índices completos.")
+    # Registro único dos índices (consolidado_sql.py), construídos em paralelo (indices.py)
+    construir_indices(DSN, db_schema, 'cnpj_consolidado', ddl_dos_indices(db_schema, 'cnpj_consolidado_new'))
+
+    with conn.cursor() as _c:
+        empresa_matriz.trocar(_c, db_schema)
+        _c.execute(f'ALTER TABLE "{db_schema}"."cnpj_consolidado" RENAME TO "cnpj_consolidado_old";')
+        _c.execute(f'ALTER TABLE "{db_schema}"."cnpj_consolidado_new" RENAME TO "cnpj_consolidado";')
+    conn.commit()
+    with conn.cursor() as _c:
+        _c.execute(f'DROP TABLE "{db_schema}"."cnpj_consolidado_old";')
+    conn.commit()
+    print(f"Swap zero-downtime concluído. cnpj_consolidado com {total_inserted:,} registros e índices completos.")
 
 #############################################
 # Limpeza dos arquivos temporários
@@ -63,11 +63,10 @@ with gzip.open(out_file, "wt", encoding="utf-8") as gz:
         print(f"  {arquivo}... ", end="", flush=True)
         count = 0
 
-        with open(os.path.join(extracted_files, arquivo), "rb") as raw:
-            reader = csv.reader(
-                (line.decode("latin1") for line in raw),
-                delimiter=";",
-            )
+        # Arquivos *.utf8 já foram convertidos (e limpos de \x00) pelo etl_postgres.py
+        encoding = "utf-8" if arquivo.endswith(".utf8") else "latin1"
+        with open(os.path.join(extracted_files, arquivo), encoding=encoding, newline="") as f:
+            reader = csv.reader(f, delimiter=";")
             for row in reader:
                 if len(row) < 8:
                     continue
@@ -0,0 +1,252 @@
+"""
+Execução de um INSERT ... SELECT por faixas de cnpj_basico em várias conexões.
+
+Cada faixa usa limites `>=`/`<` (sargable: aproveita o índice em cnpj_basico,
+ao contrário do LIKE 'NN%'), roda na sua própria transação junto com a
+atualização da tabela de progresso e, se falhar, é repetida sozinha. Uma
+construção interrompida retoma apenas as faixas que não terminaram.
+
+A tabela de progresso é UNLOGGED como as tabelas _new do modo de carga em
+massa: se o servidor cair, as duas são esvaziadas juntas e a construção
+recomeça do zero, sem faixas marcadas como concluídas e sem dados.
+"""
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+TABELA_PROGRESSO = '_faixas_progresso'
+
+
+def faixas_de_prefixo(digitos=2):
+    """
+    [(faixa, inicio, fim)] com um prefixo numérico de `digitos` dígitos cada.
+    A última faixa não tem limite superior (fim=None).
+    """
+    total = 10 ** digitos
+    faixas = []
+    for i in range(total):
+        inicio = f"{i:0{digitos}d}"
+        fim = f"{i + 1:0{digitos}d}" if i + 1 < total else None
+        faixas.append((inicio, inicio, fim))
+    return faixas
+
+
+def faixas_agrupadas(n, digitos=2):
+    """
+    As faixas de faixas_de_prefixo agrupadas em `n` faixas contíguas. A primeira
+    não tem limite inferior (inicio=None) e a última não tem limite superior.
+    """
+    prefixos = faixas_de_prefixo(digitos)
+    cortes = sorted({i * len(prefixos) // n for i in range(n)})
+    faixas = []
+    for j, corte in enumerate(cortes):
+        faixa = prefixos[corte][0]
+        inicio = faixa if j > 0 else None
+        fim = prefixos[cortes[j + 1]][0] if j + 1 < len(cortes) else None
+        faixas.append((faixa, inicio, fim))
+    return faixas
+
+
+def filtro_de_faixa(coluna, inicio, fim):
+    """Condição SQL e parâmetros para `inicio <= coluna < fim` (None: sem o limite)."""
+    condicoes, parametros = [], []
+    if inicio is not None:
+        condicoes.append(f'{coluna} >= %s')
+        parametros.append(inicio)
+    if fim is not None:
+        condicoes.append(f'{coluna} < %s')
+        parametros.append(fim)
+    return ' AND '.join(condicoes) or 'TRUE', tuple(parametros)
+
+
+class ExecutorDeFaixas:
+    """
+    Executa `montar_sql(inicio, fim) -> (sql, parametros)` para cada faixa em
+    N conexões paralelas, registrando o andamento em TABELA_PROGRESSO.
+
+        executor = ExecutorDeFaixas(DSN, schema, 'cnpj_consolidado', n_conexoes=4)
+        if not executor.tem_progresso():
+            executor.iniciar(faixas_de_prefixo())
+        executor.executar(montar_sql)
+        ...
+        executor.limpar()
+    """
+
+    def __init__(self, dsn, schema, tarefa, n_conexoes=4, max_tentativas=3, preparar=None):
+        self.dsn = dsn
+        self.schema = schema
+        self.tarefa = tarefa
+        self.n_conexoes = n_conexoes
+        self.max_tentativas = max_tentativas
+        self._preparar = preparar
+        self._tabela = f'"{schema}"."{TABELA_PROGRESSO}"'
+        with self._cursor() as c:
+            c.execute(f"""
+                CREATE UNLOGGED TABLE IF NOT EXISTS {self._tabela} (
+                    tarefa        TEXT,
+                    faixa         TEXT,
+                    inicio        TEXT,
+                    fim           TEXT,
+                    status        TEXT DEFAULT 'pendente',
+                    linhas        BIGINT,
+                    segundos      INTEGER,
+                    tentativas    INTEGER DEFAULT 0,
+                    erro          TEXT,
+                    atualizado_em TIMESTAMP DEFAULT NOW(),
+                    PRIMARY KEY (tarefa, faixa)
+                )
+            """)
+
+    def _conectar(self):
+        return psycopg2.connect(self.dsn)
+
+    @contextmanager
+    def _cursor(self):
+        """Cursor numa conexão própria, com commit ao sair e conexão fechada."""
+        conn = self._conectar()
+        try:
+            with conn, conn.cursor() as c:
+                yield c
+        finally:
+            conn.close()
+
+    def tem_progresso(self):
+        """True se há uma construção desta tarefa registrada (concluída ou não)."""
+        with self._cursor() as c:
+            c.execute(f'SELECT 1 FROM {self._tabela} WHERE tarefa = %s LIMIT 1', (self.tarefa,))
+            return c.fetchone() is not None
+
+    def iniciar(self, faixas):
+        """Registra as faixas de uma construção nova, descartando o progresso anterior."""
+        with self._cursor() as c:
+            c.execute(f'DELETE FROM {self._tabela} WHERE tarefa = %s', (self.tarefa,))
+            c.executemany(
+                f'INSERT INTO {self._tabela} (tarefa, faixa, inicio, fim) VALUES (%s, %s, %s, %s)',
+                [(self.tarefa, faixa, inicio, fim) for faixa, inicio, fim in faixas],
+            )
+
+    def pendentes(self):
+        with self._cursor() as c:
+            c.execute(
+                f"SELECT faixa, inicio, fim FROM {self._tabela} "
+                f"WHERE tarefa = %s AND status <> 'concluida' ORDER BY faixa",
+                (self.tarefa,),
+            )
+            return c.fetchall()
+
+    def limpar(self):
+        """Apaga o progresso da tarefa (chamar quando a construção terminar)."""
+        with self._cursor() as c:
+            c.execute(f'DELETE FROM {self._tabela} WHERE tarefa = %s', (self.tarefa,))
+
+    def executar(self, montar_sql):
+        """
+        Roda as faixas pendentes. Retorna o total de linhas inseridas nesta
+        execução; levanta RuntimeError se alguma faixa esgotar as tentativas.
+        """
+        def inserir(conn, faixa, inicio, fim):
+            sql, parametros = montar_sql(inicio, fim)
+            with conn.cursor() as c:
+                c.execute(sql, parametros)
+                return c.rowcount
+
+        return self.executar_tarefa(inserir)
+
+    def executar_tarefa(self, tarefa):
+        """
+        Como `executar`, com `tarefa(conn, faixa, inicio, fim) -> linhas` fazendo o
+        trabalho de cada faixa. O registro de conclusão é gravado na transação que
+        a tarefa deixar aberta; uma tarefa que faz os próprios commits precisa ser
+        idempotente, pois pode ser repetida depois de ter feito parte do trabalho.
+        """
+        fila = queue.Queue()
+        pendentes = self.pendentes()
+        for faixa in pendentes:
+            fila.put(faixa)
+        print(f"  {len(pendentes)} faixas pendentes em {self.n_conexoes} conexões", flush=True)
+
+        resultado = {'linhas': 0, 'falhas': []}
+        trava = threading.Lock()
+        inicio_geral = time.time()
+
+        def trabalhar():
+            conn = None
+            while True:
+                try:
+                    faixa, inicio, fim = fila.get_nowait()
+                except queue.Empty:
+                    break
+                for tentativa in range(1, self.max_tentativas + 1):
+                    t0 = time.time()
+                    try:
+                        if conn is None or conn.closed:
+                            conn = self._conectar()
+                            if self._preparar:
+                                self._preparar(conn)
+                        n = tarefa(conn, faixa, inicio, fim)
+                        with conn.cursor() as c:
+                            # Mesma transação da tarefa: a faixa conta como feita só se os dados ficarem
+                            c.execute(
+                                f"UPDATE {self._tabela} SET status = 'concluida', linhas = %s, segundos = %s, "
+                                f"tentativas = %s, erro = NULL, atualizado_em = NOW() "
+                                f"WHERE tarefa = %s AND faixa = %s",
+                                (n, round(time.time() - t0), tentativa, self.tarefa, faixa),
+                            )
+                        conn.commit()
+                    except Exception as e:
+                        # Não só psycopg2.Error: uma tarefa em Polars falha com ComputeError, OSError etc.,
+                        # e a exceção não pode encerrar a thread com a faixa esquecida na fila
+                        erro = str(e).strip() or type(e).__name__
+                        print(f"  Faixa {faixa}: erro na tentativa {tentativa}/{self.max_tentativas}: {erro}", flush=True)
+                        self._registrar_erro(conn, faixa, tentativa, erro)
+                        if tentativa < self.max_tentativas:
+                            time.sleep(2 ** tentativa)
+                        continue
+                    with trava:
+                        resultado['linhas'] += n
+                        total = resultado['linhas']
+                    print(f"  Faixa {faixa}: {n:,} inseridos ({round(time.time() - t0)}s) — total: {total:,}", flush=True)
+                    break
+                else:
+                    with trava:
+                        resultado['falhas'].append(faixa)
+            if conn is not None and not conn.closed:
+                conn.close()
+
+        threads = [threading.Thread(target=trabalhar) for _ in range(self.n_conexoes)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        segundos = round(time.time() - inicio_geral)
+        print(f"  {resultado['linhas']:,} linhas em {segundos}s", flush=True)
+        if resultado['falhas']:
+            raise RuntimeError(
+                f"Faixas com erro após {self.max_tentativas} tentativas: {', '.join(sorted(resultado['falhas']))}. "
+                "Rode de novo para retomar só as faixas pendentes."
+            )
+        # Confere no registro: uma faixa que não ficou 'concluida' por qualquer motivo não passa em silêncio
+        restantes = self.pendentes()
+        if restantes:
+            raise RuntimeError(
+                f"Faixas não concluídas: {', '.join(str(f) for f, _, _ in restantes)}. "
+                "Rode de novo para retomar só as faixas pendentes."
+            )
+        return resultado['linhas']
+
+    def _registrar_erro(self, conn, faixa, tentativa, erro):
+        try:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            with self._cursor() as c:
+                c.execute(
+                    f"UPDATE {self._tabela} SET status = 'erro', tentativas = %s, erro = %s, "
+                    f"atualizado_em = NOW() WHERE tarefa = %s AND faixa = %s",
+                    (tentativa, erro[:500], self.tarefa, faixa),
+                )
+        except psycopg2.Error:
+            pass  # o registro do erro é só informativo
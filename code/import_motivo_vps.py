@@ -18,11 +18,13 @@ import os
 import pathlib
 import sys
 import time
-from io import StringIO
+from itertools import islice
 
 import psycopg2
 from dotenv import load_dotenv
 
+from pg_copy import copiar_fluxo
+
 
 def _find_dotenv() -> str:
     p = pathlib.Path().resolve()
@@ -96,37 +98,26 @@ else:
     # ── 3. COPY em chunks ─────────────────────────────────────────────────────
     print(f"Carregando {csv_gz}...", flush=True)
     CHUNK = 500_000
-    buf_lines = []
     total = 0
     t0 = time.time()
 
     with gzip.open(csv_gz, "rt", encoding="utf-8") as f:
         f.readline()  # header
-        for line in f:
-            buf_lines.append(line)
-            if len(buf_lines) >= CHUNK:
-                cur2 = conn.cursor()
-                cur2.copy_expert(
-                    f'COPY "{db_schema}"."_map_motivo" (cnpj, motivo_situacao_cadastral) '
-                    "FROM STDIN WITH (FORMAT CSV, NULL '')",
-                    StringIO("".join(buf_lines)),
-                )
-                conn.commit()
-                cur2.close()
-                total += len(buf_lines)
-                buf_lines = []
-                print(f"  {total:,} linhas ({round(time.time()-t0)}s)", flush=True)
-
-    if buf_lines:
-        cur2 = conn.cursor()
-        cur2.copy_expert(
-            f'COPY "{db_schema}"."_map_motivo" (cnpj, motivo_situacao_cadastral) '
-            "FROM STDIN WITH (FORMAT CSV, NULL '')",
-            StringIO("".join(buf_lines)),
-        )
-        conn.commit()
-        cur2.close()
-        total += len(buf_lines)
+        while True:
+            # As linhas do arquivo seguem direto para o COPY, sem juntar o chunk em memória
+            cur2 = conn.cursor()
+            n = copiar_fluxo(
+                cur2,
+                f'COPY "{db_schema}"."_map_motivo" (cnpj, motivo_situacao_cadastral) '
+                "FROM STDIN WITH (FORMAT CSV, NULL '')",
+                islice(f, CHUNK),
+            )
+            conn.commit()
+            cur2.close()
+            if not n:
+                break
+            total += n
+            print(f"  {total:,} linhas ({round(time.time()-t0)}s)", flush=True)
 
     print(f"_map_motivo: {total:,} registros em {round(time.time()-t0)}s")
 
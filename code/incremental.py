@@ -0,0 +1,152 @@
+"""
+Atualização incremental mensal (LOAD_MODE=incremental).
+
+Em vez de TRUNCATE + carga completa de empresa, estabelecimento, socios e
+simples, os arquivos do mês são carregados em tabelas `<tabela>_carga`. Cada
+linha é identificada pelo md5 de todas as suas colunas, guardado em
+`hash_linha` nas tabelas brutas: linhas da geração anterior cujo hash não
+aparece na nova são apagadas e linhas novas cujo hash não existia são
+inseridas (uma alteração conta como as duas coisas). Os cnpj_basico tocados
+ficam em `_cnpj_alterados`, e cnpj_consolidado, empresa_matriz, socios_consolidado,
+pessoas_consolidado e os índices do Meilisearch são refeitos só para eles.
+
+Na primeira execução incremental sobre tabelas carregadas no modo completo,
+o hash_linha das linhas existentes é calculado antes da comparação (uma
+reescrita única de cada tabela). As tabelas
+de códigos (cnae, munic...) são pequenas e continuam sendo recarregadas
+inteiras; uma mudança de descrição nelas só chega às consolidadas na próxima
+carga completa.
+
+Linhas idênticas repetidas em socios têm o mesmo hash e contam como uma só
+na comparação.
+"""
+import os
+
+from bulk_load import criar_tabela_de_carga
+from consolidado_sql import sql_de_insercao
+import empresa_matriz
+
+ATIVO = os.getenv('LOAD_MODE', 'full').lower() == 'incremental'
+
+# Tabelas brutas atualizadas por diferença (as demais seguem com TRUNCATE + carga)
+TABELAS = ['empresa', 'estabelecimento', 'socios', 'simples']
+
+ALTERADOS = '_cnpj_alterados'
+PESSOAS_ALTERADAS = '_pessoas_alteradas'
+
+
+def tabela_de_carga(tabela):
+    """Tabela que recebe a carga do mês: `<tabela>_carga` no modo incremental."""
+    return f'{tabela}_carga' if ATIVO and tabela in TABELAS else tabela
+
+
+def filtro_alterados(schema, coluna='cnpj_basico'):
+    """Condição SQL: `coluna` está entre os cnpj_basico alterados nesta geração."""
+    return f'{coluna} IN (SELECT cnpj_basico FROM "{schema}"."{ALTERADOS}")'
+
+
+def preparar(cur, schema):
+    """Garante hash_linha nas tabelas brutas, recria as tabelas _carga e zera _cnpj_alterados e _pessoas_alteradas."""
+    for tabela in TABELAS:
+        cur.execute(f'ALTER TABLE "{schema}"."{tabela}" ADD COLUMN IF NOT EXISTS hash_linha UUID')
+        cur.execute(f'DROP TABLE IF EXISTS "{schema}"."{tabela_de_carga(tabela)}"')
+        criar_tabela_de_carga(cur, schema, tabela_de_carga(tabela),
+                              f'(LIKE "{schema}"."{tabela}" INCLUDING DEFAULTS)')
+    cur.execute(f'CREATE TABLE IF NOT EXISTS "{schema}"."{ALTERADOS}" (cnpj_basico TEXT PRIMARY KEY)')
+    cur.execute(f'CREATE TABLE IF NOT EXISTS "{schema}"."{PESSOAS_ALTERADAS}" (id UUID PRIMARY KEY)')
+    cur.execute(f'TRUNCATE "{schema}"."{ALTERADOS}", "{schema}"."{PESSOAS_ALTERADAS}"')
+
+
+def _colunas(cur, schema, tabela):
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+         WHERE table_schema = %s AND table_name = %s AND column_name <> 'hash_linha'
+         ORDER BY ordinal_position
+    """, (schema, tabela))
+    return [r[0] for r in cur.fetchall()]
+
+
+def aplicar(conn, schema, tabela):
+    """
+    Aplica em `tabela` a diferença para `<tabela>_carga`, registra os cnpj_basico
+    tocados em _cnpj_alterados e apaga a tabela _carga. Retorna (apagadas, inseridas).
+    """
+    carga = tabela_de_carga(tabela)
+    with conn.cursor() as c:
+        colunas = _colunas(c, schema, tabela)
+        lista = ', '.join(f'"{col}"' for col in colunas)
+
+        def hash_de(alias):
+            campos = ', '.join(f'{alias}."{col}"' for col in colunas)
+            return f'md5(ROW({campos})::text)::uuid'
+
+        marcar = (f'INSERT INTO "{schema}"."{ALTERADOS}" SELECT DISTINCT cnpj_basico::text FROM tocadas '
+                  'WHERE cnpj_basico IS NOT NULL ON CONFLICT DO NOTHING')
+
+        # Linhas da carga completa anterior: o hash é calculado da mesma forma
+        # que o da carga nova, então só as linhas realmente diferentes mudam
+        c.execute(f'UPDATE "{schema}"."{tabela}" o SET hash_linha = {hash_de("o")} WHERE o.hash_linha IS NULL')
+
+        c.execute(f"""
+            WITH tocadas AS (
+                DELETE FROM "{schema}"."{tabela}" o
+                 WHERE NOT EXISTS (SELECT 1 FROM "{schema}"."{carga}" n WHERE {hash_de("n")} = o.hash_linha)
+                RETURNING o.cnpj_basico
+            ), marcadas AS ({marcar})
+            SELECT COUNT(*) FROM tocadas
+        """)
+        apagadas = c.fetchone()[0]
+
+        c.execute(f"""
+            WITH tocadas AS (
+                INSERT INTO "{schema}"."{tabela}" ({lista}, hash_linha)
+                SELECT {lista}, h FROM (SELECT n.*, {hash_de("n")} AS h FROM "{schema}"."{carga}" n) n
+                 WHERE NOT EXISTS (SELECT 1 FROM "{schema}"."{tabela}" o WHERE o.hash_linha = n.h)
+                RETURNING cnpj_basico
+            ), marcadas AS ({marcar})
+            SELECT COUNT(*) FROM tocadas
+        """)
+        inseridas = c.fetchone()[0]
+
+        c.execute(f'DROP TABLE "{schema}"."{carga}"')
+    conn.commit()
+    return apagadas, inseridas
+
+
+def contar_alterados(cur, schema):
+    cur.execute(f'SELECT COUNT(*) FROM "{schema}"."{ALTERADOS}"')
+    return cur.fetchone()[0]
+
+
+def atualizar_cnpj_consolidado(conn, schema):
+    """
+    Refaz em cnpj_consolidado (e em empresa_matriz, na mesma transação) só as
+    linhas dos cnpj_basico alterados. Retorna (apagadas, inseridas) de cnpj_consolidado.
+    """
+    with conn.cursor() as c:
+        c.execute(f'DELETE FROM "{schema}"."cnpj_consolidado" WHERE {filtro_alterados(schema)}')
+        apagadas = c.rowcount
+        c.execute(sql_de_insercao(schema, 'cnpj_consolidado')
+                  .replace('{filtro}', filtro_alterados(schema, 'es.cnpj_basico')))
+        inseridas = c.rowcount
+        empresa_matriz.atualizar(c, schema, filtro_alterados(schema))
+    conn.commit()
+    return apagadas, inseridas
+
+
+def registrar_pessoas(cur, schema):
+    """
+    Acrescenta a _pessoas_alteradas as pessoas com linhas de socios_consolidado
+    nos cnpj_basico alterados (mesma junção de build_pessoas_consolidado.py).
+    Chamar antes de apagar e depois de inserir as linhas, para pegar os dois lados.
+    """
+    cur.execute(f'CREATE TABLE IF NOT EXISTS "{schema}"."{PESSOAS_ALTERADAS}" (id UUID PRIMARY KEY)')
+    cur.execute(f"""
+        INSERT INTO "{schema}"."{PESSOAS_ALTERADAS}"
+        SELECT DISTINCT p.id
+          FROM "{schema}".socios_consolidado sc
+          JOIN "{schema}".pessoas p
+            ON p.id = sc.pessoa_id
+         WHERE {filtro_alterados(schema, 'sc.cnpj_basico')}
+        ON CONFLICT DO NOTHING
+    """)
@@ -0,0 +1,215 @@
+"""
+Construção de índices em várias conexões.
+
+Recebe os CREATE INDEX de uma tabela (ex.: consolidado_sql.ddl_dos_indices) e
+os distribui entre INDICES_CONEXOES conexões, cada uma com até
+INDICES_WORKERS_POR_INDICE workers paralelos de manutenção por índice. Os GIN
+(os mais demorados) começam primeiro; os btree preenchem as outras conexões.
+Um índice só começa depois dos que estiverem em `depende_de`.
+
+O andamento de cada índice (status, segundos, erro) fica em TABELA_PROGRESSO,
+UNLOGGED como a de faixas.py. Outro processo pode usar `aguardar_indices` para
+começar assim que os índices de que depende existirem, sem esperar o resto.
+Cada construção grava a GERACAO (GERACAO_DOS_INDICES, definida por
+pipeline_full.sh) com que foi feita, e quem aguarda só aceita a mesma.
+
+    construir_indices(DSN, schema, 'cnpj_consolidado', ddls)
+"""
+import os
+import threading
+import time
+
+import psycopg2
+
+from bulk_load import configuracao_de_carga
+
+TABELA_PROGRESSO = '_indices_progresso'
+
+INDICES_CONEXOES = int(os.getenv('INDICES_CONEXOES', '3'))
+INDICES_WORKERS_POR_INDICE = int(os.getenv('INDICES_WORKERS_POR_INDICE', '2'))
+# Identifica a execução do pipeline: produtor e consumidor com a mesma geração
+# falam da mesma construção, mesmo que ela tenha terminado antes da espera começar
+GERACAO = os.getenv('GERACAO_DOS_INDICES') or None
+AGUARDAR_INDICES_TIMEOUT = int(os.getenv('AGUARDAR_INDICES_TIMEOUT', '21600'))
+
+
+def nome_do_indice(ddl):
+    return ddl.split('INDEX IF NOT EXISTS ')[1].split(' ')[0]
+
+
+def _pesado(ddl):
+    return ' using gin ' in ddl.lower()
+
+
+def _registrar(dsn, schema, tarefa, nome, status, segundos=None, erro=None):
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as c:
+            c.execute(
+                f'INSERT INTO "{schema}"."{TABELA_PROGRESSO}" (tarefa, nome, status, segundos, erro, geracao) '
+                f'VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (tarefa, nome) DO UPDATE SET '
+                f'status = EXCLUDED.status, segundos = EXCLUDED.segundos, erro = EXCLUDED.erro, '
+                f'geracao = EXCLUDED.geracao, atualizado_em = NOW()',
+                (tarefa, nome, status, segundos, erro, GERACAO),
+            )
+    finally:
+        conn.close()
+
+
+def construir_indices(dsn, schema, tarefa, ddls, n_conexoes=None, workers_por_indice=None, depende_de=None):
+    """
+    Executa `ddls` em `n_conexoes` conexões paralelas. `depende_de` ({nome: [nomes]})
+    segura um índice até os outros terminarem. Retorna {nome: segundos};
+    levanta RuntimeError se algum índice falhar.
+    """
+    n_conexoes = n_conexoes or INDICES_CONEXOES
+    workers_por_indice = workers_por_indice if workers_por_indice is not None else INDICES_WORKERS_POR_INDICE
+    nomes = {nome_do_indice(ddl) for ddl in ddls}
+    # Dependência fora da lista não segura ninguém
+    depende_de = {nome: [r for r in requisitos if r in nomes] for nome, requisitos in (depende_de or {}).items()}
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as c:
+            c.execute(f"""
+                CREATE UNLOGGED TABLE IF NOT EXISTS "{schema}"."{TABELA_PROGRESSO}" (
+                    tarefa        TEXT,
+                    nome          TEXT,
+                    status        TEXT,
+                    segundos      INTEGER,
+                    erro          TEXT,
+                    atualizado_em TIMESTAMP DEFAULT NOW(),
+                    geracao       TEXT,
+                    PRIMARY KEY (tarefa, nome)
+                )
+            """)
+            c.execute(f'ALTER TABLE "{schema}"."{TABELA_PROGRESSO}" ADD COLUMN IF NOT EXISTS geracao TEXT')
+            c.execute(f'DELETE FROM "{schema}"."{TABELA_PROGRESSO}" WHERE tarefa = %s', (tarefa,))
+    finally:
+        conn.close()
+
+    # GIN primeiro, depois o resto (ordem estável dentro de cada grupo)
+    pendentes = sorted(ddls, key=lambda ddl: not _pesado(ddl))
+    for ddl in pendentes:
+        _registrar(dsn, schema, tarefa, nome_do_indice(ddl), 'pendente')
+    prontos, falhas, tempos = set(), [], {}
+    condicao = threading.Condition()
+    inicio_geral = time.time()
+    print(f"  {len(pendentes)} índices em {n_conexoes} conexões "
+          f"({workers_por_indice} workers de manutenção por índice)", flush=True)
+
+    def proximo():
+        """Próximo DDL com as dependências prontas; None quando não há mais o que fazer."""
+        with condicao:
+            while pendentes:
+                for ddl in pendentes:
+                    requisitos = depende_de.get(nome_do_indice(ddl), [])
+                    if any(r in falhas for r in requisitos):
+                        pendentes.remove(ddl)
+                        falhas.append(nome_do_indice(ddl))
+                        _registrar(dsn, schema, tarefa, nome_do_indice(ddl), 'erro', erro='dependência com erro')
+                        condicao.notify_all()
+                        break
+                    if all(r in prontos for r in requisitos):
+                        pendentes.remove(ddl)
+                        return ddl
+                else:
+                    condicao.wait()
+            return None
+
+    def trabalhar():
+        conn = psycopg2.connect(dsn)
+        conn.autocommit = True
+        try:
+            with configuracao_de_carga(conn):
+                with conn.cursor() as c:
+                    c.execute("SELECT set_config('max_parallel_maintenance_workers', %s, false)",
+                              (str(workers_por_indice),))
+                while True:
+                    ddl = proximo()
+                    if ddl is None:
+                        break
+                    nome = nome_do_indice(ddl)
+                    _registrar(dsn, schema, tarefa, nome, 'construindo')
+                    t0 = time.time()
+                    try:
+                        with conn.cursor() as c:
+                            c.execute(ddl)
+                    except psycopg2.Error as e:
+                        erro = str(e).strip()
+                        print(f"  {nome}: erro: {erro}", flush=True)
+                        _registrar(dsn, schema, tarefa, nome, 'erro', round(time.time() - t0), erro[:500])
+                        with condicao:
+                            falhas.append(nome)
+                            condicao.notify_all()
+                        continue
+                    segundos = round(time.time() - t0)
+                    _registrar(dsn, schema, tarefa, nome, 'concluido', segundos)
+                    with condicao:
+                        prontos.add(nome)
+                        tempos[nome] = segundos
+                        condicao.notify_all()
+                    print(f"  {nome}: ok ({segundos}s)", flush=True)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=trabalhar) for _ in range(n_conexoes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"  {len(tempos)} índices em {round(time.time() - inicio_geral)}s "
+          f"(soma dos tempos: {sum(tempos.values())}s)", flush=True)
+    if falhas:
+        raise RuntimeError(f"Índices com erro: {', '.join(falhas)}")
+    return tempos
+
+
+def aguardar_indices(dsn, schema, tarefa, nomes, intervalo=30, timeout=None):
+    """
+    Bloqueia até os índices `nomes` da `tarefa` ficarem prontos. Com GERACAO
+    definida vale a construção da mesma geração, ainda que já tenha terminado;
+    sem ela, só uma registrada depois do início da espera (registros de
+    execuções anteriores não contam). Levanta RuntimeError se algum índice da
+    construção falhar ou se `timeout` segundos (AGUARDAR_INDICES_TIMEOUT)
+    passarem sem os índices.
+    """
+    timeout = timeout if timeout is not None else AGUARDAR_INDICES_TIMEOUT
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as c:
+            c.execute('SELECT NOW()')
+            desde = c.fetchone()[0]
+            if GERACAO is not None:
+                da_construcao, parametros = 'geracao = %s', (GERACAO,)
+            else:
+                da_construcao, parametros = 'atualizado_em >= %s', (desde,)
+            print(f"  Aguardando os índices de {tarefa}: {', '.join(nomes)}", flush=True)
+            limite = time.time() + timeout
+            while True:
+                c.execute('SELECT to_regclass(%s)', (f'"{schema}"."{TABELA_PROGRESSO}"',))
+                status = {}
+                if c.fetchone()[0] is not None:
+                    c.execute(
+                        f'SELECT nome, status FROM "{schema}"."{TABELA_PROGRESSO}" '
+                        f'WHERE tarefa = %s AND {da_construcao}',
+                        (tarefa, *parametros),
+                    )
+                    status = dict(c.fetchall())
+                # Qualquer índice com erro derruba a construção (construir_indices levanta e o
+                # produtor não chega ao swap), não só os que esperamos
+                falhas = sorted(nome for nome, s in status.items() if s == 'erro')
+                if falhas:
+                    raise RuntimeError(f"Índices de {tarefa} com erro: {', '.join(falhas)}")
+                if all(status.get(nome) == 'concluido' for nome in nomes):
+                    return
+                if time.time() >= limite:
+                    faltando = [nome for nome in nomes if status.get(nome) != 'concluido']
+                    raise RuntimeError(
+                        f"Índices de {tarefa} não ficaram prontos em {timeout}s: {', '.join(faltando)}"
+                    )
+                time.sleep(min(intervalo, max(limite - time.time(), 0)))
+    finally:
+        conn.close()
@@ -116,11 +116,12 @@ for arquivo in arquivos:
     t0 = time.time()
     print(f"Lendo {arquivo}... ", end="", flush=True)
 
+    # Arquivos *.utf8 já foram convertidos pelo etl_postgres.py: leitura nativa, multithread
     df = pl.read_csv(
         path,
         separator=";",
         has_header=False,
-        encoding="latin1",
+        encoding="utf8" if arquivo.endswith(".utf8") else "latin1",
         infer_schema_length=0,
         new_columns=ALL_ESTAB_COLS,
     ).select([
@@ -0,0 +1,179 @@
+"""
+Feed de mudanças entre gerações da RFB (tabela cnpj_changes).
+
+Durante a carga, cada parte de estabelecimento e socios também é reduzida a um
+retrato compacto em Parquet (mesma divisão por prefixo de cnpj_basico de
+particoes.py):
+
+    estabelecimento  cnpj, situacao_cadastral, cnae_fiscal_principal e um hash
+                     das colunas de endereço
+    socios           cnpj_basico, cpf_cnpj_socio, nome_socio_razao_social
+
+Ao fim da carga o retrato é comparado, uma partição por vez e com joins do
+Polars, com o da geração anterior. Cada diferença vira uma linha de
+cnpj_changes, com um dos eventos de EVENTOS. Depois o retrato atual passa a ser
+o anterior.
+
+Na primeira execução não há com o que comparar: só o retrato é gravado. O hash
+do endereço é o do Polars, que pode mudar entre versões; se o retrato anterior
+foi gravado por outra versão, os eventos de endereço daquela geração ficam de fora.
+Um retrato anterior sem o registro da versão (girar interrompido, por exemplo)
+é tratado como incompatível: não há comparação e o atual toma o seu lugar.
+
+    feed = FeedDeMudancas('/dados/retratos')
+    feed.gravar('estabelecimento', df)          # durante a carga
+    ...
+    for eventos in feed.comparar():             # DataFrames para cnpj_changes
+        ...
+    feed.girar()
+"""
+import os
+import shutil
+
+import polars as pl
+
+from particoes import Particoes
+
+# Número de partições do retrato: fixo, para o anterior e o atual serem comparáveis
+N_PARTICOES = 16
+
+EVENTOS = ['novo_cnpj', 'cnpj_removido', 'situacao_cadastral', 'cnae', 'endereco',
+           'socio_novo', 'socio_removido']
+
+COLUNAS_ENDERECO = ['logradouro', 'numero', 'complemento', 'bairro', 'cep', 'uf', 'municipio']
+
+# Colunas de cnpj_changes, na ordem dos DataFrames de comparar()
+COLUNAS = ['referencia', 'cnpj_basico', 'cnpj', 'evento', 'valor_anterior', 'valor_novo']
+
+_VERSAO = 'versao_polars'
+
+
+def criar_tabela(cur, schema):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS "{schema}"."cnpj_changes" (
+            referencia      VARCHAR(50),
+            cnpj_basico     VARCHAR(8),
+            cnpj            VARCHAR(14),
+            evento          VARCHAR(20),
+            valor_anterior  TEXT,
+            valor_novo      TEXT,
+            criado_em       TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    cur.execute(f'CREATE INDEX IF NOT EXISTS cnpj_changes_referencia ON "{schema}"."cnpj_changes" (referencia, evento)')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS cnpj_changes_basico ON "{schema}"."cnpj_changes" (cnpj_basico)')
+
+
+def _texto(coluna):
+    return pl.col(coluna).cast(pl.Utf8)
+
+
+def _retrato(tabela, df):
+    if tabela == 'estabelecimento':
+        return df.select(
+            _texto('cnpj_basico'),
+            pl.concat_str([_texto('cnpj_basico'), _texto('cnpj_ordem'), _texto('cnpj_dv')]).alias('cnpj'),
+            _texto('situacao_cadastral'),
+            _texto('cnae_fiscal_principal'),
+            pl.concat_str([_texto(c).fill_null('') for c in COLUNAS_ENDERECO], separator='\x1f')
+              .hash().alias('h_endereco'),
+        )
+    if tabela == 'socios':
+        return df.select(_texto('cnpj_basico'), _texto('cpf_cnpj_socio'), _texto('nome_socio_razao_social'))
+    return None
+
+
+def _evento(df, evento, anterior=None, novo=None, cnpj=True):
+    """Linhas de `evento` a partir de `df`, com as colunas de valor indicadas."""
+    return df.select(
+        pl.col('cnpj_basico'),
+        (pl.col('cnpj') if cnpj else pl.lit(None, pl.Utf8)).alias('cnpj'),
+        pl.lit(evento).alias('evento'),
+        (pl.col(anterior) if anterior else pl.lit(None, pl.Utf8)).alias('valor_anterior'),
+        (pl.col(novo) if novo else pl.lit(None, pl.Utf8)).alias('valor_novo'),
+    )
+
+
+class FeedDeMudancas:
+    def __init__(self, diretorio):
+        """Recria o retrato atual vazio em `diretorio`/atual; o anterior fica em `diretorio`/anterior."""
+        self.diretorio = diretorio
+        self.anterior = os.path.join(diretorio, 'anterior')
+        self.atual = Particoes(os.path.join(diretorio, 'atual'), N_PARTICOES)
+
+    def gravar(self, tabela, df):
+        """Grava o retrato de uma parte de estabelecimento ou socios (demais tabelas são ignoradas)."""
+        retrato = _retrato(tabela, df)
+        if retrato is not None:
+            self.atual.gravar(tabela, retrato)
+
+    def tem_anterior(self):
+        # Sem o arquivo da versão o retrato não ficou completo: é como se não existisse
+        return os.path.isfile(os.path.join(self.anterior, _VERSAO))
+
+    def _ler(self, diretorio, tabela, k):
+        arquivos = os.path.join(diretorio, tabela, f'p{k:03d}', '*.parquet')
+        if not os.path.isdir(os.path.dirname(arquivos)):
+            return None
+        return pl.scan_parquet(arquivos)
+
+    def comparar(self, referencia):
+        """
+        Gera, partição por partição, DataFrames com as colunas de COLUNAS com os
+        eventos entre o retrato anterior e o atual. Nada é gerado sem anterior.
+        """
+        if not self.tem_anterior():
+            return
+        with open(os.path.join(self.anterior, _VERSAO)) as f:
+            compara_endereco = f.read().strip() == pl.__version__
+
+        for k in range(N_PARTICOES):
+            partes = []
+            ant = self._ler(self.anterior, 'estabelecimento', k)
+            atu = self._ler(self.atual.diretorio, 'estabelecimento', k)
+            if ant is not None and atu is not None:
+                ambos = ant.join(atu, on='cnpj', how='inner', suffix='_novo')
+                partes += [
+                    _evento(atu.join(ant, on='cnpj', how='anti'), 'novo_cnpj', novo='situacao_cadastral'),
+                    _evento(ant.join(atu, on='cnpj', how='anti'), 'cnpj_removido', anterior='situacao_cadastral'),
+                    _evento(ambos.filter(pl.col('situacao_cadastral').ne_missing(pl.col('situacao_cadastral_novo'))),
+                            'situacao_cadastral', 'situacao_cadastral', 'situacao_cadastral_novo'),
+                    _evento(ambos.filter(pl.col('cnae_fiscal_principal').ne_missing(pl.col('cnae_fiscal_principal_novo'))),
+                            'cnae', 'cnae_fiscal_principal', 'cnae_fiscal_principal_novo'),
+                ]
+                if compara_endereco:
+                    partes.append(_evento(ambos.filter(pl.col('h_endereco') != pl.col('h_endereco_novo')), 'endereco'))
+            elif atu is not None:
+                partes.append(_evento(atu, 'novo_cnpj', novo='situacao_cadastral'))
+            elif ant is not None:
+                partes.append(_evento(ant, 'cnpj_removido', anterior='situacao_cadastral'))
+
+            chave = ['cnpj_basico', 'cpf_cnpj_socio', 'nome_socio_razao_social']
+            socio = pl.concat_str([pl.col('cpf_cnpj_socio').fill_null(''), pl.col('nome_socio_razao_social')],
+                                  separator=' ').alias('socio')
+            ant = self._ler(self.anterior, 'socios', k)
+            atu = self._ler(self.atual.diretorio, 'socios', k)
+            vazio = pl.LazyFrame(schema={c: pl.Utf8 for c in chave})
+            ant, atu = ant if ant is not None else vazio, atu if atu is not None else vazio
+            partes += [
+                _evento(atu.join(ant, on=chave, how='anti', nulls_equal=True).with_columns(socio),
+                        'socio_novo', novo='socio', cnpj=False),
+                _evento(ant.join(atu, on=chave, how='anti', nulls_equal=True).with_columns(socio),
+                        'socio_removido', anterior='socio', cnpj=False),
+            ]
+
+            eventos = pl.concat(partes).with_columns(pl.lit(referencia).alias('referencia')).select(COLUNAS).collect()
+            if eventos.height:
+                yield eventos
+
+    def girar(self):
+        """O retrato atual passa a ser o anterior da próxima geração."""
+        # A versão é gravada antes da troca: um anterior sem ela nunca é usado (tem_anterior)
+        with open(os.path.join(self.atual.diretorio, _VERSAO), 'w') as f:
+            f.write(pl.__version__)
+        shutil.rmtree(self.anterior, ignore_errors=True)
+        os.replace(self.atual.diretorio, self.anterior)
+
+    def descartar(self):
+        """Apaga o retrato atual (carga incompleta) e mantém o anterior."""
+        self.atual.remover()
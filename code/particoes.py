@@ -0,0 +1,71 @@
+"""
+Partições em disco (Parquet) das tabelas usadas na consolidação.
+
+Durante a carga, cada parte lida dos arquivos da RFB também é gravada aqui,
+dividida pelo prefixo de cnpj_basico: as 100 faixas de dois dígitos são
+agrupadas em `n` partições contíguas. Depois a consolidação junta uma
+partição por vez (estabelecimento × empresa × simples da mesma partição),
+sem ler as tabelas brutas de volta do PostgreSQL e com a memória limitada
+ao tamanho de uma partição.
+
+Tabelas sem cnpj_basico (cnae, natju, munic) são gravadas inteiras.
+
+    particoes = Particoes('/tmp/particoes', n=16)
+    particoes.gravar('empresa', df)           # durante a carga
+    ...
+    estab = particoes.ler('estabelecimento', 3)   # LazyFrame da partição 3
+"""
+import glob
+import itertools
+import os
+import shutil
+
+import polars as pl
+
+_COLUNA = '_particao'
+
+
+class Particoes:
+    def __init__(self, diretorio, n=16, colunas=None):
+        """
+        Recria `diretorio` vazio. `colunas` ({tabela: [colunas]}) restringe o que
+        é gravado de cada tabela; tabelas fora do dicionário são ignoradas.
+        """
+        self.diretorio = diretorio
+        self.n = n
+        self.colunas = colunas
+        self._seq = itertools.count()  # next() é atômico: nomes únicos entre threads
+        shutil.rmtree(diretorio, ignore_errors=True)
+        os.makedirs(diretorio)
+
+    def _pasta(self, tabela, particao):
+        return os.path.join(self.diretorio, tabela, f'p{particao:03d}')
+
+    def gravar(self, tabela, df):
+        """Grava `df` dividido pelo prefixo de cnpj_basico (ou inteiro, se não houver a coluna)."""
+        if self.colunas is not None:
+            if tabela not in self.colunas:
+                return
+            df = df.select(self.colunas[tabela])
+        if df.height == 0:
+            return
+        nome = f'{next(self._seq):08d}.parquet'
+        if 'cnpj_basico' not in df.columns:
+            os.makedirs(self._pasta(tabela, 0), exist_ok=True)
+            df.write_parquet(os.path.join(self._pasta(tabela, 0), nome))
+            return
+        prefixo = pl.col('cnpj_basico').cast(pl.Utf8).str.slice(0, 2).cast(pl.Int32, strict=False).fill_null(0)
+        df = df.with_columns((prefixo * self.n // 100).alias(_COLUNA))
+        for (particao,), parte in df.partition_by(_COLUNA, as_dict=True, include_key=False).items():
+            os.makedirs(self._pasta(tabela, particao), exist_ok=True)
+            parte.write_parquet(os.path.join(self._pasta(tabela, particao), nome))
+
+    def ler(self, tabela, particao=0):
+        """LazyFrame de uma partição, ou None se nada foi gravado nela."""
+        arquivos = glob.glob(os.path.join(self._pasta(tabela, particao), '*.parquet'))
+        if not arquivos:
+            return None
+        return pl.scan_parquet(arquivos)
+
+    def remover(self):
+        shutil.rmtree(self.diretorio, ignore_errors=True)
@@ -0,0 +1,165 @@
+"""
+Identidade das pessoas (sócios) de dados_rfb.pessoas.
+
+A chave de uma pessoa é (cpf_cnpj, nome), com o nome sem espaços nas pontas e
+em maiúsculas: o CPF mascarado não é único por pessoa (o mesmo ***052458** pode
+representar centenas de pessoas distintas). O id é determinístico,
+uuid5(UUID_NAMESPACE, 'cpf_cnpj|NOME'), então a carga de socios em
+etl_postgres.py já grava socios.pessoa_id (com_pessoa_id) e build_pessoas.py só
+deriva pessoas das combinações distintas, sem UPDATE em socios.
+"""
+import re
+import unicodedata
+import uuid
+
+import numpy as np
+import polars as pl
+
+# Namespace fixo — garante que o mesmo cpf_cnpj sempre gera o mesmo UUID
+UUID_NAMESPACE = uuid.UUID("a1b2c3d4-e5f6-7890-abcd-ef1234567890")
+
+
+def normalize_name(name: str) -> str:
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    name = name.lower().strip()
+    name = re.sub(r"[^a-z0-9\s]", "", name)
+    name = re.sub(r"\s+", "-", name)
+    return name[:60]
+
+
+def make_slug(uid: uuid.UUID, name: str) -> str:
+    return f"{str(uid)[:8]}-{normalize_name(name)}"
+
+
+# Espaços de str.isspace() no ASCII (o \s e o strip do Polars não incluem \x1c-\x1f)
+_ESPACOS = ' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+# Os demais de str.isspace(): o nome da chave não passa pelo NFKD antes do strip
+_ESPACOS_UNICODE = _ESPACOS + '\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000'
+
+
+def nome_canonico(coluna):
+    """Expressão do nome como entra na chave: sem espaços nas pontas e em maiúsculas (nulo vira '')."""
+    return pl.col(coluna).fill_null('').str.strip_chars(_ESPACOS_UNICODE).str.to_uppercase()
+
+
+def com_pessoa_id(df, cpf='cpf_cnpj_socio', nome='nome_socio_razao_social'):
+    """
+    `df` com a coluna pessoa_id (texto do UUID; nula sem cpf_cnpj). A chave é
+    montada no Polars e o uuid5 é calculado uma vez por chave distinta da
+    parte (uuid5_em_lote), depois juntado de volta às linhas.
+    """
+    valido = pl.col(cpf).is_not_null() & (pl.col(cpf) != '')
+    chave = pl.when(valido).then(pl.concat_str([pl.col(cpf), pl.lit('|'), nome_canonico(nome)]))
+    df = df.with_columns(chave.alias('_chave_pessoa'))
+    chaves = df.get_column('_chave_pessoa').drop_nulls().unique()
+    ids = pl.DataFrame({'_chave_pessoa': chaves, 'pessoa_id': uuid5_em_lote(chaves)})
+    return df.join(ids, on='_chave_pessoa', how='left', maintain_order='left').drop('_chave_pessoa')
+
+
+# Mensagens por chamada de _sha1: com os vetores no cache a rodada não espera a memória
+_MENSAGENS_POR_FATIA = 16_384
+
+
+def uuid5_em_lote(chaves, namespace=UUID_NAMESPACE):
+    """
+    Texto de uuid.uuid5(namespace, chave) para cada chave da Series `chaves`
+    (sem nulos). O SHA-1 roda no NumPy sobre todas as chaves de uma vez,
+    agrupadas pelo número de blocos de 64 bytes da mensagem.
+    """
+    n = len(chaves)
+    if n == 0:
+        return pl.Series(chaves.name, [], dtype=pl.Utf8)
+    prefixo = np.frombuffer(namespace.bytes, dtype=np.uint8)
+    tamanhos = chaves.str.len_bytes().to_numpy().astype(np.int64)
+    dados = np.frombuffer(chaves.str.join('').item().encode(), dtype=np.uint8)
+    mensagens = len(prefixo) + tamanhos
+    # Padding do SHA-1: 0x80, zeros e o tamanho em bits nos últimos 8 bytes do último bloco
+    blocos = (mensagens + 8) // 64 + 1
+    # Mensagens com padding lado a lado num buffer só, ordenadas pelo número de blocos:
+    # cada grupo vira uma matriz (linhas, blocos * 64) sem cópia
+    ordem = np.argsort(blocos, kind='stable')
+    larguras = blocos[ordem] * 64
+    destino = np.empty(n, dtype=np.int64)
+    destino[ordem] = np.cumsum(larguras) - larguras
+    buffer = np.zeros(int(larguras.sum()), dtype=np.uint8)
+    buffer[np.arange(len(dados)) + np.repeat(destino + len(prefixo) - (np.cumsum(tamanhos) - tamanhos), tamanhos)] = dados
+    buffer[destino + mensagens] = 0x80
+    resumo = np.empty((n, 16), dtype=np.uint8)
+    inicio = 0
+    for b, quantas in zip(*np.unique(blocos, return_counts=True)):
+        linhas = ordem[inicio:inicio + quantas]
+        m = buffer[destino[linhas[0]]:destino[linhas[0]] + quantas * b * 64].reshape(quantas, b * 64)
+        m[:, :len(prefixo)] = prefixo
+        m[:, -8:] = (mensagens[linhas] * 8).astype('>u8').view(np.uint8).reshape(-1, 8)
+        # Em fatias que cabem no cache: cada rodada do SHA-1 percorre os vetores inteiros
+        for i in range(0, quantas, _MENSAGENS_POR_FATIA):
+            fatia = slice(i, i + _MENSAGENS_POR_FATIA)
+            h = _sha1(np.ascontiguousarray(m[fatia].view('>u4').T, dtype=np.uint32), b)
+            resumo[linhas[fatia]] = np.stack(h[:4], axis=1).astype('>u4').view(np.uint8)
+        inicio += quantas
+    # Versão 5 e variante RFC 4122, como em uuid.UUID(bytes=sha1[:16], version=5)
+    resumo[:, 6] = (resumo[:, 6] & 0x0f) | 0x50
+    resumo[:, 8] = (resumo[:, 8] & 0x3f) | 0x80
+    hexa = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+    texto = np.full((n, 36), ord('-'), dtype=np.uint8)
+    posicoes = [i for i in range(36) if i not in (8, 13, 18, 23)]
+    texto[:, posicoes[0::2]] = hexa[resumo >> 4]
+    texto[:, posicoes[1::2]] = hexa[resumo & 0x0f]
+    return pl.Series(chaves.name, texto.view('S36').ravel()).cast(pl.Utf8)
+
+
+def _sha1(palavras, n_blocos):
+    """
+    Estado final do SHA-1 (h0..h4) de mensagens já com padding: `palavras` tem
+    uma linha por palavra de 32 bits e uma coluna por mensagem.
+    """
+    h = [np.full(palavras.shape[1], v, dtype=np.uint32)
+         for v in (0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0)]
+    for bloco in range(n_blocos):
+        w = list(palavras[bloco * 16:bloco * 16 + 16])
+        a, b, c, d, e = h
+        for t in range(80):
+            if t >= 16:
+                x = w[(t - 3) % 16] ^ w[(t - 8) % 16]
+                x ^= w[(t - 14) % 16]
+                x ^= w[t % 16]
+                w[t % 16] = (x << 1) | (x >> 31)
+            if t < 20:
+                f = b & c
+                f |= ~b & d
+                k = 0x5A827999
+            elif t < 40:
+                f = b ^ c
+                f ^= d
+                k = 0x6ED9EBA1
+            elif t < 60:
+                f = b & c
+                f |= (b | c) & d
+                k = 0x8F1BBCDC
+            else:
+                f = b ^ c
+                f ^= d
+                k = 0xCA62C1D6
+            f += e
+            f += np.uint32(k)
+            f += w[t % 16]
+            f += (a << 5) | (a >> 27)
+            a, b, c, d, e = f, a, (b << 30) | (b >> 2), c, d
+        h = [x + y for x, y in zip(h, (a, b, c, d, e))]
+    return h
+
+
+
+def slug(id_col='id', nome_col='nome', cpf_col='cpf_cnpj'):
+    """Expressão equivalente a make_slug(id, nome or cpf_cnpj), para calcular os slugs de uma vez."""
+    nome = pl.when(pl.col(nome_col).fill_null('') != '').then(pl.col(nome_col)).otherwise(pl.col(cpf_col))
+    normalizado = (
+        nome.str.normalize('NFKD')
+        .str.replace_all(r'[^\x00-\x7f]', '')
+        .str.to_lowercase()
+        .str.strip_chars(_ESPACOS)
+        .str.replace_all(r'[^a-z0-9\t\n\r\x0b\x0c\x1c-\x1f ]', '')
+        .str.replace_all(r'[\t\n\r\x0b\x0c\x1c-\x1f ]+', '-')
+        .str.slice(0, 60)
+    )
+    return pl.concat_str([pl.col(id_col).str.slice(0, 8), pl.lit('-'), normalizado])
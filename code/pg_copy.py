@@ -0,0 +1,350 @@
+"""
+Envio de dados ao PostgreSQL por COPY FROM STDIN em fluxo.
+
+`FluxoCopy` entrega ao copy_expert blocos de tamanho fixo gerados sob demanda
+a partir de um iterador de pedaços (fatias de DataFrame, lotes de linhas ou
+linhas prontas), sem montar o conteúdo inteiro em memória: o pico fica em
+O(bloco) e a serialização acontece junto com o envio pela rede.
+
+O CSV obriga o servidor a interpretar o texto de novo; com `copiar_binario`
+cada coluna é codificada direto no formato `COPY ... (FORMAT binary)`, de
+acordo com o tipo da coluna de destino (lido do pg_catalog).
+
+`CargaParalela` distribui as partes de uma tabela entre várias conexões de
+escrita, cada uma com o seu COPY.
+
+Tipos suportados no destino: text/varchar/bpchar (a partir de colunas texto ou
+inteiras), int2/int4/int8 (a partir de colunas inteiras) e uuid (a partir do
+texto do UUID). Qualquer outra
+combinação (numeric, date, float...) faz `copiar_binario` devolver False para
+que o chamador use o COPY em CSV.
+
+No sentido contrário, `copia_de_saida` expõe o `COPY (consulta) TO STDOUT`
+como um stream de bytes CSV lido direto pelo parser do Polars, com o schema de
+`tipos_da_consulta`, sem criar uma tupla Python por linha.
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import polars as pl
+import psycopg2
+
+# Tamanho de cada read() feito pelo copy_expert
+TAMANHO_BLOCO = 1024 * 1024
+
+# Cabeçalho fixo do formato binário: assinatura + flags (int32) + extensão (int32)
+CABECALHO = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+# Fim dos dados: contagem de campos igual a -1
+TRAILER = b'\xff\xff'
+
+TIPOS_TEXTO = {'text', 'varchar', 'bpchar'}
+TIPOS_INTEIROS = {'int2': 2, 'int4': 4, 'int8': 8}
+
+# Tipos lidos com dtype próprio no COPY TO; os demais (numeric, date...) ficam
+# Utf8 com o texto do PostgreSQL, que volta igual num COPY FROM
+DTYPES_DE_LEITURA = {
+    'int2': pl.Int16, 'int4': pl.Int32, 'int8': pl.Int64,
+    'float4': pl.Float32, 'float8': pl.Float64, 'bool': pl.Boolean,
+}
+
+# Tabela de 65536 grupos hexadecimais de 16 bits: os inteiros são quebrados em
+# pedaços de 16 bits e convertidos com gather (bem mais rápido que formatar)
+_HEX16 = pl.Series([f'{i:04x}' for i in range(65536)], dtype=pl.Utf8)
+_NULO = 'ffffffff'
+
+_tipos_cache = {}
+
+
+def tipos_das_colunas(conn, schema, table_name):
+    """
+    Retorna {coluna: nome do tipo} da tabela de destino. O cache é pelo OID: uma
+    tabela recriada com o mesmo nome (as _new de cada carga) é lida de novo.
+    """
+    with conn.cursor() as cur:
+        cur.execute('SELECT %s::regclass::oid', (f'"{schema}"."{table_name}"',))
+        oid = cur.fetchone()[0]
+        if oid not in _tipos_cache:
+            cur.execute(
+                """
+                SELECT a.attname, t.typname
+                  FROM pg_attribute a
+                  JOIN pg_type t ON t.oid = a.atttypid
+                 WHERE a.attrelid = %s
+                   AND a.attnum > 0 AND NOT a.attisdropped
+                """,
+                (oid,),
+            )
+            _tipos_cache[oid] = dict(cur.fetchall())
+    return _tipos_cache[oid]
+
+
+def tipos_da_consulta(conn, query):
+    """{coluna: dtype do Polars} do resultado de `query`, sem executá-la (LIMIT 0)."""
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT * FROM ({query}) q LIMIT 0')
+        colunas = [(d[0], d[1]) for d in cur.description]
+        cur.execute('SELECT oid, typname FROM pg_type WHERE oid = ANY(%s)',
+                    (list({oid for _, oid in colunas}),))
+        nomes = dict(cur.fetchall())
+    return {nome: DTYPES_DE_LEITURA.get(nomes.get(oid), pl.Utf8) for nome, oid in colunas}
+
+
+@contextmanager
+def copia_de_saida(conn, query, tamanho_buffer=TAMANHO_BLOCO):
+    """
+    Stream binário com o CSV (UTF-8, sem cabeçalho, nulos vazios) de
+    `COPY (query) TO STDOUT`. O COPY roda numa thread que escreve num pipe;
+    quem lê recebe os dados enquanto chegam e o servidor para de enviar se a
+    leitura ficar para trás. `conn` fica ocupada até o fim do bloco with.
+    """
+    r, w = os.pipe()
+    erro = []
+
+    def produzir():
+        try:
+            with open(w, 'wb', buffering=tamanho_buffer) as saida, conn.cursor() as cur:
+                cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, ENCODING 'UTF8')", saida)
+        except Exception as e:
+            erro.append(e)
+
+    produtor = threading.Thread(target=produzir, daemon=True)
+    with open(r, 'rb') as entrada:
+        produtor.start()
+        try:
+            yield entrada
+        except BaseException:
+            # Leitor desistiu: interrompe o COPY antes de fechar o pipe
+            conn.cancel()
+            raise
+        finally:
+            entrada.close()
+            produtor.join()
+    if erro:
+        raise erro[0]
+
+
+def _hex16(e):
+    return pl.lit(_HEX16).gather(e)
+
+
+def _hex_inteiro(u, n_bytes):
+    """Hex big-endian de `u` (inteiro sem sinal) com n_bytes bytes."""
+    grupos = []
+    for i in reversed(range(n_bytes // 2)):
+        grupos.append(_hex16((u // (65536 ** i)) % 65536))
+    return pl.concat_str(grupos)
+
+
+def _campo_texto(nome):
+    e = pl.col(nome).cast(pl.Utf8)
+    tamanho = e.str.len_bytes().cast(pl.Int64)
+    return pl.when(e.is_null()).then(pl.lit(_NULO)).otherwise(
+        pl.concat_str([_hex_inteiro(tamanho, 4), e.cast(pl.Binary).bin.encode('hex')])
+    )
+
+
+def _verificar_faixa(df, nome, n_bytes):
+    """Levanta OverflowError se a coluna não couber no inteiro de n_bytes do destino (como o COPY em CSV)."""
+    limite = 2 ** (8 * n_bytes - 1)
+    menor, maior = df.get_column(nome).min(), df.get_column(nome).max()
+    for valor in (menor, maior):
+        if valor is not None and not -limite <= valor < limite:
+            raise OverflowError(f"Coluna {nome}: {valor} fora da faixa de int{n_bytes}")
+
+
+def _campo_inteiro(nome, n_bytes):
+    e = pl.col(nome).cast(pl.Int64)
+    if n_bytes == 8:
+        u = e.reinterpret(signed=False)
+    else:
+        # Módulo do Polars é "floored": negativos viram complemento de dois
+        # (a faixa já foi conferida em expressoes_binarias)
+        u = e % (256 ** n_bytes)
+    return pl.when(e.is_null()).then(pl.lit(_NULO)).otherwise(
+        pl.concat_str([pl.lit(f'{n_bytes:08x}'), _hex_inteiro(u, n_bytes)])
+    )
+
+
+def _campo_uuid(nome):
+    # Os 16 bytes do UUID são os 32 dígitos hexadecimais do texto, sem os hífens
+    e = pl.col(nome).cast(pl.Utf8)
+    return pl.when(e.is_null()).then(pl.lit(_NULO)).otherwise(
+        pl.concat_str([pl.lit(f'{16:08x}'), e.str.replace_all('-', '', literal=True)])
+    )
+
+
+def expressoes_binarias(df, tipos):
+    """
+    Monta a expressão de cada campo em hexadecimal conforme o tipo de destino.
+    Retorna None se alguma coluna não puder ser codificada em binário; levanta
+    OverflowError se um inteiro não couber no tipo de destino.
+    """
+    campos = []
+    for nome, dtype in df.schema.items():
+        tipo = tipos.get(nome)
+        if tipo in TIPOS_TEXTO and (dtype == pl.Utf8 or dtype.is_integer()):
+            campos.append(_campo_texto(nome))
+        elif tipo in TIPOS_INTEIROS and dtype.is_integer():
+            _verificar_faixa(df, nome, TIPOS_INTEIROS[tipo])
+            campos.append(_campo_inteiro(nome, TIPOS_INTEIROS[tipo]))
+        elif tipo == 'uuid' and dtype == pl.Utf8:
+            campos.append(_campo_uuid(nome))
+        else:
+            return None
+    return campos
+
+
+class FluxoCopy:
+    """
+    Objeto tipo arquivo para o copy_expert. Consome `pedacos` (str ou bytes)
+    conforme o COPY lê; `pedacos_lidos` conta quantos já foram consumidos.
+    """
+
+    def __init__(self, pedacos):
+        self._pedacos = iter(pedacos)
+        self._atual = ''
+        self._vazio = ''
+        self._pos = 0
+        self.pedacos_lidos = 0
+
+    def read(self, size=-1):
+        partes = []
+        falta = size
+        while size < 0 or falta > 0:
+            if self._pos >= len(self._atual):
+                proximo = next(self._pedacos, None)
+                if proximo is None:
+                    break
+                self._atual, self._vazio, self._pos = proximo, proximo[:0], 0
+                self.pedacos_lidos += 1
+                continue
+            fim = len(self._atual) if size < 0 else self._pos + falta
+            trecho = self._atual[self._pos:fim]
+            self._pos += len(trecho)
+            falta -= len(trecho)
+            partes.append(trecho)
+        return self._vazio.join(partes)
+
+
+def copiar_fluxo(cur, copy_sql, pedacos, tamanho_bloco=TAMANHO_BLOCO):
+    """Executa `copy_sql` lendo de `pedacos` em fluxo. Retorna quantos pedaços foram enviados."""
+    fluxo = FluxoCopy(pedacos)
+    cur.copy_expert(copy_sql, fluxo, size=tamanho_bloco)
+    return fluxo.pedacos_lidos
+
+
+def csv_de_dataframe(df, linhas_por_fatia=50_000):
+    """CSV (sem cabeçalho, nulos vazios) de `df`, uma fatia por vez."""
+    for inicio in range(0, df.height, linhas_por_fatia):
+        yield df.slice(inicio, linhas_por_fatia).write_csv(include_header=False, null_value='')
+
+
+def _binario_de_dataframe(df, campos, linhas_por_fatia):
+    linha = pl.concat_str([pl.lit(f'{len(campos):04x}')] + campos)
+    yield CABECALHO
+    for inicio in range(0, df.height, linhas_por_fatia):
+        fatia = df.slice(inicio, linhas_por_fatia)
+        yield bytes.fromhex(fatia.select(linha.str.join('')).item())
+    yield TRAILER
+
+
+def copiar_binario(df, table_name, cur, schema, linhas_por_fatia=50_000):
+    """
+    Envia `df` com COPY FORMAT binary usando o cursor `cur`.
+    Retorna False (sem enviar nada) se os tipos não forem suportados.
+    """
+    tipos = tipos_das_colunas(cur.connection, schema, table_name)
+    campos = expressoes_binarias(df, tipos)
+    if campos is None:
+        return False
+    col_list = ', '.join(f'"{c}"' for c in df.columns)
+    copy_sql = f'COPY "{schema}"."{table_name}" ({col_list}) FROM STDIN WITH (FORMAT binary)'
+    copiar_fluxo(cur, copy_sql, _binario_de_dataframe(df, campos, linhas_por_fatia))
+    return True
+
+
+class CargaParalela:
+    """
+    Carga por N conexões de escrita em paralelo.
+
+    `enviar(df)` coloca a parte numa fila limitada (o leitor espera se os
+    escritores ficarem para trás) e cada thread escritora faz o COPY na sua
+    própria conexão com `escrever(df, tabela, conn)`. Ao fechar, mostra as
+    linhas/s de cada conexão e relança o primeiro erro de escrita.
+
+        with CargaParalela(dsn, 'socios', escrever, n_conexoes=4) as carga:
+            for df in partes:
+                carga.enviar(df)
+
+    Com tabela=None a mesma carga atende várias tabelas: `enviar(df, tabela)`.
+    """
+
+    def __init__(self, dsn, tabela, escrever, n_conexoes=4, tamanho_fila=None):
+        self.tabela = tabela
+        self._escrever = escrever
+        self._fila = queue.Queue(maxsize=tamanho_fila or 2 * n_conexoes)
+        self._erro = None
+        self._stats = [[0, 0.0] for _ in range(n_conexoes)]  # linhas, segundos em COPY
+        self._conexoes = [psycopg2.connect(dsn) for _ in range(n_conexoes)]
+        self._threads = [
+            threading.Thread(target=self._trabalhar, args=(i,), daemon=True)
+            for i in range(n_conexoes)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _trabalhar(self, i):
+        conn = self._conexoes[i]
+        while True:
+            item = self._fila.get()
+            if item is None:
+                return
+            if self._erro is not None:
+                continue  # só esvazia a fila para o leitor não travar
+            tabela, df = item
+            t0 = time.time()
+            try:
+                self._escrever(df, tabela, conn)
+            except Exception as e:
+                self._erro = self._erro or e
+                conn.rollback()
+                continue
+            self._stats[i][0] += df.height
+            self._stats[i][1] += time.time() - t0
+
+    def enviar(self, df, tabela=None):
+        if self._erro is not None:
+            raise self._erro
+        self._fila.put((tabela or self.tabela, df))
+
+    def fechar(self):
+        for _ in self._threads:
+            self._fila.put(None)
+        for t in self._threads:
+            t.join()
+        for conn in self._conexoes:
+            conn.close()
+        for i, (linhas, segundos) in enumerate(self._stats):
+            taxa = linhas / segundos if segundos else 0
+            print(f"  [{self.tabela or 'carga'}] conexão {i + 1}: {linhas:,} linhas em "
+                  f"{round(segundos)}s ({taxa:,.0f} linhas/s)")
+        if self._erro is not None:
+            raise self._erro
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        if tipo is None:
+            self.fechar()
+        else:
+            # Erro no leitor: encerra os escritores sem mascarar a exceção original
+            self._erro = self._erro or valor
+            try:
+                self.fechar()
+            except Exception:
+                pass
+        return False
@@ -4,9 +4,30 @@
 set -e
 
 echo "=== [1/6] ETL Postgres (download + carga raw) ===" && python code/etl_postgres.py
-echo "=== [2/6] Consolidar cnpj_consolidado ===" && python code/consolidar_fast.py
-echo "=== [3/6] Build socios_consolidado ===" && python code/build_socios_consolidado.py
-echo "=== [4/6] Build pessoas_consolidado ===" && python code/build_pessoas_consolidado.py
+
+# 2 e 3-4 em paralelo: socios_consolidado só espera os índices de que depende
+# (consolidado_sql.DEPENDENCIAS_DAS_ETAPAS) e lê empresa_matriz_new enquanto os
+# GIN de cnpj_consolidado continuam; o swap das duas espera essa leitura terminar
+# Mesma geração para quem constrói e quem aguarda os índices (indices.GERACAO)
+export GERACAO_DOS_INDICES="$(date +%Y%m%d%H%M%S)-$$"
+# Cada job em segundo plano no seu grupo de processos: o kill abaixo alcança o python
+# que estiver rodando dentro do subshell, não só o subshell
+set -m
+echo "=== [2/6] Consolidar cnpj_consolidado ===" && python code/consolidar_fast.py &
+consolidar=$!
+(
+  echo "=== [3/6] Build socios_consolidado ===" && AGUARDAR_INDICES=1 python code/build_socios_consolidado.py
+  echo "=== [4/6] Build pessoas_consolidado ===" && python code/build_pessoas_consolidado.py
+) &
+socios=$!
+if ! wait $consolidar; then
+  echo "consolidar_fast.py falhou; interrompendo socios/pessoas." >&2
+  kill -- -$socios 2>/dev/null || true
+  exit 1
+fi
+wait $socios
+set +m
+
 echo "=== [5/6] Meilisearch: indexar pessoas ===" && python code/build_meili_socios.py
 echo "=== [6/6] Meilisearch: indexar socios ===" && python code/build_meili_socios_idx.py
 